@@ -18,15 +18,16 @@ COMPILE_ARGS = ("-Wall -g -O2 -shared -fPIC"
 SSE_FLAGS = "-mfpmath=sse -msse2"
 SOURCE_FILES = [
     'pyhelper.c', 'serialqueue.c', 'stepcompress.c', 'itersolve.c', 'trapq.c',
-    'pollreactor.c', 'msgblock.c', 'trdispatch.c',
+    'pollreactor.c', 'msgblock.c', 'trdispatch.c', 'lookahead.c',
+    'stepflush.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_corexz.c', 'kin_delta.c',
     'kin_deltesian.c', 'kin_polar.c', 'kin_rotary_delta.c', 'kin_winch.c',
-    'kin_extruder.c', 'kin_shaper.c',
+    'kin_extruder.c', 'kin_shaper.c', 'kin_bed_mesh.c',
 ]
 DEST_LIB = "c_helper.so"
 OTHER_FILES = [
     'list.h', 'serialqueue.h', 'stepcompress.h', 'itersolve.h', 'pyhelper.h',
-    'trapq.h', 'pollreactor.h', 'msgblock.h'
+    'trapq.h', 'pollreactor.h', 'msgblock.h', 'lookahead.h', 'stepflush.h',
 ]
 
 defs_stepcompress = """
@@ -72,8 +73,12 @@ defs_itersolve = """
         , struct stepcompress *sc, double step_dist);
     double itersolve_calc_position_from_coord(struct stepper_kinematics *sk
         , double x, double y, double z);
+    double itersolve_calc_position_from_axes(struct stepper_kinematics *sk
+        , double *pos, int axis_count);
     void itersolve_set_position(struct stepper_kinematics *sk
         , double x, double y, double z);
+    void itersolve_set_position_axes(struct stepper_kinematics *sk
+        , double *pos, int axis_count);
     double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
 """
 
@@ -83,6 +88,7 @@ defs_trapq = """
         double start_v, accel;
         double start_x, start_y, start_z;
         double x_r, y_r, z_r;
+        double start_pos[9], axes_r[9];
     };
 
     struct trapq *trapq_alloc(void);
@@ -92,13 +98,44 @@ defs_trapq = """
         , double start_pos_x, double start_pos_y, double start_pos_z
         , double axes_r_x, double axes_r_y, double axes_r_z
         , double start_v, double cruise_v, double accel);
+    void trapq_append_axes(struct trapq *tq, double print_time
+        , double accel_t, double cruise_t, double decel_t
+        , double *start_pos, double *axes_r, int axis_count
+        , double start_v, double cruise_v, double accel);
+    void trapq_append_arc(struct trapq *tq, double print_time
+        , double accel_t, double cruise_t, double decel_t
+        , double *start_pos, double *axes_r, int axis_count
+        , double start_v, double cruise_v, double accel
+        , int axis0, int axis1, double radius, double angle
+        , double angle_r);
+    int trapq_extend(struct trapq *tq, double end_time);
     void trapq_finalize_moves(struct trapq *tq, double print_time);
+    void trapq_append_multi(struct trapq **tqs, int tq_count, int axis_count
+        , double *data, int move_count);
+    void trapq_finalize_moves_multi(struct trapq **tqs, int tq_count
+        , double print_time);
     void trapq_set_position(struct trapq *tq, double print_time
         , double pos_x, double pos_y, double pos_z);
+    void trapq_set_position_axes(struct trapq *tq, double print_time
+        , double *pos, int axis_count);
     int trapq_extract_old(struct trapq *tq, struct pull_move *p, int max
         , double start_time, double end_time);
 """
 
+defs_lookahead = """
+    struct lookahead_limits {
+        double max_start_v2, delta_v2;
+        double max_smoothed_v2, smooth_delta_v2;
+        double max_cruise_v2;
+    };
+    struct lookahead_junction {
+        double start_v2, cruise_v2, end_v2;
+    };
+
+    int lookahead_flush(struct lookahead_limits *limits
+        , struct lookahead_junction *junctions, int count, int lazy);
+"""
+
 defs_kin_cartesian = """
     struct stepper_kinematics *cartesian_stepper_alloc(char axis);
     struct stepper_kinematics *cartesian_reverse_stepper_alloc(char axis);
@@ -153,6 +190,22 @@ defs_kin_shaper = """
     struct stepper_kinematics * input_shaper_alloc(void);
 """
 
+defs_kin_bed_mesh = """
+    int bed_mesh_set_sk(struct stepper_kinematics *sk
+        , struct stepper_kinematics *orig_sk);
+    int bed_mesh_set_grid(struct stepper_kinematics *sk, int x_count
+        , int y_count, double min_x, double min_y, double dist_x
+        , double dist_y, double *z);
+    void bed_mesh_set_offsets(struct stepper_kinematics *sk
+        , double x, double y);
+    void bed_mesh_set_fade(struct stepper_kinematics *sk, double fade_start
+        , double fade_end, double fade_target);
+    double bed_mesh_get_z_adjust(struct stepper_kinematics *sk
+        , double x, double y, double z);
+    struct stepper_kinematics *bed_mesh_alloc(void);
+    void bed_mesh_free(struct stepper_kinematics *sk);
+"""
+
 defs_serialqueue = """
     #define MESSAGE_MAX 64
     struct pull_queue_message {
@@ -171,6 +224,11 @@ defs_serialqueue = """
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock
         , uint64_t notify_id);
+    void serialqueue_send_ints(struct serialqueue *sq, struct command_queue *cq
+        , int64_t *data, int len, int count
+        , uint64_t min_clock, uint64_t req_clock);
+    int serialqueue_pull_batch(struct serialqueue *sq
+        , struct pull_queue_message *q, int max);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
     void serialqueue_set_wire_frequency(struct serialqueue *sq
@@ -184,6 +242,26 @@ defs_serialqueue = """
         , struct pull_queue_message *q, int max);
 """
 
+defs_msgblock = """
+    struct msgdecoder *msgdecoder_alloc(void);
+    void msgdecoder_free(struct msgdecoder *md);
+    int msgdecoder_set_format(struct msgdecoder *md, int msgid, char *types);
+    int msgdecoder_decode(struct msgdecoder *md, uint8_t *msg, int msg_len
+        , int64_t *values, int max_values);
+"""
+
+defs_stepflush = """
+    struct stepflush *stepflush_alloc(void);
+    void stepflush_free(struct stepflush *sf);
+    int stepflush_add_mcu(struct stepflush *sf, struct steppersync *ss);
+    int stepflush_add_stepper(struct stepflush *sf, int mcu_index
+        , struct stepper_kinematics *sk);
+    void stepflush_set_stepper(struct stepflush *sf, int stepper_index
+        , struct stepper_kinematics *sk);
+    int stepflush_flush(struct stepflush *sf, double gen_time
+        , int64_t *flush_clocks, int32_t *results);
+"""
+
 defs_trdispatch = """
     void trdispatch_start(struct trdispatch *td, uint32_t dispatch_reason);
     void trdispatch_stop(struct trdispatch *td);
@@ -207,11 +285,12 @@ defs_std = """
 """
 
 defs_all = [
-    defs_pyhelper, defs_serialqueue, defs_std, defs_stepcompress,
-    defs_itersolve, defs_trapq, defs_trdispatch,
+    defs_pyhelper, defs_serialqueue, defs_msgblock, defs_std,
+    defs_stepcompress, defs_itersolve, defs_trapq, defs_trdispatch,
+    defs_lookahead, defs_stepflush,
     defs_kin_cartesian, defs_kin_corexy, defs_kin_corexz, defs_kin_delta,
     defs_kin_deltesian, defs_kin_polar, defs_kin_rotary_delta, defs_kin_winch,
-    defs_kin_extruder, defs_kin_shaper,
+    defs_kin_extruder, defs_kin_shaper, defs_kin_bed_mesh,
 ]
 
 # Update filenames to an absolute path
@@ -136,10 +136,14 @@ itersolve_gen_steps_range(struct stepper_kinematics *sk, struct move *m
 static inline int
 check_active(struct stepper_kinematics *sk, struct move *m)
 {
-    int af = sk->active_flags;
-    return ((af & AF_X && m->axes_r.x != 0.)
-            || (af & AF_Y && m->axes_r.y != 0.)
-            || (af & AF_Z && m->axes_r.z != 0.));
+    int af = sk->active_flags, i;
+    if (m->arc_radius
+        && af & ((AF_X << m->arc_axis0) | (AF_X << m->arc_axis1)))
+        return 1;
+    for (i = 0; af; i++, af >>= 1)
+        if (af & 1 && m->axes_r.axis[i] != 0.)
+            return 1;
+    return 0;
 }
 
 // Generate step times for a range of moves on the trapq
@@ -234,9 +238,10 @@ itersolve_check_active(struct stepper_kinematics *sk, double flush_time)
 int32_t __visible
 itersolve_is_active_axis(struct stepper_kinematics *sk, char axis)
 {
-    if (axis < 'x' || axis > 'z')
+    int index = trapq_axis_index(axis);
+    if (index < 0)
         return 0;
-    return (sk->active_flags & (AF_X << (axis - 'x'))) != 0;
+    return (sk->active_flags & (AF_X << index)) != 0;
 }
 
 void __visible
@@ -266,6 +271,19 @@ itersolve_calc_position_from_coord(struct stepper_kinematics *sk
     return sk->calc_position_cb(sk, &m, 500.);
 }
 
+double __visible
+itersolve_calc_position_from_axes(struct stepper_kinematics *sk
+                                  , double *pos, int axis_count)
+{
+    struct move m;
+    memset(&m, 0, sizeof(m));
+    if (axis_count > TRAPQ_MAX_AXES)
+        axis_count = TRAPQ_MAX_AXES;
+    memcpy(m.start_pos.axis, pos, axis_count * sizeof(m.start_pos.axis[0]));
+    m.move_t = 1000.;
+    return sk->calc_position_cb(sk, &m, 500.);
+}
+
 void __visible
 itersolve_set_position(struct stepper_kinematics *sk
                        , double x, double y, double z)
@@ -273,6 +291,13 @@ itersolve_set_position(struct stepper_kinematics *sk
     sk->commanded_pos = itersolve_calc_position_from_coord(sk, x, y, z);
 }
 
+void __visible
+itersolve_set_position_axes(struct stepper_kinematics *sk
+                            , double *pos, int axis_count)
+{
+    sk->commanded_pos = itersolve_calc_position_from_axes(sk, pos, axis_count);
+}
+
 double __visible
 itersolve_get_commanded_pos(struct stepper_kinematics *sk)
 {
@@ -5,6 +5,8 @@
 
 enum {
     AF_X = 1 << 0, AF_Y = 1 << 1, AF_Z = 1 << 2,
+    AF_A = 1 << 3, AF_B = 1 << 4, AF_C = 1 << 5,
+    AF_U = 1 << 6, AF_V = 1 << 7, AF_W = 1 << 8,
 };
 
 struct stepper_kinematics;
@@ -34,8 +36,12 @@ void itersolve_set_stepcompress(struct stepper_kinematics *sk
                                 , struct stepcompress *sc, double step_dist);
 double itersolve_calc_position_from_coord(struct stepper_kinematics *sk
                                           , double x, double y, double z);
+double itersolve_calc_position_from_axes(struct stepper_kinematics *sk
+                                         , double *pos, int axis_count);
 void itersolve_set_position(struct stepper_kinematics *sk
                             , double x, double y, double z);
+void itersolve_set_position_axes(struct stepper_kinematics *sk
+                                 , double *pos, int axis_count);
 double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
 
 #endif // itersolve.h
@@ -0,0 +1,193 @@
+// Bed mesh z compensation applied during step generation
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <math.h> // floor
+#include <stddef.h> // offsetof
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "itersolve.h" // struct stepper_kinematics
+#include "trapq.h" // struct move
+
+
+/****************************************************************
+ * Mesh interpolation
+ ****************************************************************/
+
+struct mesh_grid {
+    int x_count, y_count;
+    double min_x, min_y, inv_dist_x, inv_dist_y;
+    double offset_x, offset_y;
+    double *z;
+};
+
+static inline double
+clamp(double v, double min_v, double max_v)
+{
+    return v < min_v ? min_v : (v > max_v ? max_v : v);
+}
+
+// Bilinear interpolation of the mesh (see ZMesh.calc_z in bed_mesh.py)
+static double
+mesh_calc_z(struct mesh_grid *g, double x, double y)
+{
+    double cx = (x + g->offset_x - g->min_x) * g->inv_dist_x;
+    double cy = (y + g->offset_y - g->min_y) * g->inv_dist_y;
+    int xidx = clamp(floor(cx), 0., g->x_count - 2);
+    int yidx = clamp(floor(cy), 0., g->y_count - 2);
+    double tx = clamp(cx - xidx, 0., 1.), ty = clamp(cy - yidx, 0., 1.);
+    double *row0 = &g->z[yidx * g->x_count + xidx], *row1 = row0 + g->x_count;
+    double z00 = row0[0], z01 = row0[1], z10 = row1[0], z11 = row1[1];
+    return (z00 + (z01 - z00) * tx
+            + ((z10 - z00) + (z11 - z10 - z01 + z00) * tx) * ty);
+}
+
+
+/****************************************************************
+ * Kinematics-related mesh code
+ ****************************************************************/
+
+#define DUMMY_T 500.0
+
+struct bed_mesh {
+    struct stepper_kinematics sk;
+    struct stepper_kinematics *orig_sk;
+    struct move m;
+    struct mesh_grid grid;
+    double fade_start, fade_end, fade_target;
+};
+
+// Return the z adjustment for a (non-adjusted) toolhead position
+static double
+bed_mesh_z_adjust(struct bed_mesh *bm, double x, double y, double z)
+{
+    double factor = 1.;
+    if (z >= bm->fade_end)
+        factor = 0.;
+    else if (z >= bm->fade_start)
+        factor = (bm->fade_end - z) / (bm->fade_end - bm->fade_start);
+    if (!factor)
+        return bm->fade_target;
+    double mesh_z = mesh_calc_z(&bm->grid, x, y);
+    return factor * (mesh_z - bm->fade_target) + bm->fade_target;
+}
+
+static double
+bed_mesh_calc_position(struct stepper_kinematics *sk, struct move *m
+                       , double move_time)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    if (!bm->grid.z)
+        return bm->orig_sk->calc_position_cb(bm->orig_sk, m, move_time);
+    struct coord c = move_get_coord(m, move_time);
+    c.z += bed_mesh_z_adjust(bm, c.x, c.y, c.z);
+    bm->m.start_pos = c;
+    return bm->orig_sk->calc_position_cb(bm->orig_sk, &bm->m, DUMMY_T);
+}
+
+// Return the z adjustment the stepper applies at a toolhead position
+double __visible
+bed_mesh_get_z_adjust(struct stepper_kinematics *sk
+                      , double x, double y, double z)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    if (!bm->grid.z)
+        return 0.;
+    return bed_mesh_z_adjust(bm, x, y, z);
+}
+
+static void
+bed_mesh_note_active_flags(struct bed_mesh *bm)
+{
+    // With a mesh the stepper also moves on xy moves
+    bm->sk.active_flags = bm->orig_sk->active_flags;
+    if (bm->grid.z)
+        bm->sk.active_flags |= AF_X | AF_Y;
+}
+
+int __visible
+bed_mesh_set_sk(struct stepper_kinematics *sk
+                , struct stepper_kinematics *orig_sk)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    if (!(orig_sk->active_flags & AF_Z))
+        return -1;
+    bm->sk.calc_position_cb = bed_mesh_calc_position;
+    bm->orig_sk = orig_sk;
+    bm->sk.commanded_pos = orig_sk->commanded_pos;
+    bm->sk.last_flush_time = orig_sk->last_flush_time;
+    bm->sk.last_move_time = orig_sk->last_move_time;
+    bm->sk.gen_steps_pre_active = orig_sk->gen_steps_pre_active;
+    bm->sk.gen_steps_post_active = orig_sk->gen_steps_post_active;
+    bed_mesh_note_active_flags(bm);
+    return 0;
+}
+
+// Set the mesh grid (z values by row), a count below 2 disables the mesh
+int __visible
+bed_mesh_set_grid(struct stepper_kinematics *sk, int x_count, int y_count
+                  , double min_x, double min_y, double dist_x, double dist_y
+                  , double *z)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    struct mesh_grid *g = &bm->grid;
+    free(g->z);
+    g->z = NULL;
+    int ret = 0;
+    if (x_count >= 2 && y_count >= 2 && dist_x > 0. && dist_y > 0.) {
+        size_t size = sizeof(*g->z) * x_count * y_count;
+        g->z = malloc(size);
+        if (g->z) {
+            memcpy(g->z, z, size);
+            g->x_count = x_count;
+            g->y_count = y_count;
+            g->min_x = min_x;
+            g->min_y = min_y;
+            g->inv_dist_x = 1. / dist_x;
+            g->inv_dist_y = 1. / dist_y;
+        } else {
+            ret = -1;
+        }
+    } else if (x_count || y_count) {
+        ret = -1;
+    }
+    if (bm->orig_sk)
+        bed_mesh_note_active_flags(bm);
+    return ret;
+}
+
+void __visible
+bed_mesh_set_offsets(struct stepper_kinematics *sk, double x, double y)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    bm->grid.offset_x = x;
+    bm->grid.offset_y = y;
+}
+
+void __visible
+bed_mesh_set_fade(struct stepper_kinematics *sk, double fade_start
+                  , double fade_end, double fade_target)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    bm->fade_start = fade_start;
+    bm->fade_end = fade_end;
+    bm->fade_target = fade_target;
+}
+
+struct stepper_kinematics * __visible
+bed_mesh_alloc(void)
+{
+    struct bed_mesh *bm = malloc(sizeof(*bm));
+    memset(bm, 0, sizeof(*bm));
+    bm->m.move_t = 2. * DUMMY_T;
+    return &bm->sk;
+}
+
+void __visible
+bed_mesh_free(struct stepper_kinematics *sk)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    free(bm->grid.z);
+    free(bm);
+}
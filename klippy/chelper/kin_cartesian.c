@@ -4,87 +4,63 @@
 //
 // This file may be distributed under the terms of the GNU GPLv3 license.
 
+#include <stddef.h> // offsetof
 #include <stdlib.h> // malloc
 #include <string.h> // memset
 #include "compiler.h" // __visible
 #include "itersolve.h" // struct stepper_kinematics
 #include "pyhelper.h" // errorf
-#include "trapq.h" // move_get_coord
+#include "trapq.h" // move_get_axis_coord
 
-static double
-cart_stepper_x_calc_position(struct stepper_kinematics *sk, struct move *m
-                             , double move_time)
-{
-    return move_get_coord(m, move_time).x;
-}
+struct cartesian_stepper {
+    struct stepper_kinematics sk;
+    int axis;
+};
 
 static double
-cart_stepper_y_calc_position(struct stepper_kinematics *sk, struct move *m
-                             , double move_time)
+cart_stepper_calc_position(struct stepper_kinematics *sk, struct move *m
+                           , double move_time)
 {
-    return move_get_coord(m, move_time).y;
+    struct cartesian_stepper *cs = container_of(
+        sk, struct cartesian_stepper, sk);
+    return move_get_axis_coord(m, cs->axis, move_time);
 }
 
 static double
-cart_stepper_z_calc_position(struct stepper_kinematics *sk, struct move *m
-                             , double move_time)
+cart_reverse_stepper_calc_position(struct stepper_kinematics *sk
+                                   , struct move *m, double move_time)
 {
-    return move_get_coord(m, move_time).z;
+    struct cartesian_stepper *cs = container_of(
+        sk, struct cartesian_stepper, sk);
+    return -move_get_axis_coord(m, cs->axis, move_time);
 }
 
-struct stepper_kinematics * __visible
-cartesian_stepper_alloc(char axis)
+// Allocate a stepper following one axis of the trapq (any of 'x', 'y',
+// 'z', 'a', 'b', 'c', 'u', 'v', or 'w')
+static struct stepper_kinematics *
+cart_stepper_alloc(char axis, sk_calc_callback calc_position_cb)
 {
-    struct stepper_kinematics *sk = malloc(sizeof(*sk));
-    memset(sk, 0, sizeof(*sk));
-    if (axis == 'x') {
-        sk->calc_position_cb = cart_stepper_x_calc_position;
-        sk->active_flags = AF_X;
-    } else if (axis == 'y') {
-        sk->calc_position_cb = cart_stepper_y_calc_position;
-        sk->active_flags = AF_Y;
-    } else if (axis == 'z') {
-        sk->calc_position_cb = cart_stepper_z_calc_position;
-        sk->active_flags = AF_Z;
+    int index = trapq_axis_index(axis);
+    if (index < 0) {
+        errorf("Unknown cartesian stepper axis '%c'", axis);
+        return NULL;
     }
-    return sk;
-}
-
-static double
-cart_reverse_stepper_x_calc_position(struct stepper_kinematics *sk
-                             , struct move *m, double move_time)
-{
-    return -move_get_coord(m, move_time).x;
+    struct cartesian_stepper *cs = malloc(sizeof(*cs));
+    memset(cs, 0, sizeof(*cs));
+    cs->axis = index;
+    cs->sk.calc_position_cb = calc_position_cb;
+    cs->sk.active_flags = AF_X << index;
+    return &cs->sk;
 }
 
-static double
-cart_reverse_stepper_y_calc_position(struct stepper_kinematics *sk
-                             , struct move *m, double move_time)
-{
-    return -move_get_coord(m, move_time).y;
-}
-
-static double
-cart_reverse_stepper_z_calc_position(struct stepper_kinematics *sk
-                             , struct move *m, double move_time)
+struct stepper_kinematics * __visible
+cartesian_stepper_alloc(char axis)
 {
-    return -move_get_coord(m, move_time).z;
+    return cart_stepper_alloc(axis, cart_stepper_calc_position);
 }
 
 struct stepper_kinematics * __visible
 cartesian_reverse_stepper_alloc(char axis)
 {
-    struct stepper_kinematics *sk = malloc(sizeof(*sk));
-    memset(sk, 0, sizeof(*sk));
-    if (axis == 'x') {
-        sk->calc_position_cb = cart_reverse_stepper_x_calc_position;
-        sk->active_flags = AF_X;
-    } else if (axis == 'y') {
-        sk->calc_position_cb = cart_reverse_stepper_y_calc_position;
-        sk->active_flags = AF_Y;
-    } else if (axis == 'z') {
-        sk->calc_position_cb = cart_reverse_stepper_z_calc_position;
-        sk->active_flags = AF_Z;
-    }
-    return sk;
+    return cart_stepper_alloc(axis, cart_reverse_stepper_calc_position);
 }
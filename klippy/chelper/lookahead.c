@@ -0,0 +1,91 @@
+// Lookahead junction velocity planning
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include "compiler.h" // __visible
+#include "lookahead.h" // lookahead_flush
+
+static inline double
+min2(double a, double b)
+{
+    return b < a ? b : a;
+}
+
+// Determine the start, cruise, and end velocities (squared) of a
+// queue of moves.  This is a C version of the backward pass in
+// toolhead.py:MoveQueue.flush() and must give identical results.
+// The velocities of each planned move are stored in 'junctions'
+// (moves that could not be planned yet have a negative cruise_v2).
+// Returns the number of moves that are ready to be flushed.
+int __visible
+lookahead_flush(struct lookahead_limits *limits
+                , struct lookahead_junction *junctions
+                , int count, int lazy)
+{
+    int update_flush_count = lazy, flush_count = count, i, j;
+    // Moves waiting on peak_cruise_v2 always form a contiguous range
+    // (delayed_lo to delayed_hi) just after the current move.  Their
+    // start and end limits are stored in the junctions array.
+    int delayed_lo = 0, delayed_hi = -1;
+    double next_end_v2 = 0., next_smoothed_v2 = 0., peak_cruise_v2 = 0.;
+    for (i = 0; i < count; i++)
+        junctions[i].cruise_v2 = -1.;
+    for (i = count - 1; i >= 0; i--) {
+        struct lookahead_limits *l = &limits[i];
+        double reachable_start_v2 = next_end_v2 + l->delta_v2;
+        double start_v2 = min2(l->max_start_v2, reachable_start_v2);
+        double reachable_smoothed_v2 = next_smoothed_v2 + l->smooth_delta_v2;
+        double smoothed_v2 = min2(l->max_smoothed_v2, reachable_smoothed_v2);
+        if (smoothed_v2 < reachable_smoothed_v2) {
+            // It's possible for this move to accelerate
+            int has_delayed = delayed_hi >= delayed_lo;
+            if (smoothed_v2 + l->smooth_delta_v2 > next_smoothed_v2
+                || has_delayed) {
+                // This move can decelerate or this is a full accel
+                // move after a full decel move
+                if (update_flush_count && peak_cruise_v2) {
+                    flush_count = i;
+                    update_flush_count = 0;
+                }
+                peak_cruise_v2 = min2(l->max_cruise_v2, (smoothed_v2
+                                      + reachable_smoothed_v2) * .5);
+                if (has_delayed) {
+                    // Propagate peak_cruise_v2 to any delayed moves
+                    if (!update_flush_count && i < flush_count) {
+                        double mc_v2 = peak_cruise_v2;
+                        for (j = delayed_lo; j <= delayed_hi; j++) {
+                            struct lookahead_junction *d = &junctions[j];
+                            mc_v2 = min2(mc_v2, d->start_v2);
+                            d->start_v2 = min2(d->start_v2, mc_v2);
+                            d->cruise_v2 = mc_v2;
+                            d->end_v2 = min2(d->end_v2, mc_v2);
+                        }
+                    }
+                    delayed_hi = -1;
+                }
+            }
+            if (!update_flush_count && i < flush_count) {
+                struct lookahead_junction *jn = &junctions[i];
+                double cruise_v2 = min2(min2(
+                    (start_v2 + reachable_start_v2) * .5, l->max_cruise_v2)
+                                        , peak_cruise_v2);
+                jn->start_v2 = min2(start_v2, cruise_v2);
+                jn->cruise_v2 = cruise_v2;
+                jn->end_v2 = min2(next_end_v2, cruise_v2);
+            }
+        } else {
+            // Delay calculating this move until peak_cruise_v2 is known
+            struct lookahead_junction *jn = &junctions[i];
+            jn->start_v2 = start_v2;
+            jn->end_v2 = next_end_v2;
+            if (delayed_hi < delayed_lo)
+                delayed_hi = i;
+            delayed_lo = i;
+        }
+        next_end_v2 = start_v2;
+        next_smoothed_v2 = smoothed_v2;
+    }
+    if (update_flush_count)
+        return 0;
+    return flush_count;
+}
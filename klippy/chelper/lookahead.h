@@ -0,0 +1,18 @@
+#ifndef LOOKAHEAD_H
+#define LOOKAHEAD_H
+
+struct lookahead_limits {
+    double max_start_v2, delta_v2;
+    double max_smoothed_v2, smooth_delta_v2;
+    double max_cruise_v2;
+};
+
+struct lookahead_junction {
+    double start_v2, cruise_v2, end_v2;
+};
+
+int lookahead_flush(struct lookahead_limits *limits
+                    , struct lookahead_junction *junctions
+                    , int count, int lazy);
+
+#endif // lookahead.h
@@ -7,6 +7,7 @@
 #include <stddef.h> // offsetof
 #include <stdlib.h> // malloc
 #include <string.h> // memset
+#include "compiler.h" // ARRAY_SIZE
 #include "msgblock.h" // message_alloc
 #include "pyhelper.h" // errorf
 
@@ -77,7 +78,7 @@ encode_int(uint8_t *p, uint32_t v)
     if (sv < (3L<<12) && sv >= -(1L<<12)) goto f3;
     if (sv < (3L<<19) && sv >= -(1L<<19)) goto f2;
     if (sv < (3L<<26) && sv >= -(1L<<26)) goto f1;
-    *p++ = (v>>28) | 0x80;
+    *p++ = ((sv>>28) & 0x7f) | 0x80;
 f1: *p++ = ((v>>21) & 0x7f) | 0x80;
 f2: *p++ = ((v>>14) & 0x7f) | 0x80;
 f3: *p++ = ((v>>7) & 0x7f) | 0x80;
@@ -119,6 +120,109 @@ msgblock_decode(uint32_t *data, int data_len, uint8_t *msg, int msg_len)
 }
 
 
+/****************************************************************
+ * Response decoding
+ ****************************************************************/
+
+// Parameter types of a message format (see msgdecoder_set_format)
+enum {
+    MD_UINT32 = 'u', MD_INT32 = 'i', MD_BUFFER = 's',
+};
+
+struct msgdecoder_format {
+    int param_count;
+    uint8_t types[MESSAGE_PAYLOAD_MAX];
+};
+
+struct msgdecoder {
+    struct msgdecoder_format *formats[128];
+};
+
+// Allocate a 'struct msgdecoder' object
+struct msgdecoder * __visible
+msgdecoder_alloc(void)
+{
+    struct msgdecoder *md = malloc(sizeof(*md));
+    memset(md, 0, sizeof(*md));
+    return md;
+}
+
+// Free a 'struct msgdecoder' object
+void __visible
+msgdecoder_free(struct msgdecoder *md)
+{
+    if (!md)
+        return;
+    int i;
+    for (i=0; i<ARRAY_SIZE(md->formats); i++)
+        free(md->formats[i]);
+    free(md);
+}
+
+// Register the parameter types of a message id.  The 'types' string
+// has one character per parameter: 'u' unsigned, 'i' signed, 's' buffer
+int __visible
+msgdecoder_set_format(struct msgdecoder *md, int msgid, char *types)
+{
+    int count = strlen(types);
+    if (msgid < 0 || msgid >= ARRAY_SIZE(md->formats)
+        || count > MESSAGE_PAYLOAD_MAX)
+        return -1;
+    struct msgdecoder_format *mf = md->formats[msgid];
+    if (!mf) {
+        mf = md->formats[msgid] = malloc(sizeof(*mf));
+        memset(mf, 0, sizeof(*mf));
+    }
+    mf->param_count = count;
+    memcpy(mf->types, types, count);
+    return 0;
+}
+
+// Decode the parameters of a single response message into 'values'.
+// Buffers are returned as (offset << 8 | length) into 'msg'.  Returns
+// the message id, or -1 if the message can not be decoded here.
+int __visible
+msgdecoder_decode(struct msgdecoder *md, uint8_t *msg, int msg_len
+                  , int64_t *values, int max_values)
+{
+    if (msg_len < MESSAGE_MIN || msg_len > MESSAGE_MAX)
+        return -1;
+    uint8_t *p = &msg[MESSAGE_HEADER_SIZE];
+    uint8_t *end = &msg[msg_len - MESSAGE_TRAILER_SIZE];
+    uint8_t msgid = *p++;
+    if (msgid >= ARRAY_SIZE(md->formats) || !md->formats[msgid])
+        return -1;
+    struct msgdecoder_format *mf = md->formats[msgid];
+    if (mf->param_count > max_values)
+        return -1;
+    int i;
+    for (i=0; i<mf->param_count; i++) {
+        if (p >= end)
+            return -1;
+        switch (mf->types[i]) {
+        case MD_BUFFER: {
+            uint8_t len = *p++;
+            if (p + len > end)
+                return -1;
+            values[i] = ((int64_t)(p - msg) << 8) | len;
+            p += len;
+            break;
+        }
+        case MD_INT32:
+            values[i] = (int32_t)parse_int(&p);
+            break;
+        default:
+            values[i] = parse_int(&p);
+            break;
+        }
+    }
+    if (p != end)
+        // Extra data (or a truncated integer) at end of message
+        return -1;
+    return msgid;
+}
+
+
 /****************************************************************
  * Command queues
  ****************************************************************/
@@ -12,6 +12,7 @@
 // clock times, prioritizes commands, and handles retransmissions.  A
 // background thread is launched to do this work and minimize latency.
 
+#define _GNU_SOURCE
 #include <linux/can.h> // // struct can_frame
 #include <math.h> // fabs
 #include <pthread.h> // pthread_mutex_lock
@@ -20,7 +21,9 @@
 #include <stdio.h> // snprintf
 #include <stdlib.h> // malloc
 #include <string.h> // memset
+#include <sys/socket.h> // sendmmsg
 #include <termios.h> // tcflush
+#include <time.h> // clock_gettime
 #include <unistd.h> // pipe
 #include "compiler.h" // __visible
 #include "list.h" // list_add_tail
@@ -42,6 +45,7 @@ struct serialqueue {
     uint8_t input_buf[4096];
     uint8_t need_sync;
     int input_pos;
+    double input_time;
     // Threading
     pthread_t tid;
     pthread_mutex_t lock; // protects variables below
@@ -71,6 +75,9 @@ struct serialqueue {
     struct list_head old_sent, old_receive;
     // Stats
     uint32_t bytes_write, bytes_read, bytes_retransmit, bytes_invalid;
+    uint32_t can_frames_write, can_frames_read;
+    uint64_t can_bits, last_stats_can_bits;
+    double last_stats_time;
 };
 
 #define SQPF_SERIAL 0
@@ -92,6 +99,8 @@ struct serialqueue {
 #define MIN_BACKGROUND_DELTA 0.005
 #define IDLE_QUERY_TIME 1.0
 
+#define CAN_BATCH 32
+
 #define DEBUG_QUEUE_SENT 100
 #define DEBUG_QUEUE_RECEIVE 100
 
@@ -153,6 +162,34 @@ calculate_bittime(struct serialqueue *sq, uint32_t bytes)
     }
 }
 
+// Number of bits a canbus frame with the given payload occupies on the wire
+static uint32_t
+can_frame_bits(uint32_t dlc)
+{
+    return dlc * 8 + CANBUS_PACKET_BITS;
+}
+
+// Convert a kernel receive timestamp (CLOCK_REALTIME) to monotonic time
+static double
+can_receive_time(struct msghdr *mh, double now, double realtime)
+{
+    struct cmsghdr *cmsg;
+    for (cmsg = CMSG_FIRSTHDR(mh); cmsg; cmsg = CMSG_NXTHDR(mh, cmsg)) {
+        if (cmsg->cmsg_level != SOL_SOCKET
+            || cmsg->cmsg_type != SCM_TIMESTAMPNS)
+            continue;
+        struct timespec ts;
+        memcpy(&ts, CMSG_DATA(cmsg), sizeof(ts));
+        double age = realtime - ((double)ts.tv_sec
+                                 + (double)ts.tv_nsec * .000000001);
+        if (age < 0. || age > 1.)
+            // System clock stepped - timestamp not usable
+            break;
+        return now - age;
+    }
+    return now;
+}
+
 // Update internal state when the receive sequence increases
 static void
 update_receive_seq(struct serialqueue *sq, double eventtime, uint64_t rseq)
@@ -267,7 +304,8 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
         struct queue_message *qm = message_fill(sq->input_buf, len);
         qm->sent_time = (rseq > sq->retransmit_seq
                          ? sq->last_receive_sent_time : 0.);
-        qm->receive_time = get_monotonic(); // must be time post read()
+        qm->receive_time = (sq->input_time ? sq->input_time
+                            : get_monotonic()); // must be time post read()
         qm->receive_time -= calculate_bittime(sq, len);
         list_add_tail(&qm->node, &sq->receive_queue);
         must_wake = 1;
@@ -295,35 +333,10 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
     pthread_mutex_unlock(&sq->lock);
 }
 
-// Callback for input activity on the serial fd
+// Process any complete messages in the input buffer
 static void
-input_event(struct serialqueue *sq, double eventtime)
+process_input(struct serialqueue *sq, double eventtime)
 {
-    if (sq->serial_fd_type == SQT_CAN) {
-        struct can_frame cf;
-        int ret = read(sq->serial_fd, &cf, sizeof(cf));
-        if (ret <= 0) {
-            report_errno("can read", ret);
-            pollreactor_do_exit(sq->pr);
-            return;
-        }
-        if (cf.can_id != sq->client_id + 1)
-            return;
-        memcpy(&sq->input_buf[sq->input_pos], cf.data, cf.can_dlc);
-        sq->input_pos += cf.can_dlc;
-    } else {
-        int ret = read(sq->serial_fd, &sq->input_buf[sq->input_pos]
-                       , sizeof(sq->input_buf) - sq->input_pos);
-        if (ret <= 0) {
-            if(ret < 0)
-                report_errno("read", ret);
-            else
-                errorf("Got EOF when reading from device");
-            pollreactor_do_exit(sq->pr);
-            return;
-        }
-        sq->input_pos += ret;
-    }
     for (;;) {
         int len = msgblock_check(&sq->need_sync, sq->input_buf, sq->input_pos);
         if (!len)
@@ -345,6 +358,76 @@ input_event(struct serialqueue *sq, double eventtime)
     }
 }
 
+// Read a batch of frames from a CAN socket
+static void
+can_input_event(struct serialqueue *sq, double eventtime)
+{
+    struct can_frame frames[CAN_BATCH];
+    struct iovec iov[CAN_BATCH];
+    struct mmsghdr msgs[CAN_BATCH];
+    uint8_t control[CAN_BATCH][CMSG_SPACE(sizeof(struct timespec))];
+    memset(msgs, 0, sizeof(msgs));
+    int i;
+    for (i=0; i<CAN_BATCH; i++) {
+        iov[i].iov_base = &frames[i];
+        iov[i].iov_len = sizeof(frames[i]);
+        msgs[i].msg_hdr.msg_iov = &iov[i];
+        msgs[i].msg_hdr.msg_iovlen = 1;
+        msgs[i].msg_hdr.msg_control = control[i];
+        msgs[i].msg_hdr.msg_controllen = sizeof(control[i]);
+    }
+    int count = recvmmsg(sq->serial_fd, msgs, CAN_BATCH, MSG_DONTWAIT, NULL);
+    if (count <= 0) {
+        report_errno("can recvmmsg", count);
+        pollreactor_do_exit(sq->pr);
+        return;
+    }
+    struct timespec rts;
+    clock_gettime(CLOCK_REALTIME, &rts);
+    double realtime = (double)rts.tv_sec + (double)rts.tv_nsec * .000000001;
+    double now = get_monotonic();
+    uint32_t frames_read = 0, bits = 0;
+    for (i=0; i<count; i++) {
+        struct can_frame *cf = &frames[i];
+        if (cf->can_id != sq->client_id + 1 || cf->can_dlc > 8)
+            continue;
+        frames_read++;
+        bits += can_frame_bits(cf->can_dlc);
+        memcpy(&sq->input_buf[sq->input_pos], cf->data, cf->can_dlc);
+        sq->input_pos += cf->can_dlc;
+        // Messages completed by this frame were received at its timestamp
+        sq->input_time = can_receive_time(&msgs[i].msg_hdr, now, realtime);
+        process_input(sq, eventtime);
+    }
+    sq->input_time = 0.;
+    pthread_mutex_lock(&sq->lock);
+    sq->can_frames_read += frames_read;
+    sq->can_bits += bits;
+    pthread_mutex_unlock(&sq->lock);
+}
+
+// Callback for input activity on the serial fd
+static void
+input_event(struct serialqueue *sq, double eventtime)
+{
+    if (sq->serial_fd_type == SQT_CAN) {
+        can_input_event(sq, eventtime);
+        return;
+    }
+    int ret = read(sq->serial_fd, &sq->input_buf[sq->input_pos]
+                   , sizeof(sq->input_buf) - sq->input_pos);
+    if (ret <= 0) {
+        if(ret < 0)
+            report_errno("read", ret);
+        else
+            errorf("Got EOF when reading from device");
+        pollreactor_do_exit(sq->pr);
+        return;
+    }
+    sq->input_pos += ret;
+    process_input(sq, eventtime);
+}
+
 // Callback for input activity on the pipe fd (wakes command_event)
 static void
 kick_event(struct serialqueue *sq, double eventtime)
@@ -366,20 +449,39 @@ do_write(struct serialqueue *sq, void *buf, int buflen)
             report_errno("write", ret);
         return;
     }
-    // Write to CAN fd
-    struct can_frame cf;
+    // Write to CAN fd - queue a batch of frames with each system call
+    struct can_frame frames[CAN_BATCH];
+    struct iovec iov[CAN_BATCH];
+    struct mmsghdr msgs[CAN_BATCH];
+    memset(msgs, 0, sizeof(msgs));
     while (buflen) {
-        int size = buflen > 8 ? 8 : buflen;
-        cf.can_id = sq->client_id;
-        cf.can_dlc = size;
-        memcpy(cf.data, buf, size);
-        int ret = write(sq->serial_fd, &cf, sizeof(cf));
-        if (ret < 0) {
-            report_errno("can write", ret);
-            return;
+        int count = 0;
+        while (buflen && count < CAN_BATCH) {
+            int size = buflen > 8 ? 8 : buflen;
+            struct can_frame *cf = &frames[count];
+            memset(cf, 0, sizeof(*cf));
+            cf->can_id = sq->client_id;
+            cf->can_dlc = size;
+            memcpy(cf->data, buf, size);
+            iov[count].iov_base = cf;
+            iov[count].iov_len = sizeof(*cf);
+            msgs[count].msg_hdr.msg_iov = &iov[count];
+            msgs[count].msg_hdr.msg_iovlen = 1;
+            sq->can_bits += can_frame_bits(size);
+            count++;
+            buf += size;
+            buflen -= size;
+        }
+        int sent = 0;
+        while (sent < count) {
+            int ret = sendmmsg(sq->serial_fd, &msgs[sent], count - sent, 0);
+            if (ret < 0) {
+                report_errno("can sendmmsg", ret);
+                return;
+            }
+            sent += ret;
+            sq->can_frames_write += ret;
         }
-        buf += size;
-        buflen -= size;
     }
 }
 
@@ -635,6 +737,11 @@ serialqueue_alloc(int serial_fd, char serial_fd_type, int client_id)
     pollreactor_add_timer(sq->pr, SQPT_RETRANSMIT, retransmit_event);
     pollreactor_add_timer(sq->pr, SQPT_COMMAND, command_event);
     fd_set_non_blocking(serial_fd);
+    if (serial_fd_type == SQT_CAN) {
+        // Request kernel receive timestamps (used for clock tracking)
+        int on = 1;
+        setsockopt(serial_fd, SOL_SOCKET, SO_TIMESTAMPNS, &on, sizeof(on));
+    }
     fd_set_non_blocking(sq->pipe_fds[0]);
     fd_set_non_blocking(sq->pipe_fds[1]);
 
@@ -827,44 +934,83 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq, uint8_t *msg
     serialqueue_send_one(sq, cq, qm);
 }
 
-// Return a message read from the serial port (or wait for one if none
-// available)
+// Encode and schedule 'count' messages that each consist of 'len'
+// integers in 'data' (the message tag followed by its parameters)
 void __visible
-serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+serialqueue_send_ints(struct serialqueue *sq, struct command_queue *cq
+                      , int64_t *data, int len, int count
+                      , uint64_t min_clock, uint64_t req_clock)
+{
+    if (len > MESSAGE_PAYLOAD_MAX) {
+        errorf("Encode error");
+        return;
+    }
+    struct list_head msgs;
+    list_init(&msgs);
+    uint32_t msg_data[MESSAGE_PAYLOAD_MAX];
+    while (count--) {
+        int i;
+        for (i=0; i<len; i++)
+            msg_data[i] = *data++;
+        struct queue_message *qm = message_alloc_and_encode(msg_data, len);
+        qm->min_clock = min_clock;
+        qm->req_clock = req_clock;
+        list_add_tail(&qm->node, &msgs);
+    }
+    serialqueue_send_batch(sq, cq, &msgs);
+}
+
+// Return up to 'max' messages read from the serial port (or wait for
+// one if none available).  Returns the number of messages, or -1 if
+// the serialqueue is exiting.
+int __visible
+serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *q
+                       , int max)
 {
     pthread_mutex_lock(&sq->lock);
     // Wait for message to be available
     while (list_empty(&sq->receive_queue)) {
-        if (pollreactor_is_exit(sq->pr))
-            goto exit;
+        if (pollreactor_is_exit(sq->pr)) {
+            pthread_mutex_unlock(&sq->lock);
+            return -1;
+        }
         sq->receive_waiting = 1;
         int ret = pthread_cond_wait(&sq->cond, &sq->lock);
         if (ret)
             report_errno("pthread_cond_wait", ret);
     }
 
-    // Remove message from queue
-    struct queue_message *qm = list_first_entry(
-        &sq->receive_queue, struct queue_message, node);
-    list_del(&qm->node);
-
-    // Copy message
-    memcpy(pqm->msg, qm->msg, qm->len);
-    pqm->len = qm->len;
-    pqm->sent_time = qm->sent_time;
-    pqm->receive_time = qm->receive_time;
-    pqm->notify_id = qm->notify_id;
-    if (qm->len)
-        debug_queue_add(&sq->old_receive, qm);
-    else
-        message_free(qm);
+    int count = 0;
+    while (count < max && !list_empty(&sq->receive_queue)) {
+        // Remove message from queue
+        struct queue_message *qm = list_first_entry(
+            &sq->receive_queue, struct queue_message, node);
+        list_del(&qm->node);
 
-    pthread_mutex_unlock(&sq->lock);
-    return;
+        // Copy message
+        struct pull_queue_message *pqm = &q[count++];
+        memcpy(pqm->msg, qm->msg, qm->len);
+        pqm->len = qm->len;
+        pqm->sent_time = qm->sent_time;
+        pqm->receive_time = qm->receive_time;
+        pqm->notify_id = qm->notify_id;
+        if (qm->len)
+            debug_queue_add(&sq->old_receive, qm);
+        else
+            message_free(qm);
+    }
 
-exit:
-    pqm->len = -1;
     pthread_mutex_unlock(&sq->lock);
+    return count;
+}
+
+// Return a message read from the serial port (or wait for one if none
+// available)
+void __visible
+serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+{
+    if (serialqueue_pull_batch(sq, pqm, 1) < 0)
+        pqm->len = -1;
 }
 
 void __visible
@@ -917,11 +1063,14 @@ void __visible
 serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
 {
     struct serialqueue stats;
+    double curtime = get_monotonic();
     pthread_mutex_lock(&sq->lock);
     memcpy(&stats, sq, sizeof(stats));
+    sq->last_stats_time = curtime;
+    sq->last_stats_can_bits = sq->can_bits;
     pthread_mutex_unlock(&sq->lock);
 
-    snprintf(buf, len, "bytes_write=%u bytes_read=%u"
+    int pos = snprintf(buf, len, "bytes_write=%u bytes_read=%u"
              " bytes_retransmit=%u bytes_invalid=%u"
              " send_seq=%u receive_seq=%u retransmit_seq=%u"
              " srtt=%.3f rttvar=%.3f rto=%.3f"
@@ -932,6 +1081,17 @@ serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
              , (int)stats.retransmit_seq
              , stats.srtt, stats.rttvar, stats.rto
              , stats.ready_bytes, stats.upcoming_bytes);
+    if (stats.serial_fd_type != SQT_CAN || pos < 0 || pos >= len)
+        return;
+    // Fraction of the bus time used by this node since the last report
+    double bus_load = 0.;
+    if (stats.last_stats_time && curtime > stats.last_stats_time)
+        bus_load = ((stats.can_bits - stats.last_stats_can_bits)
+                    * stats.bittime_adjust
+                    / (curtime - stats.last_stats_time));
+    snprintf(&buf[pos], len - pos
+             , " can_frames_write=%u can_frames_read=%u can_bus_load=%.3f"
+             , stats.can_frames_write, stats.can_frames_read, bus_load);
 }
 
 // Extract old messages stored in the debug queues
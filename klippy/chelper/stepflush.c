@@ -0,0 +1,182 @@
+// Parallel step generation and flushing for multiple mcus
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <pthread.h> // pthread_create
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "itersolve.h" // itersolve_generate_steps
+#include "pyhelper.h" // report_errno
+#include "stepcompress.h" // steppersync_flush
+#include "stepflush.h" // stepflush_alloc
+#include "trapq.h" // trapq_check_sentinels
+
+// Each mcu has its own steppers and steppersync, so the steps of
+// different mcus can be generated and flushed independently.  The
+// steppers of an mcu are handled on one thread (in the order they were
+// added).  A thread is started for each mcu with steppers, except for
+// the last one which is handled by the calling thread.
+
+struct stepflush_stepper {
+    struct stepper_kinematics *sk;
+    int mcu_index;
+};
+
+struct stepflush_mcu {
+    struct steppersync *ss;
+    struct stepflush *sf;
+    pthread_t tid;
+    int index, stepper_count, started;
+    // Work for the current flush
+    double gen_time;
+    int64_t flush_clock;
+    int32_t result;
+};
+
+struct stepflush {
+    struct stepflush_stepper *steppers;
+    int stepper_count;
+    struct stepflush_mcu *mcus;
+    int mcu_count;
+};
+
+// Allocate a new 'stepflush' object
+struct stepflush * __visible
+stepflush_alloc(void)
+{
+    struct stepflush *sf = malloc(sizeof(*sf));
+    memset(sf, 0, sizeof(*sf));
+    return sf;
+}
+
+// Free memory associated with a 'stepflush' object
+void __visible
+stepflush_free(struct stepflush *sf)
+{
+    if (!sf)
+        return;
+    free(sf->steppers);
+    free(sf->mcus);
+    free(sf);
+}
+
+// Register an mcu (with an optional steppersync), returns its index
+int __visible
+stepflush_add_mcu(struct stepflush *sf, struct steppersync *ss)
+{
+    int index = sf->mcu_count++;
+    sf->mcus = realloc(sf->mcus, sf->mcu_count * sizeof(*sf->mcus));
+    struct stepflush_mcu *sm = &sf->mcus[index];
+    memset(sm, 0, sizeof(*sm));
+    sm->ss = ss;
+    sm->index = index;
+    return index;
+}
+
+// Register a stepper on an mcu, returns the stepper index
+int __visible
+stepflush_add_stepper(struct stepflush *sf, int mcu_index
+                      , struct stepper_kinematics *sk)
+{
+    int index = sf->stepper_count++;
+    sf->steppers = realloc(sf->steppers
+                           , sf->stepper_count * sizeof(*sf->steppers));
+    sf->steppers[index].sk = sk;
+    sf->steppers[index].mcu_index = mcu_index;
+    sf->mcus[mcu_index].stepper_count++;
+    return index;
+}
+
+// Update the stepper_kinematics of a stepper (eg, after input shaping
+// or a manual move replaced it)
+void __visible
+stepflush_set_stepper(struct stepflush *sf, int stepper_index
+                      , struct stepper_kinematics *sk)
+{
+    sf->steppers[stepper_index].sk = sk;
+}
+
+// Generate the steps of an mcu and flush its steppersync
+static void
+flush_mcu(struct stepflush_mcu *sm)
+{
+    struct stepflush *sf = sm->sf;
+    sm->result = 0;
+    int i;
+    for (i=0; i<sf->stepper_count; i++) {
+        struct stepflush_stepper *s = &sf->steppers[i];
+        if (s->mcu_index != sm->index || !s->sk)
+            continue;
+        if (itersolve_generate_steps(s->sk, sm->gen_time)) {
+            sm->result = 1;
+            return;
+        }
+    }
+    if (sm->ss && sm->flush_clock >= 0
+        && steppersync_flush(sm->ss, sm->flush_clock))
+        sm->result = 2;
+}
+
+static void *
+flush_thread(void *data)
+{
+    flush_mcu(data);
+    return NULL;
+}
+
+// Generate steps up to 'gen_time' for all steppers and then flush each
+// mcu up to its entry in 'flush_clocks' (negative to skip).  Each mcu
+// reports 0 (ok), 1 (step generation error) or 2 (flush error) in
+// 'results'.  Returns non-zero if any mcu reported an error.
+int __visible
+stepflush_flush(struct stepflush *sf, double gen_time
+                , int64_t *flush_clocks, int32_t *results)
+{
+    // The trapq sentinels are updated on first use after new moves;
+    // do that here so the threads only read the (shared) trapqs.
+    int i;
+    for (i=0; i<sf->stepper_count; i++) {
+        struct stepper_kinematics *sk = sf->steppers[i].sk;
+        if (sk && sk->tq)
+            trapq_check_sentinels(sk->tq);
+    }
+    // Start a thread for all but the last mcu with steppers
+    struct stepflush_mcu *last = NULL;
+    for (i=0; i<sf->mcu_count; i++) {
+        struct stepflush_mcu *sm = &sf->mcus[i];
+        sm->sf = sf;
+        sm->gen_time = gen_time;
+        sm->flush_clock = flush_clocks[i];
+        sm->started = 0;
+        if (!sm->stepper_count) {
+            flush_mcu(sm);
+            continue;
+        }
+        if (last) {
+            int ret = pthread_create(&last->tid, NULL, flush_thread, last);
+            if (ret) {
+                report_errno("pthread_create", ret);
+                flush_mcu(last);
+            } else {
+                last->started = 1;
+            }
+        }
+        last = sm;
+    }
+    if (last)
+        flush_mcu(last);
+    // Wait for the threads to complete
+    int res = 0;
+    for (i=0; i<sf->mcu_count; i++) {
+        struct stepflush_mcu *sm = &sf->mcus[i];
+        if (sm->started) {
+            int ret = pthread_join(sm->tid, NULL);
+            if (ret)
+                report_errno("pthread_join", ret);
+        }
+        results[i] = sm->result;
+        res |= sm->result;
+    }
+    return res;
+}
@@ -0,0 +1,19 @@
+#ifndef STEPFLUSH_H
+#define STEPFLUSH_H
+
+#include <stdint.h> // int64_t
+
+struct steppersync;
+struct stepper_kinematics;
+
+struct stepflush *stepflush_alloc(void);
+void stepflush_free(struct stepflush *sf);
+int stepflush_add_mcu(struct stepflush *sf, struct steppersync *ss);
+int stepflush_add_stepper(struct stepflush *sf, int mcu_index
+                          , struct stepper_kinematics *sk);
+void stepflush_set_stepper(struct stepflush *sf, int stepper_index
+                           , struct stepper_kinematics *sk);
+int stepflush_flush(struct stepflush *sf, double gen_time
+                    , int64_t *flush_clocks, int32_t *results);
+
+#endif // stepflush.h
@@ -27,15 +27,53 @@ move_get_distance(struct move *m, double move_time)
     return (m->start_v + m->half_accel * move_time) * move_time;
 }
 
-// Return the XYZ coordinates given a time in a move
+// Return the XYZ coordinates given a time in a move (the other axes
+// are left at zero, see move_get_coord_all)
 inline struct coord
 move_get_coord(struct move *m, double move_time)
 {
     double move_dist = move_get_distance(m, move_time);
-    return (struct coord) {
+    struct coord c = {
         .x = m->start_pos.x + m->axes_r.x * move_dist,
         .y = m->start_pos.y + m->axes_r.y * move_dist,
         .z = m->start_pos.z + m->axes_r.z * move_dist };
+    if (unlikely(m->arc_radius)) {
+        double angle = m->arc_angle + m->arc_angle_r * move_dist;
+        if (m->arc_axis0 < 3)
+            c.axis[m->arc_axis0] += m->arc_radius * cos(angle);
+        if (m->arc_axis1 < 3)
+            c.axis[m->arc_axis1] += m->arc_radius * sin(angle);
+    }
+    return c;
+}
+
+// Return the coordinates of all axes given a time in a move
+struct coord
+move_get_coord_all(struct move *m, double move_time)
+{
+    double move_dist = move_get_distance(m, move_time);
+    struct coord c;
+    int i;
+    for (i = 0; i < TRAPQ_MAX_AXES; i++)
+        c.axis[i] = m->start_pos.axis[i] + m->axes_r.axis[i] * move_dist;
+    if (unlikely(m->arc_radius)) {
+        double angle = m->arc_angle + m->arc_angle_r * move_dist;
+        c.axis[m->arc_axis0] += m->arc_radius * cos(angle);
+        c.axis[m->arc_axis1] += m->arc_radius * sin(angle);
+    }
+    return c;
+}
+
+// Return the coordinate index of an axis name ('x', 'y', ..., 'w')
+int
+trapq_axis_index(char axis)
+{
+    static const char axis_names[] = "xyzabcuvw";
+    int i;
+    for (i = 0; i < TRAPQ_MAX_AXES; i++)
+        if (axis_names[i] == axis)
+            return i;
+    return -1;
 }
 
 #define NEVER_TIME 9999999999999999.9
@@ -88,7 +126,7 @@ trapq_check_sentinels(struct trapq *tq)
         return;
     }
     tail_sentinel->print_time = m->print_time + m->move_t;
-    tail_sentinel->start_pos = move_get_coord(m, m->move_t);
+    tail_sentinel->start_pos = move_get_coord_all(m, m->move_t);
 }
 
 #define MAX_NULL_MOVE 1.0
@@ -102,7 +140,7 @@ trapq_add_move(struct trapq *tq, struct move *m)
     if (prev->print_time + prev->move_t < m->print_time) {
         // Add a null move to fill time gap
         struct move *null_move = move_alloc();
-        null_move->start_pos = m->start_pos;
+        null_move->start_pos = move_get_coord_all(m, 0.);
         if (!prev->print_time && m->print_time > MAX_NULL_MOVE)
             // Limit the first null move to improve numerical stability
             null_move->print_time = m->print_time - MAX_NULL_MOVE;
@@ -115,7 +153,71 @@ trapq_add_move(struct trapq *tq, struct move *m)
     tail_sentinel->print_time = 0.;
 }
 
+// Allocate a move with the geometry of 'path' and add it to the queue
+static struct move *
+trapq_add_path(struct trapq *tq, struct move *path, double print_time
+               , double move_t, double start_v, double accel)
+{
+    struct move *m = move_alloc();
+    *m = *path;
+    m->print_time = print_time;
+    m->move_t = move_t;
+    m->start_v = start_v;
+    m->half_accel = .5 * accel;
+    trapq_add_move(tq, m);
+    return m;
+}
+
+// Advance the start of 'path' by the distance covered by move 'm'
+static void
+trapq_advance_path(struct move *path, struct move *m)
+{
+    double move_dist = move_get_distance(m, m->move_t);
+    int i;
+    for (i = 0; i < TRAPQ_MAX_AXES; i++)
+        path->start_pos.axis[i] += path->axes_r.axis[i] * move_dist;
+    path->arc_angle += path->arc_angle_r * move_dist;
+}
+
+// Split a move into its accel, cruise and decel parts and queue them
+static void
+trapq_append_path(struct trapq *tq, double print_time
+                  , double accel_t, double cruise_t, double decel_t
+                  , struct move *path
+                  , double start_v, double cruise_v, double accel)
+{
+    if (accel_t) {
+        struct move *m = trapq_add_path(tq, path, print_time, accel_t
+                                        , start_v, accel);
+        print_time += accel_t;
+        trapq_advance_path(path, m);
+    }
+    if (cruise_t) {
+        struct move *m = trapq_add_path(tq, path, print_time, cruise_t
+                                        , cruise_v, 0.);
+        print_time += cruise_t;
+        trapq_advance_path(path, m);
+    }
+    if (decel_t)
+        trapq_add_path(tq, path, print_time, decel_t, cruise_v, -accel);
+}
+
 // Fill and add a move to the trapezoid velocity queue
+static void
+trapq_append_coord(struct trapq *tq, double print_time
+                   , double accel_t, double cruise_t, double decel_t
+                   , struct coord start_pos, struct coord axes_r
+                   , double start_v, double cruise_v, double accel)
+{
+    struct move path;
+    memset(&path, 0, sizeof(path));
+    path.start_pos = start_pos;
+    path.axes_r = axes_r;
+    trapq_append_path(tq, print_time, accel_t, cruise_t, decel_t
+                      , &path, start_v, cruise_v, accel);
+}
+
+// Add an XYZ move to the trapezoid velocity queue
 void __visible
 trapq_append(struct trapq *tq, double print_time
              , double accel_t, double cruise_t, double decel_t
@@ -125,42 +227,97 @@ trapq_append(struct trapq *tq, double print_time
 {
     struct coord start_pos = { .x=start_pos_x, .y=start_pos_y, .z=start_pos_z };
     struct coord axes_r = { .x=axes_r_x, .y=axes_r_y, .z=axes_r_z };
-    if (accel_t) {
-        struct move *m = move_alloc();
-        m->print_time = print_time;
-        m->move_t = accel_t;
-        m->start_v = start_v;
-        m->half_accel = .5 * accel;
-        m->start_pos = start_pos;
-        m->axes_r = axes_r;
-        trapq_add_move(tq, m);
+    trapq_append_coord(tq, print_time, accel_t, cruise_t, decel_t
+                       , start_pos, axes_r, start_v, cruise_v, accel);
+}
 
-        print_time += accel_t;
-        start_pos = move_get_coord(m, accel_t);
+// Add a move with up to TRAPQ_MAX_AXES coordinates to the queue
+void __visible
+trapq_append_axes(struct trapq *tq, double print_time
+                  , double accel_t, double cruise_t, double decel_t
+                  , double *start_pos, double *axes_r, int axis_count
+                  , double start_v, double cruise_v, double accel)
+{
+    struct coord sp, ar;
+    memset(&sp, 0, sizeof(sp));
+    memset(&ar, 0, sizeof(ar));
+    if (axis_count > TRAPQ_MAX_AXES)
+        axis_count = TRAPQ_MAX_AXES;
+    memcpy(sp.axis, start_pos, axis_count * sizeof(sp.axis[0]));
+    memcpy(ar.axis, axes_r, axis_count * sizeof(ar.axis[0]));
+    trapq_append_coord(tq, print_time, accel_t, cruise_t, decel_t
+                       , sp, ar, start_v, cruise_v, accel);
+}
+
+// Add a circular (or helical) move to the queue.  Axes 'axis0' and
+// 'axis1' follow a circle of 'radius' around their start_pos
+// coordinates, starting at 'angle' and turning 'angle_r' radians per
+// mm of move distance.  All other axes move linearly using axes_r.
+void __visible
+trapq_append_arc(struct trapq *tq, double print_time
+                 , double accel_t, double cruise_t, double decel_t
+                 , double *start_pos, double *axes_r, int axis_count
+                 , double start_v, double cruise_v, double accel
+                 , int axis0, int axis1, double radius, double angle
+                 , double angle_r)
+{
+    struct move path;
+    memset(&path, 0, sizeof(path));
+    if (axis_count > TRAPQ_MAX_AXES)
+        axis_count = TRAPQ_MAX_AXES;
+    memcpy(path.start_pos.axis, start_pos
+           , axis_count * sizeof(path.start_pos.axis[0]));
+    memcpy(path.axes_r.axis, axes_r, axis_count * sizeof(path.axes_r.axis[0]));
+    if (axis0 >= 0 && axis0 < TRAPQ_MAX_AXES
+        && axis1 >= 0 && axis1 < TRAPQ_MAX_AXES) {
+        path.arc_axis0 = axis0;
+        path.arc_axis1 = axis1;
+        path.arc_radius = radius;
+        path.arc_angle = angle;
+        path.arc_angle_r = angle_r;
     }
-    if (cruise_t) {
-        struct move *m = move_alloc();
-        m->print_time = print_time;
-        m->move_t = cruise_t;
-        m->start_v = cruise_v;
-        m->half_accel = 0.;
-        m->start_pos = start_pos;
-        m->axes_r = axes_r;
-        trapq_add_move(tq, m);
+    trapq_append_path(tq, print_time, accel_t, cruise_t, decel_t
+                      , &path, start_v, cruise_v, accel);
+}
 
-        print_time += cruise_t;
-        start_pos = move_get_coord(m, cruise_t);
+// Append a list of moves to several trapqs (one per kinematic group)
+// in a single call.  Each move in 'data' is stored as:
+//   print_time, accel_t, cruise_t, decel_t, start_v, cruise_v, accel,
+//   start_pos[axis_count * tq_count], axes_r[axis_count * tq_count]
+// where the coordinates of trapq 'i' are at offset axis_count * i.
+void __visible
+trapq_append_multi(struct trapq **tqs, int tq_count, int axis_count
+                   , double *data, int move_count)
+{
+    int coords = axis_count * tq_count, i, j;
+    int stride = TRAPQ_MULTI_FIELDS + 2 * coords;
+    for (i = 0; i < move_count; i++, data += stride) {
+        double *start_pos = &data[TRAPQ_MULTI_FIELDS];
+        double *axes_r = &start_pos[coords];
+        for (j = 0; j < tq_count; j++) {
+            trapq_append_axes(tqs[j], data[0], data[1], data[2], data[3]
+                              , start_pos, axes_r, axis_count
+                              , data[4], data[5], data[6]);
+            start_pos += axis_count;
+            axes_r += axis_count;
+        }
     }
-    if (decel_t) {
-        struct move *m = move_alloc();
-        m->print_time = print_time;
-        m->move_t = decel_t;
-        m->start_v = cruise_v;
-        m->half_accel = -.5 * accel;
-        m->start_pos = start_pos;
-        m->axes_r = axes_r;
-        trapq_add_move(tq, m);
+}
+
+// Extend a trailing constant velocity move so that it ends at `end_time`
+int __visible
+trapq_extend(struct trapq *tq, double end_time)
+{
+    struct move *tail_sentinel = list_last_entry(&tq->moves, struct move, node);
+    struct move *m = list_prev_entry(tail_sentinel, node);
+    struct move *head_sentinel = list_first_entry(&tq->moves, struct move,node);
+    if (m == head_sentinel || m->half_accel || m->arc_radius || !m->start_v)
+        return -1;
+    if (m->print_time + m->move_t < end_time) {
+        m->move_t = end_time - m->print_time;
+        tail_sentinel->print_time = 0.;
     }
+    return 0;
 }
 
 #define HISTORY_EXPIRE (30.0)
@@ -200,10 +357,19 @@ trapq_finalize_moves(struct trapq *tq, double print_time)
     }
 }
 
-// Note a position change in the trapq history
+// Expire moves older than `print_time` from several trapqs
 void __visible
-trapq_set_position(struct trapq *tq, double print_time
-                   , double pos_x, double pos_y, double pos_z)
+trapq_finalize_moves_multi(struct trapq **tqs, int tq_count, double print_time)
+{
+    int i;
+    for (i = 0; i < tq_count; i++)
+        trapq_finalize_moves(tqs[i], print_time);
+}
+
+// Note a position change in the trapq history
+static void
+trapq_set_position_coord(struct trapq *tq, double print_time
+                         , struct coord pos)
 {
     // Flush all moves from trapq
     trapq_finalize_moves(tq, NEVER_TIME);
@@ -223,12 +389,30 @@ trapq_set_position(struct trapq *tq, double print_time
     // Add a marker to the trapq history
     struct move *m = move_alloc();
     m->print_time = print_time;
-    m->start_pos.x = pos_x;
-    m->start_pos.y = pos_y;
-    m->start_pos.z = pos_z;
+    m->start_pos = pos;
     list_add_head(&m->node, &tq->history);
 }
 
+void __visible
+trapq_set_position(struct trapq *tq, double print_time
+                   , double pos_x, double pos_y, double pos_z)
+{
+    struct coord pos = { .x=pos_x, .y=pos_y, .z=pos_z };
+    trapq_set_position_coord(tq, print_time, pos);
+}
+
+void __visible
+trapq_set_position_axes(struct trapq *tq, double print_time
+                        , double *pos, int axis_count)
+{
+    struct coord c;
+    memset(&c, 0, sizeof(c));
+    if (axis_count > TRAPQ_MAX_AXES)
+        axis_count = TRAPQ_MAX_AXES;
+    memcpy(c.axis, pos, axis_count * sizeof(c.axis[0]));
+    trapq_set_position_coord(tq, print_time, c);
+}
+
 // Return history of movement queue
 int __visible
 trapq_extract_old(struct trapq *tq, struct pull_move *p, int max
@@ -245,12 +429,19 @@ trapq_extract_old(struct trapq *tq, struct pull_move *p, int max
         p->move_t = m->move_t;
         p->start_v = m->start_v;
         p->accel = 2. * m->half_accel;
-        p->start_x = m->start_pos.x;
-        p->start_y = m->start_pos.y;
-        p->start_z = m->start_pos.z;
+        // Arcs are reported with their start position (the circular
+        // part of the motion is not described by axes_r)
+        struct coord start_pos = m->start_pos;
+        if (m->arc_radius)
+            start_pos = move_get_coord_all(m, 0.);
+        p->start_x = start_pos.x;
+        p->start_y = start_pos.y;
+        p->start_z = start_pos.z;
         p->x_r = m->axes_r.x;
         p->y_r = m->axes_r.y;
         p->z_r = m->axes_r.z;
+        memcpy(p->start_pos, start_pos.axis, sizeof(p->start_pos));
+        memcpy(p->axes_r, m->axes_r.axis, sizeof(p->axes_r));
         p++;
         res++;
     }
@@ -1,14 +1,19 @@
 #ifndef TRAPQ_H
 #define TRAPQ_H
 
+#include <math.h> // cos
+#include "compiler.h" // unlikely
 #include "list.h" // list_node
 
+// Maximum number of coordinates carried by each move (XYZABCUVW)
+#define TRAPQ_MAX_AXES 9
+
 struct coord {
     union {
         struct {
-            double x, y, z;
+            double x, y, z, a, b, c, u, v, w;
         };
-        double axis[3];
+        double axis[TRAPQ_MAX_AXES];
     };
 };
 
@@ -16,6 +21,9 @@ struct move {
     double print_time, move_t;
     double start_v, half_accel;
     struct coord start_pos, axes_r;
+    // Circular motion of two axes around start_pos (see trapq_append_arc)
+    int arc_axis0, arc_axis1;
+    double arc_radius, arc_angle, arc_angle_r;
 
     struct list_node node;
 };
@@ -24,16 +32,22 @@ struct trapq {
     struct list_head moves, history;
 };
 
+// Number of per-move values preceding the coordinates in trapq_append_multi()
+#define TRAPQ_MULTI_FIELDS 7
+
 struct pull_move {
     double print_time, move_t;
     double start_v, accel;
     double start_x, start_y, start_z;
     double x_r, y_r, z_r;
+    double start_pos[TRAPQ_MAX_AXES], axes_r[TRAPQ_MAX_AXES];
 };
 
 struct move *move_alloc(void);
 double move_get_distance(struct move *m, double move_time);
 struct coord move_get_coord(struct move *m, double move_time);
+struct coord move_get_coord_all(struct move *m, double move_time);
+int trapq_axis_index(char axis);
 struct trapq *trapq_alloc(void);
 void trapq_free(struct trapq *tq);
 void trapq_check_sentinels(struct trapq *tq);
@@ -43,10 +57,50 @@ void trapq_append(struct trapq *tq, double print_time
                   , double start_pos_x, double start_pos_y, double start_pos_z
                   , double axes_r_x, double axes_r_y, double axes_r_z
                   , double start_v, double cruise_v, double accel);
+void trapq_append_axes(struct trapq *tq, double print_time
+                       , double accel_t, double cruise_t, double decel_t
+                       , double *start_pos, double *axes_r, int axis_count
+                       , double start_v, double cruise_v, double accel);
+void trapq_append_arc(struct trapq *tq, double print_time
+                      , double accel_t, double cruise_t, double decel_t
+                      , double *start_pos, double *axes_r, int axis_count
+                      , double start_v, double cruise_v, double accel
+                      , int axis0, int axis1, double radius, double angle
+                      , double angle_r);
+void trapq_append_multi(struct trapq **tqs, int tq_count, int axis_count
+                        , double *data, int move_count);
+int trapq_extend(struct trapq *tq, double end_time);
 void trapq_finalize_moves(struct trapq *tq, double print_time);
+void trapq_finalize_moves_multi(struct trapq **tqs, int tq_count
+                                , double print_time);
 void trapq_set_position(struct trapq *tq, double print_time
                         , double pos_x, double pos_y, double pos_z);
+void trapq_set_position_axes(struct trapq *tq, double print_time
+                             , double *pos, int axis_count);
 int trapq_extract_old(struct trapq *tq, struct pull_move *p, int max
                       , double start_time, double end_time);
 
+// Return the offset of an arc axis from the arc center
+static inline double
+move_get_arc_offset(struct move *m, int axis, double move_dist)
+{
+    double angle = m->arc_angle + m->arc_angle_r * move_dist;
+    if (axis == m->arc_axis0)
+        return m->arc_radius * cos(angle);
+    if (axis == m->arc_axis1)
+        return m->arc_radius * sin(angle);
+    return 0.;
+}
+
+// Return the coordinate of a single axis given a time in a move
+static inline double
+move_get_axis_coord(struct move *m, int axis, double move_time)
+{
+    double move_dist = (m->start_v + m->half_accel * move_time) * move_time;
+    double pos = m->start_pos.axis[axis] + m->axes_r.axis[axis] * move_dist;
+    if (unlikely(m->arc_radius))
+        pos += move_get_arc_offset(m, axis, move_dist);
+    return pos;
+}
+
 #endif // trapq.h
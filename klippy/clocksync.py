@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, math
+import logging, math, collections
 
 """ Notes on 'Multiple micro-controllers': https://www.klipper3d.org/Code_Overview.html#time
 
@@ -20,10 +20,17 @@ measured drift.
 RTT_AGE = .000010 / (60. * 60.)
 DECAY = 1. / 30.
 TRANSMIT_EXTRA = .001
+# Windowed regression ("clock_estimator: window")
+WINDOW_SAMPLES = 64
+WINDOW_RTT_SLACK = .000100
+WINDOW_FREQ_PRIOR = .000100
+WINDOW_MIN_JITTER = .000025
+WINDOW_RESET_TIME = 10.
 
 class ClockSync:
-    def __init__(self, reactor):
+    def __init__(self, reactor, estimator='decay'):
         self.reactor = reactor
+        self.estimator = estimator
         self.serial = None
         self.get_clock_timer = reactor.register_timer(self._get_clock_event)
         self.get_clock_cmd = self.cmd_queue = None
@@ -39,16 +46,15 @@ class ClockSync:
         self.clock_avg = self.clock_covariance = 0.
         self.prediction_variance = 0.
         self.last_prediction_time = 0.
+        # Recent (sent_time, half_rtt, clock) samples of the window estimator
+        self.samples = collections.deque(maxlen=WINDOW_SAMPLES)
     def connect(self, serial):
         self.serial = serial
         self.mcu_freq = serial.msgparser.get_constant_float('CLOCK_FREQ')
         # Load initial clock and frequency
         params = serial.send_with_response('get_uptime', 'uptime')
-        self.last_clock = (params['high'] << 32) | params['clock']
-        self.clock_avg = self.last_clock
-        self.time_avg = params['#sent_time']
-        self.clock_est = (self.time_avg, self.clock_avg, self.mcu_freq)
-        self.prediction_variance = (.001 * self.mcu_freq)**2
+        self.reset_estimate(params['#sent_time'],
+                            (params['high'] << 32) | params['clock'])
         # Enable periodic get_clock timer
         for i in range(8):
             self.reactor.pause(self.reactor.monotonic() + 0.050)
@@ -67,6 +73,13 @@ class ClockSync:
         if pace:
             freq = self.mcu_freq
         serial.set_clock_est(freq, self.reactor.monotonic(), 0, 0)
+    def reset_estimate(self, sent_time, clock):
+        # Start a new estimate from a single clock sample
+        self.last_clock = self.clock_avg = clock
+        self.time_avg = sent_time
+        self.clock_est = (self.time_avg, self.clock_avg, self.mcu_freq)
+        self.prediction_variance = (.001 * self.mcu_freq)**2
+        self.samples.clear()
     # MCU clock querying (_handle_clock is invoked from background thread)
     def _get_clock_event(self, eventtime):
         self.serial.raw_send(self.get_clock_cmd, 0, 0, self.cmd_queue)
@@ -94,6 +107,14 @@ class ClockSync:
             self.min_rtt_time = sent_time
             logging.debug("new minimum rtt %.3f: hrtt=%.6f freq=%d",
                           sent_time, half_rtt, self.clock_est[2])
+        # NOTE: These lines may be replayed with scripts/clocksync_replay.py
+        logging.debug("%sclock sample sent=%.6f receive=%.6f clock=%d",
+                      self.serial.warn_prefix, sent_time, receive_time, clock)
+        if self.estimator == 'window':
+            self._update_window(sent_time, half_rtt, clock)
+        else:
+            self._update_decay(sent_time, clock)
+    def _update_decay(self, sent_time, clock):
         # Filter out samples that are extreme outliers
         exp_clock = ((sent_time - self.time_avg) * self.clock_est[2]
                      + self.clock_avg)
@@ -133,6 +154,70 @@ class ClockSync:
                           self.clock_avg, new_freq)
         #logging.debug("regr %.3f: freq=%.3f d=%d(%.3f)",
         #              sent_time, new_freq, clock - exp_clock, pred_stddev)
+    def _fit_window(self, samples):
+        # Least squares fit of clock over sent_time.  The frequency is
+        # weighted towards the nominal CLOCK_FREQ (within the expected
+        # crystal accuracy), which keeps the short spans just after
+        # connecting from amplifying the sample jitter.
+        count = len(samples)
+        time_avg = sum([s[0] for s in samples]) / count
+        clock_avg = sum([s[2] for s in samples]) / count
+        time_variance = sum([(s[0] - time_avg)**2 for s in samples])
+        covariance = sum([(s[0] - time_avg) * (s[2] - clock_avg)
+                          for s in samples])
+        clock_variance = (WINDOW_MIN_JITTER * self.mcu_freq)**2
+        if count >= 8:
+            freq = covariance / time_variance
+            variance = sum([(s[2] - clock_avg - (s[0] - time_avg) * freq)**2
+                            for s in samples]) / (count - 2)
+            clock_variance = max(clock_variance, variance)
+        prior = clock_variance / (WINDOW_FREQ_PRIOR * self.mcu_freq)**2
+        freq = (covariance + prior * self.mcu_freq) / (time_variance + prior)
+        residuals = [s[2] - clock_avg - (s[0] - time_avg) * freq
+                     for s in samples]
+        variance = sum([r**2 for r in residuals]) / max(1, count - 2)
+        return (time_avg, clock_avg, freq, variance, residuals,
+                time_variance / count, covariance / count)
+    def _update_window(self, sent_time, half_rtt, clock):
+        samples = self.samples
+        samples.append((sent_time, half_rtt, clock))
+        # Samples with a long round-trip-time have an uncertain timing,
+        # only use those close to the fastest in the window
+        rtts = sorted([s[1] for s in samples])
+        rtt_limit = rtts[0] + max(WINDOW_RTT_SLACK,
+                                  2. * (rtts[len(rtts) // 2] - rtts[0]))
+        good = [s for s in samples if s[1] <= rtt_limit]
+        fit = self._fit_window(good)
+        # Drop clock outliers and fit again
+        min_outlier2 = (.000500 * self.mcu_freq)**2
+        limit2 = max(25. * fit[3], min_outlier2)
+        inliers = [s for s, res in zip(good, fit[4]) if res**2 <= limit2]
+        if len(inliers) >= 2 and len(inliers) < len(good):
+            good = inliers
+            fit = self._fit_window(good)
+        if good[-1] is not samples[-1]:
+            if sent_time > self.last_prediction_time + WINDOW_RESET_TIME:
+                # No sample accepted for a while - restart the window
+                logging.info("Resetting clock window %.3f: freq=%d",
+                             sent_time, self.clock_est[2])
+                samples.clear()
+                samples.append((sent_time, half_rtt, clock))
+                good = list(samples)
+                fit = self._fit_window(good)
+                self.last_prediction_time = sent_time
+        else:
+            self.last_prediction_time = sent_time
+        time_avg, clock_avg, new_freq, variance = fit[:4]
+        self.time_variance, self.clock_covariance = fit[5:]
+        # Report the fitted line at the latest accepted sample
+        self.time_avg = good[-1][0]
+        self.clock_avg = clock_avg + (self.time_avg - time_avg) * new_freq
+        self.prediction_variance = variance
+        pred_stddev = math.sqrt(self.prediction_variance)
+        self.serial.set_clock_est(new_freq, self.time_avg + TRANSMIT_EXTRA,
+                                  int(self.clock_avg - 3. * pred_stddev), clock)
+        self.clock_est = (self.time_avg + self.min_half_rtt,
+                          self.clock_avg, new_freq)
     # clock frequency conversions
     def print_time_to_clock(self, print_time):
         return int(print_time * self.mcu_freq)
@@ -186,8 +271,8 @@ class ClockSync:
 # Clock syncing code for secondary MCUs (whose clocks are sync'ed to a
 # primary MCU)
 class SecondarySync(ClockSync):
-    def __init__(self, reactor, main_sync):
-        ClockSync.__init__(self, reactor)
+    def __init__(self, reactor, main_sync, estimator='decay'):
+        ClockSync.__init__(self, reactor, estimator)
         self.main_sync = main_sync
         self.clock_adj = (0., 1.)
         self.last_sync_time = 0.
@@ -3,7 +3,7 @@
 # Copyright (C) 2021,2022  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, math, threading
+import logging, math
 from . import bus, motion_report
 
 MIN_MSG_TIME = 0.100
@@ -417,9 +417,6 @@ class Angle:
         # Measurement conversion
         self.start_clock = self.time_shift = self.sample_ticks = 0
         self.last_sequence = self.last_angle = 0
-        # Measurement storage (accessed from background thread)
-        self.lock = threading.Lock()
-        self.raw_samples = []
         # Sensor type
         sensors = { "a1333": HelperA1333, "as5047d": HelperAS5047D,
                     "tle5012b": HelperTLE5012B }
@@ -439,8 +436,8 @@ class Angle:
             "query_spi_angle oid=%d clock=0 rest_ticks=0 time_shift=0"
             % (oid,), on_restart=True)
         mcu.register_config_callback(self._build_config)
-        mcu.register_response(self._handle_spi_angle_data,
-                              "spi_angle_data", oid)
+        # Measurement storage (filled from background thread)
+        self.bulk_buffer = mcu.register_bulk_response("spi_angle_data", oid)
         # API server endpoints
         self.api_dump = motion_report.APIDumpHelper(
             self.printer, self._api_update, self._api_startstop, 0.100)
@@ -464,9 +461,6 @@ class Angle:
     # Measurement collection
     def is_measuring(self):
         return self.start_clock != 0
-    def _handle_spi_angle_data(self, params):
-        with self.lock:
-            self.raw_samples.append(params)
     def _extract_samples(self, raw_samples):
         # Load variables to optimize inner loop below
         sample_ticks = self.sample_ticks
@@ -488,12 +482,11 @@ class Angle:
         # Process every message in raw_samples
         count = error_count = 0
         samples = [None] * (len(raw_samples) * 16)
-        for params in raw_samples:
-            seq = (last_sequence & ~0xffff) | params['sequence']
+        for sequence, d in raw_samples:
+            seq = (last_sequence & ~0xffff) | sequence
             if seq < last_sequence:
                 seq += 0x10000
             last_sequence = seq
-            d = bytearray(params['data'])
             msg_mclock = start_clock + seq*16*sample_ticks
             for i in range(len(d) // 3):
                 tcode = d[i*3]
@@ -526,9 +519,7 @@ class Angle:
     def _api_update(self, eventtime):
         if self.sensor_helper.is_tcode_absolute:
             self.sensor_helper.update_clock()
-        with self.lock:
-            raw_samples = self.raw_samples
-            self.raw_samples = []
+        raw_samples = self.bulk_buffer.pull()
         if not raw_samples:
             return {}
         samples, error_count = self._extract_samples(raw_samples)
@@ -543,8 +534,7 @@ class Angle:
         logging.info("Starting angle '%s' measurements", self.name)
         self.sensor_helper.start()
         # Start bulk reading
-        with self.lock:
-            self.raw_samples = []
+        self.bulk_buffer.clear()
         self.last_sequence = 0
         systime = self.printer.get_reactor().monotonic()
         print_time = self.mcu.estimated_print_time(systime) + MIN_MSG_TIME
@@ -559,8 +549,7 @@ class Angle:
         # Halt bulk reading
         params = self.query_spi_angle_end_cmd.send([self.oid, 0, 0, 0])
         self.start_clock = 0
-        with self.lock:
-            self.raw_samples = []
+        self.bulk_buffer.clear()
         self.sensor_helper.last_temperature = None
         logging.info("Stopped angle '%s' measurements", self.name)
     def _api_startstop(self, is_start):
@@ -4,7 +4,8 @@
 # Copyright (C) 2018-2019 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, math, json, collections
+import logging, math, json, collections, importlib
+import chelper
 from . import probe
 
 PROFILE_VERSION = 1
@@ -35,6 +36,19 @@ def constrain(val, min_val, max_val):
 def lerp(t, v0, v1):
     return (1. - t) * v0 + t * v1
 
+# NumPy is optional, it is used to interpolate large meshes when
+# available. It is imported on first use to keep it out of startup.
+NUMPY_MIN_POINTS = 2500
+numpy = None
+def load_numpy():
+    global numpy
+    if numpy is None:
+        try:
+            numpy = importlib.import_module('numpy')
+        except ImportError:
+            numpy = False
+    return numpy
+
 # retreive commma separated pair from config
 def parse_config_pair(config, option, default, minval=None, maxval=None):
     pair = config.getintlist(option, (default, default))
@@ -105,6 +119,16 @@ class BedMesh:
         self.fade_target = 0.
         self.gcode = self.printer.lookup_object('gcode')
         self.splitter = MoveSplitter(config, self.gcode)
+        # With "stepper" compensation the mesh is applied during step
+        # generation of the z steppers, and moves are not split
+        modes = {'split': 'split', 'stepper': 'stepper'}
+        self.stepper_mesh = None
+        if config.getchoice('compensation_mode', modes, 'split') == 'stepper':
+            self.stepper_mesh = StepperMesh(self.printer)
+            self.printer.register_event_handler(
+                "homing:home_rails_begin", self._handle_home_rails_begin)
+            self.printer.register_event_handler(
+                "homing:homing_move_begin", self._handle_homing_move_begin)
         # setup persistent storage
         self.pmgr = ProfileManager(config, self)
         self.save_profile = self.pmgr.save_profile
@@ -125,11 +149,38 @@ class BedMesh:
         gcode_move = self.printer.load_object(config, 'gcode_move')
         gcode_move.set_move_transform(self)
         # initialize status dict
+        self.status_version = 0
         self.update_status()
     def handle_connect(self):
         self.toolhead = self.printer.lookup_object('toolhead')
         self.bmc.print_generated_points(logging.info)
+        if self.stepper_mesh is not None:
+            self.stepper_mesh.connect(self.toolhead)
+    def _handle_home_rails_begin(self, homing_state, rails):
+        # Homing and probing moves are not compensated
+        self._disable_stepper_mesh()
+    def _handle_homing_move_begin(self, hmove):
+        self._disable_stepper_mesh()
+    def _disable_stepper_mesh(self):
+        # Stop applying the mesh in the z steppers (the next move
+        # enables it again), the toolhead position is updated to keep
+        # the steppers in place
+        if self.stepper_mesh is None or not self.stepper_mesh.is_active():
+            return
+        self.toolhead.flush_step_generation()
+        pos = self.toolhead.get_position()
+        pos[2] += self.stepper_mesh.get_z_adjust(pos[0], pos[1], pos[2])
+        self.stepper_mesh.set_mesh(None)
+        self.toolhead.set_position(pos)
+    def _enable_stepper_mesh(self):
+        self.toolhead.flush_step_generation()
+        pos = self.toolhead.get_position()
+        pos[2] -= self._calc_z_adjust(pos[0], pos[1], pos[2])
+        self.stepper_mesh.set_mesh(self.z_mesh, self.fade_start,
+                                   self.fade_end, self.fade_target)
+        self.toolhead.set_position(pos)
     def set_mesh(self, mesh):
+        self._disable_stepper_mesh()
         if mesh is not None and self.fade_end != self.FADE_DISABLE:
             self.log_fade_complete = True
             if self.base_fade_target is None:
@@ -177,26 +228,45 @@ class BedMesh:
             # No mesh calibrated, so send toolhead position
             self.last_position[:] = self.toolhead.get_position()
             self.last_position[2] -= self.fade_target
+        elif self.stepper_mesh is not None and self.stepper_mesh.is_active():
+            # The mesh is applied by the z steppers
+            self.last_position[:] = self.toolhead.get_position()
         else:
             # return current position minus the current z-adjustment
             x, y, z, e = self.toolhead.get_position()
-            max_adj = self.z_mesh.calc_z(x, y)
-            factor = 1.
-            z_adj = max_adj - self.fade_target
-            if min(z, (z - max_adj)) >= self.fade_end:
-                # Fade out is complete, no factor
-                factor = 0.
-            elif max(z, (z - max_adj)) >= self.fade_start:
-                # Likely in the process of fading out adjustment.
-                # Because we don't yet know the gcode z position, use
-                # algebra to calculate the factor from the toolhead pos
-                factor = ((self.fade_end + self.fade_target - z) /
-                          (self.fade_dist - z_adj))
-                factor = constrain(factor, 0., 1.)
-            final_z_adj = factor * z_adj + self.fade_target
-            self.last_position[:] = [x, y, z - final_z_adj, e]
+            self.last_position[:] = [x, y, z - self._calc_z_adjust(x, y, z), e]
         return list(self.last_position)
+    def _calc_z_adjust(self, x, y, z):
+        # Return the z-adjustment included in a toolhead position
+        max_adj = self.z_mesh.calc_z(x, y)
+        factor = 1.
+        z_adj = max_adj - self.fade_target
+        if min(z, (z - max_adj)) >= self.fade_end:
+            # Fade out is complete, no factor
+            factor = 0.
+        elif max(z, (z - max_adj)) >= self.fade_start:
+            # Likely in the process of fading out adjustment.
+            # Because we don't yet know the gcode z position, use
+            # algebra to calculate the factor from the toolhead pos
+            factor = ((self.fade_end + self.fade_target - z) /
+                      (self.fade_dist - z_adj))
+            factor = constrain(factor, 0., 1.)
+        return factor * z_adj + self.fade_target
     def move(self, newpos, speed):
+        if self.stepper_mesh is not None and self.z_mesh is not None:
+            # The z steppers apply the mesh, the toolhead position
+            # is not adjusted
+            enable = not self.stepper_mesh.is_active()
+            if enable:
+                self._enable_stepper_mesh()
+            self.toolhead.move(newpos, speed)
+            self.last_position[:] = newpos
+            if enable:
+                # NOTE: Enabling the mesh set the toolhead position, which
+                #       reset the gcode position to the start of this move.
+                gcode_move = self.printer.lookup_object('gcode_move')
+                gcode_move.reset_last_position()
+            return
         factor = self.get_z_factor(newpos[2])
         if self.z_mesh is None or not factor:
             # No mesh calibrated, or mesh leveling phased out.
@@ -219,7 +289,10 @@ class BedMesh:
         self.last_position[:] = newpos
     def get_status(self, eventtime=None):
         return self.status
+    def get_status_version(self):
+        return self.status_version
     def update_status(self):
+        self.status_version += 1
         self.status = {
             "profile_name": "",
             "mesh_min": (0., 0.),
@@ -271,6 +344,7 @@ class BedMesh:
             offsets = [None, None]
             for i, axis in enumerate(['X', 'Y']):
                 offsets[i] = gcmd.get_float(axis, None)
+            self._disable_stepper_mesh()
             self.z_mesh.set_mesh_offsets(offsets)
             gcode_move = self.printer.lookup_object('gcode_move')
             gcode_move.reset_last_position()
@@ -719,22 +793,22 @@ class BedMeshCalibrate:
             positions = corrected_pts
 
         probed_matrix = []
-        row = []
+        row = collections.deque()
         prev_pos = positions[0]
         for pos in positions:
             if not isclose(pos[1], prev_pos[1], abs_tol=.1):
                 # y has changed, append row and start new
-                probed_matrix.append(row)
-                row = []
+                probed_matrix.append(list(row))
+                row = collections.deque()
             if pos[0] > prev_pos[0]:
                 # probed in the positive direction
                 row.append(pos[2] - z_offset)
             else:
                 # probed in the negative direction
-                row.insert(0, pos[2] - z_offset)
+                row.appendleft(pos[2] - z_offset)
             prev_pos = pos
         # append last row
-        probed_matrix.append(row)
+        probed_matrix.append(list(row))
 
         # make sure the y-axis is the correct length
         if len(probed_matrix) != y_cnt:
@@ -866,6 +940,59 @@ class MoveSplitter:
             return None
 
 
+# Mesh compensation applied by the z steppers during step generation
+# (see kin_bed_mesh.c)
+class StepperMesh:
+    def __init__(self, printer):
+        self.printer = printer
+        self.orig_sks = []
+        self.bed_mesh_sks = []
+        self.active = False
+    def connect(self, toolhead):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        for s in toolhead.get_kinematics().get_steppers():
+            sk = s.get_stepper_kinematics()
+            if not ffi_lib.itersolve_is_active_axis(sk, b'z'):
+                continue
+            bm_sk = ffi_main.gc(ffi_lib.bed_mesh_alloc(), ffi_lib.bed_mesh_free)
+            if ffi_lib.bed_mesh_set_sk(bm_sk, sk) < 0:
+                continue
+            s.set_stepper_kinematics(bm_sk)
+            # NOTE: The original kinematics must be kept allocated
+            self.orig_sks.append(sk)
+            self.bed_mesh_sks.append(bm_sk)
+        if not self.bed_mesh_sks:
+            raise self.printer.config_error(
+                "bed_mesh: no z steppers found for stepper compensation")
+    def is_active(self):
+        return self.active
+    def get_z_adjust(self, x, y, z):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        return ffi_lib.bed_mesh_get_z_adjust(self.bed_mesh_sks[0], x, y, z)
+    def set_mesh(self, z_mesh, fade_start=0., fade_end=0., fade_target=0.):
+        # The toolhead must be flushed before changing the mesh
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.active = z_mesh is not None
+        if not self.active:
+            for sk in self.bed_mesh_sks:
+                ffi_lib.bed_mesh_set_grid(sk, 0, 0, 0., 0., 0., 0.,
+                                          ffi_main.NULL)
+            return
+        grid = ffi_main.new('double[]', [z for line in z_mesh.mesh_matrix
+                                         for z in line])
+        for sk in self.bed_mesh_sks:
+            ret = ffi_lib.bed_mesh_set_grid(
+                sk, z_mesh.mesh_x_count, z_mesh.mesh_y_count,
+                z_mesh.mesh_x_min, z_mesh.mesh_y_min,
+                z_mesh.mesh_x_dist, z_mesh.mesh_y_dist, grid)
+            if ret:
+                raise self.printer.command_error(
+                    "bed_mesh: unable to load mesh in the z steppers")
+            ffi_lib.bed_mesh_set_offsets(sk, z_mesh.mesh_offsets[0],
+                                         z_mesh.mesh_offsets[1])
+            ffi_lib.bed_mesh_set_fade(sk, fade_start, fade_end, fade_target)
+
+
 class ZMesh:
     def __init__(self, params):
         self.probed_matrix = self.mesh_matrix = None
@@ -940,17 +1067,18 @@ class ZMesh:
             msg += "Interpolation Algorithm: %s\n" \
                    % (self.mesh_params['algo'])
             msg += "Measured points:\n"
-            for y_line in range(self.mesh_y_count - 1, -1, -1):
-                for z in matrix[y_line]:
-                    msg += "  %f" % (z)
-                msg += "\n"
+            msg += "".join(["".join(["  %f" % (z) for z in matrix[y_line]])
+                            + "\n"
+                            for y_line in range(self.mesh_y_count - 1, -1, -1)])
             print_func(msg)
         else:
             print_func("bed_mesh: Z Mesh not generated")
     def build_mesh(self, z_matrix):
         self.probed_matrix = z_matrix
         self._sample(z_matrix)
-        self.print_mesh(logging.debug)
+        self._build_coefficients()
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self.print_mesh(logging.debug)
     def set_zero_reference(self, xpos, ypos):
         offset = self.calc_z(xpos, ypos)
         logging.info(
@@ -961,6 +1089,7 @@ class ZMesh:
             for yidx in range(len(matrix)):
                 for xidx in range(len(matrix[yidx])):
                     matrix[yidx][xidx] -= offset
+        self._build_coefficients()
     def set_mesh_offsets(self, offsets):
         for i, o in enumerate(offsets):
             if o is not None:
@@ -971,15 +1100,28 @@ class ZMesh:
         return self.mesh_y_min + self.mesh_y_dist * index
     def calc_z(self, x, y):
         if self.mesh_matrix is not None:
-            tbl = self.mesh_matrix
-            tx, xidx = self._get_linear_index(x + self.mesh_offsets[0], 0)
-            ty, yidx = self._get_linear_index(y + self.mesh_offsets[1], 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
-            return lerp(ty, z0, z1)
+            cx = (x + self.mesh_offsets[0] - self.mesh_x_min) / self.mesh_x_dist
+            cy = (y + self.mesh_offsets[1] - self.mesh_y_min) / self.mesh_y_dist
+            xidx = constrain(int(math.floor(cx)), 0, self.mesh_x_count - 2)
+            yidx = constrain(int(math.floor(cy)), 0, self.mesh_y_count - 2)
+            tx = constrain(cx - xidx, 0., 1.)
+            ty = constrain(cy - yidx, 0., 1.)
+            z, zx, zy, zxy = self.z_coeffs[yidx * self.coeff_stride + xidx]
+            return z + zx * tx + (zy + zxy * tx) * ty
         else:
             # No mesh table generated, no z-adjustment
             return 0.
+    def _build_coefficients(self):
+        # Bilinear coefficients of each mesh cell, calc_z only needs to
+        # find the cell and evaluate z + zx*tx + zy*ty + zxy*tx*ty
+        tbl = self.mesh_matrix
+        self.coeff_stride = self.mesh_x_count - 1
+        self.z_coeffs = coeffs = []
+        for row0, row1 in zip(tbl[:-1], tbl[1:]):
+            for z00, z01, z10, z11 in zip(row0[:-1], row0[1:],
+                                          row1[:-1], row1[1:]):
+                coeffs.append((z00, z01 - z00, z10 - z00,
+                               z11 - z10 - z01 + z00))
     def get_z_range(self):
         if self.mesh_matrix is not None:
             mesh_min = min([min(x) for x in self.mesh_matrix])
@@ -997,52 +1139,45 @@ class ZMesh:
             return round(avg_z, 2)
         else:
             return 0.
-    def _get_linear_index(self, coord, axis):
-        if axis == 0:
-            # X-axis
-            mesh_min = self.mesh_x_min
-            mesh_cnt = self.mesh_x_count
-            mesh_dist = self.mesh_x_dist
-            cfunc = self.get_x_coordinate
-        else:
-            # Y-axis
-            mesh_min = self.mesh_y_min
-            mesh_cnt = self.mesh_y_count
-            mesh_dist = self.mesh_y_dist
-            cfunc = self.get_y_coordinate
-        t = 0.
-        idx = int(math.floor((coord - mesh_min) / mesh_dist))
-        idx = constrain(idx, 0, mesh_cnt - 2)
-        t = (coord - cfunc(idx)) / mesh_dist
-        return constrain(t, 0., 1.), idx
     def _sample_direct(self, z_matrix):
         self.mesh_matrix = z_matrix
+    # Both interpolation algorithms are separable: the probed rows are
+    # interpolated along X, then every column along Y. Each mesh point
+    # is a weighted sum of probed points, so the weights of each axis
+    # are computed once and applied to the whole matrix.
+    def _interpolate(self, z_matrix, x_weights, y_weights):
+        np = load_numpy()
+        if np and self.mesh_x_count * self.mesh_y_count >= NUMPY_MIN_POINTS:
+            wx = self._get_weight_matrix(x_weights, len(z_matrix[0]))
+            wy = self._get_weight_matrix(y_weights, len(z_matrix))
+            z = np.array(z_matrix, dtype=float)
+            self.mesh_matrix = wy.dot(z.dot(wx.T)).tolist()
+            return
+        # Interpolate X coordinates of the probed rows
+        x_rows = [[sum([row[i] * w for i, w in wts]) for wts in x_weights]
+                  for row in z_matrix]
+        # Interpolate Y coordinates
+        self.mesh_matrix = []
+        for wts in y_weights:
+            line = [0.] * self.mesh_x_count
+            for i, w in wts:
+                line = [z + w * xz for z, xz in zip(line, x_rows[i])]
+            self.mesh_matrix.append(line)
+    def _get_weight_matrix(self, weights, pt_cnt):
+        wmat = numpy.zeros((len(weights), pt_cnt))
+        for i, wts in enumerate(weights):
+            for j, w in wts:
+                wmat[i, j] = w
+        return wmat
     def _sample_lagrange(self, z_matrix):
-        x_mult = self.x_mult
-        y_mult = self.y_mult
-        self.mesh_matrix = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_matrix[j//y_mult][i//x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
         xpts, ypts = self._get_lagrange_coords()
-        # Interpolate X coordinates
-        for i in range(self.mesh_y_count):
-            # only interpolate X-rows that have probed coordinates
-            if i % y_mult != 0:
-                continue
-            for j in range(self.mesh_x_count):
-                if j % x_mult == 0:
-                    continue
-                x = self.get_x_coordinate(j)
-                self.mesh_matrix[i][j] = self._calc_lagrange(xpts, x, i, 0)
-        # Interpolate Y coordinates
-        for i in range(self.mesh_x_count):
-            for j in range(self.mesh_y_count):
-                if j % y_mult == 0:
-                    continue
-                y = self.get_y_coordinate(j)
-                self.mesh_matrix[j][i] = self._calc_lagrange(ypts, y, i, 1)
+        x_weights = [self._get_lagrange_weights(xpts, i, self.x_mult,
+                                                self.get_x_coordinate)
+                     for i in range(self.mesh_x_count)]
+        y_weights = [self._get_lagrange_weights(ypts, i, self.y_mult,
+                                                self.get_y_coordinate)
+                     for i in range(self.mesh_y_count)]
+        self._interpolate(z_matrix, x_weights, y_weights)
     def _get_lagrange_coords(self):
         xpts = []
         ypts = []
@@ -1051,122 +1186,52 @@ class ZMesh:
         for j in range(self.mesh_params['y_count']):
             ypts.append(self.get_y_coordinate(j * self.y_mult))
         return xpts, ypts
-    def _calc_lagrange(self, lpts, c, vec, axis=0):
-        pt_cnt = len(lpts)
-        total = 0.
-        for i in range(pt_cnt):
+    def _get_lagrange_weights(self, lpts, idx, mult, cfunc):
+        # Weights of the probed points for the mesh point at "idx"
+        if idx % mult == 0:
+            return [(idx // mult, 1.)]
+        c = cfunc(idx)
+        weights = []
+        for i in range(len(lpts)):
             n = 1.
             d = 1.
-            for j in range(pt_cnt):
+            for j in range(len(lpts)):
                 if j == i:
                     continue
                 n *= (c - lpts[j])
                 d *= (lpts[i] - lpts[j])
-            if axis == 0:
-                # Calc X-Axis
-                z = self.mesh_matrix[vec][i*self.x_mult]
-            else:
-                # Calc Y-Axis
-                z = self.mesh_matrix[i*self.y_mult][vec]
-            total += z * n / d
-        return total
+            weights.append((i, n / d))
+        return weights
     def _sample_bicubic(self, z_matrix):
         # should work for any number of probe points above 3x3
-        x_mult = self.x_mult
-        y_mult = self.y_mult
         c = self.mesh_params['tension']
-        self.mesh_matrix = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_matrix[j//y_mult][i//x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
-        # Interpolate X values
-        for y in range(self.mesh_y_count):
-            if y % y_mult != 0:
-                continue
-            for x in range(self.mesh_x_count):
-                if x % x_mult == 0:
-                    continue
-                pts = self._get_x_ctl_pts(x, y)
-                self.mesh_matrix[y][x] = self._cardinal_spline(pts, c)
-        # Interpolate Y values
-        for x in range(self.mesh_x_count):
-            for y in range(self.mesh_y_count):
-                if y % y_mult == 0:
-                    continue
-                pts = self._get_y_ctl_pts(x, y)
-                self.mesh_matrix[y][x] = self._cardinal_spline(pts, c)
-    def _get_x_ctl_pts(self, x, y):
-        # Fetch control points and t for a X value in the mesh
-        x_mult = self.x_mult
-        x_row = self.mesh_matrix[y]
-        last_pt = self.mesh_x_count - 1 - x_mult
-        if x < x_mult:
-            p0 = p1 = x_row[0]
-            p2 = x_row[x_mult]
-            p3 = x_row[2*x_mult]
-            t = x / float(x_mult)
-        elif x > last_pt:
-            p0 = x_row[last_pt - x_mult]
-            p1 = x_row[last_pt]
-            p2 = p3 = x_row[last_pt + x_mult]
-            t = (x - last_pt) / float(x_mult)
-        else:
-            found = False
-            for i in range(x_mult, last_pt, x_mult):
-                if x > i and x < (i + x_mult):
-                    p0 = x_row[i - x_mult]
-                    p1 = x_row[i]
-                    p2 = x_row[i + x_mult]
-                    p3 = x_row[i + 2*x_mult]
-                    t = (x - i) / float(x_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding x control points")
-        return p0, p1, p2, p3, t
-    def _get_y_ctl_pts(self, x, y):
-        # Fetch control points and t for a Y value in the mesh
-        y_mult = self.y_mult
-        last_pt = self.mesh_y_count - 1 - y_mult
-        y_col = self.mesh_matrix
-        if y < y_mult:
-            p0 = p1 = y_col[0][x]
-            p2 = y_col[y_mult][x]
-            p3 = y_col[2*y_mult][x]
-            t = y / float(y_mult)
-        elif y > last_pt:
-            p0 = y_col[last_pt - y_mult][x]
-            p1 = y_col[last_pt][x]
-            p2 = p3 = y_col[last_pt + y_mult][x]
-            t = (y - last_pt) / float(y_mult)
-        else:
-            found = False
-            for i in range(y_mult, last_pt, y_mult):
-                if y > i and y < (i + y_mult):
-                    p0 = y_col[i - y_mult][x]
-                    p1 = y_col[i][x]
-                    p2 = y_col[i + y_mult][x]
-                    p3 = y_col[i + 2*y_mult][x]
-                    t = (y - i) / float(y_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding y control points")
-        return p0, p1, p2, p3, t
-    def _cardinal_spline(self, p, tension):
-        t = p[4]
+        x_weights = [self._get_bicubic_weights(i, self.x_mult,
+                                               self.mesh_params['x_count'], c)
+                     for i in range(self.mesh_x_count)]
+        y_weights = [self._get_bicubic_weights(i, self.y_mult,
+                                               self.mesh_params['y_count'], c)
+                     for i in range(self.mesh_y_count)]
+        self._interpolate(z_matrix, x_weights, y_weights)
+    def _get_bicubic_weights(self, idx, mult, pt_cnt, tension):
+        # Weights of the cardinal spline control points for the mesh
+        # point at "idx" (the end points are repeated at the edges)
+        pidx, rem = divmod(idx, mult)
+        if not rem:
+            return [(pidx, 1.)]
+        if pidx + 1 >= pt_cnt:
+            raise BedMeshError("bed_mesh: Error finding control points")
+        t = rem / float(mult)
         t2 = t*t
         t3 = t2*t
-        m1 = tension * (p[2] - p[0])
-        m2 = tension * (p[3] - p[1])
-        a = p[1] * (2*t3 - 3*t2 + 1)
-        b = p[2] * (-2*t3 + 3*t2)
-        c = m1 * (t3 - 2*t2 + t)
-        d = m2 * (t3 - t2)
-        return a + b + c + d
+        h00 = 2*t3 - 3*t2 + 1
+        h01 = -2*t3 + 3*t2
+        h10 = tension * (t3 - 2*t2 + t)
+        h11 = tension * (t3 - t2)
+        ctl_pts = [max(pidx - 1, 0), pidx, pidx + 1, min(pidx + 2, pt_cnt - 1)]
+        weights = {}
+        for i, w in zip(ctl_pts, [-h10, h00 - h11, h01 + h10, h11]):
+            weights[i] = weights.get(i, 0.) + w
+        return sorted(weights.items())
 
 
 class ProfileManager:
@@ -7,6 +7,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math
+from gcode import MOVE_WORDS, MOVE_WORD_INDEX
 
 # Coordinates created by this are converted into G1 commands.
 #
@@ -23,12 +24,26 @@ Y_AXIS = 1
 Z_AXIS = 2
 E_AXIS = 3
 
+# Native arcs need the target to be on the circle (within this distance)
+NATIVE_RADIUS_TOLERANCE = .001
+
+# Positions of the G1 words in the coordinates passed to "move_G1"
+MOVE_XYZ = [MOVE_WORD_INDEX[w] for w in 'XYZ']
+MOVE_E = MOVE_WORD_INDEX['E']
+MOVE_F = MOVE_WORD_INDEX['F']
+
 
 class ArcSupport:
 
     def __init__(self, config):
         self.printer = config.get_printer()
         self.mm_per_arc_segment = config.getfloat('resolution', 1., above=0.0)
+        self.chord_tolerance = config.getfloat('chord_tolerance', 0.,
+                                               minval=0.)
+        self.native_arcs = config.getboolean('native_arcs', False)
+        if self.native_arcs:
+            self.printer.register_event_handler("klippy:connect",
+                                                self._handle_connect)
 
         self.gcode_move = self.printer.load_object(config, 'gcode_move')
         self.gcode = self.printer.lookup_object('gcode')
@@ -44,6 +59,13 @@ class ArcSupport:
         # backwards compatibility, prior implementation only supported XY
         self.plane = ARC_PLANE_X_Y
 
+    def _handle_connect(self):
+        # Input shaping filters each axis along a straight move and can
+        # not follow arcs evaluated in the step generator.
+        if self.printer.lookup_object('input_shaper', None) is not None:
+            raise self.printer.config_error(
+                "gcode_arcs native_arcs can not be used with input_shaper")
+
     def cmd_G2(self, gcmd):
         self._cmd_inner(gcmd, True)
 
@@ -90,6 +112,26 @@ class ArcSupport:
         asE = gcmd.get_float("E", None)
         asF = gcmd.get_float("F", None)
 
+        move_coords = [None] * len(MOVE_WORDS)
+        move_coords[MOVE_F] = asF
+        if (self.native_arcs and self.gcode_move.move_transform is None
+            and self._is_circular(currentPos, asTarget, asPlanar, *axes)):
+            # Queue the whole arc as a single toolhead move
+            angular_travel = self._calc_angular_travel(
+                currentPos, asTarget, asPlanar, clockwise, *axes[:2])
+            startPos = gcodestatus['position']
+            center = (startPos[axes[0]] + asPlanar[0],
+                      startPos[axes[1]] + asPlanar[1])
+            toolhead = self.printer.lookup_object('toolhead')
+            def arc_move(newpos, speed):
+                toolhead.arc_move(newpos, speed, axes[0], axes[1], center,
+                                  angular_travel)
+            for i, v in zip(MOVE_XYZ, asTarget):
+                move_coords[i] = v
+            move_coords[MOVE_E] = asE
+            self.gcode_move.move_G1(gcmd, move_coords, arc_move)
+            return
+
         # Build list of linear coordinates to move
         coords = self.planArc(currentPos, asTarget, asPlanar,
                               clockwise, *axes)
@@ -99,30 +141,29 @@ class ArcSupport:
                 e_base = currentPos[3]
             e_per_move = (asE - e_base) / len(coords)
 
-        # Convert coords into G1 commands
+        # Convert coords into G1 moves
         for coord in coords:
-            g1_params = {'X': coord[0], 'Y': coord[1], 'Z': coord[2]}
+            for i, v in zip(MOVE_XYZ, coord):
+                move_coords[i] = v
             if e_per_move:
-                g1_params['E'] = e_base + e_per_move
+                move_coords[MOVE_E] = e_base + e_per_move
                 if gcodestatus['absolute_extrude']:
                     e_base += e_per_move
-            if asF is not None:
-                g1_params['F'] = asF
-            g1_gcmd = self.gcode.create_gcode_command("G1", "G1", g1_params)
-            self.gcode_move.cmd_G1(g1_gcmd)
-
-    # function planArc() originates from marlin plan_arc()
-    # https://github.com/MarlinFirmware/Marlin
-    #
-    # The arc is approximated by generating many small linear segments.
-    # The length of each segment is configured in MM_PER_ARC_SEGMENT
-    # Arcs smaller then this value, will be a Line only
-    #
-    # alpha and beta axes are the current plane, helical axis is linear travel
-    def planArc(self, currentPos, targetPos, offset, clockwise,
-                alpha_axis, beta_axis, helical_axis):
-        # todo: sometimes produces full circles
-
+            self.gcode_move.move_G1(gcmd, move_coords)
+
+    def _is_circular(self, currentPos, targetPos, offset,
+                     alpha_axis, beta_axis, helical_axis):
+        # Check that the start and the target are at the same radius,
+        # other arcs end with a straight segment (see planArc)
+        center_P = currentPos[alpha_axis] + offset[0]
+        center_Q = currentPos[beta_axis] + offset[1]
+        end_radius = math.hypot(targetPos[alpha_axis] - center_P,
+                                targetPos[beta_axis] - center_Q)
+        return (math.fabs(end_radius - math.hypot(*offset))
+                <= NATIVE_RADIUS_TOLERANCE)
+
+    def _calc_angular_travel(self, currentPos, targetPos, offset, clockwise,
+                             alpha_axis, beta_axis):
         # Radius vector from center to current location
         r_P = -offset[0]
         r_Q = -offset[1]
@@ -145,6 +186,41 @@ class ArcSupport:
             # Make a circle if the angular rotation is 0 and the
             # target is current position
             angular_travel = 2. * math.pi
+        return angular_travel
+
+    def _calc_segments(self, radius, angular_travel, mm_of_travel):
+        if not self.chord_tolerance:
+            return max(1., math.floor(mm_of_travel / self.mm_per_arc_segment))
+        # Largest angle per segment keeping the distance between each
+        # chord and the arc within chord_tolerance
+        if self.chord_tolerance >= radius:
+            segment_angle = .5 * math.pi
+        else:
+            segment_angle = min(
+                2. * math.acos(1. - self.chord_tolerance / radius),
+                .5 * math.pi)
+        return max(1., math.ceil(math.fabs(angular_travel) / segment_angle))
+
+    # function planArc() originates from marlin plan_arc()
+    # https://github.com/MarlinFirmware/Marlin
+    #
+    # The arc is approximated by generating many small linear segments.
+    # The length of each segment is configured in MM_PER_ARC_SEGMENT, or
+    # follows from the radius when a chord tolerance is configured.
+    # Arcs smaller then this value, will be a Line only
+    #
+    # alpha and beta axes are the current plane, helical axis is linear travel
+    def planArc(self, currentPos, targetPos, offset, clockwise,
+                alpha_axis, beta_axis, helical_axis):
+        # todo: sometimes produces full circles
+
+        # Radius vector from center to current location
+        r_P = -offset[0]
+        r_Q = -offset[1]
+        center_P = currentPos[alpha_axis] - r_P
+        center_Q = currentPos[beta_axis] - r_Q
+        angular_travel = self._calc_angular_travel(
+            currentPos, targetPos, offset, clockwise, alpha_axis, beta_axis)
 
         # Determine number of segments
         linear_travel = targetPos[helical_axis] - currentPos[helical_axis]
@@ -154,7 +230,7 @@ class ArcSupport:
             mm_of_travel = math.hypot(flat_mm, linear_travel)
         else:
             mm_of_travel = math.fabs(flat_mm)
-        segments = max(1., math.floor(mm_of_travel / self.mm_per_arc_segment))
+        segments = self._calc_segments(radius, angular_travel, mm_of_travel)
 
         # Generate coordinates
         theta_per_segment = angular_travel / segments
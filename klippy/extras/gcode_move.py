@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, klippy
-from gcode import GCodeDispatch
+from gcode import GCodeDispatch, MOVE_WORDS, MOVE_WORD_INDEX
 from extras.homing import Homing
 
 class GCodeMove:
@@ -72,6 +72,11 @@ class GCodeMove:
             gcode.register_command(cmd, func, when_not_ready=False, desc=desc)
         
         gcode.register_command('G0', self.cmd_G1)
+        # NOTE: plain G0/G1 lines are pre-parsed by GCodeDispatch and
+        #       handed to "move_G1" directly (see "register_move_handler").
+        gcode.register_move_handler('G0', self.move_G1)
+        gcode.register_move_handler('G1', self.move_G1)
+        self._build_move_words()
         gcode.register_command('M114', self.cmd_M114, True)
         gcode.register_command('GET_POSITION', self.cmd_GET_POSITION, True,
                                desc=self.cmd_GET_POSITION_help)
@@ -200,51 +205,71 @@ class GCodeMove:
         else:
             logging.info("\n\n" + f"gcode_move.reset_last_position: printer not ready self.last_position={self.last_position} not updated.\n\n")
     
+    def _build_move_words(self):
+        # NOTE: Index of each axis word in the "MOVE_WORDS" layout, and
+        #       the words (with their index) parsed by "cmd_G1".
+        self.axis_word_idxs = [MOVE_WORD_INDEX[a] for a in self.axis_names]
+        self.move_words = [(w, MOVE_WORD_INDEX[w])
+                           for w in self.axis_names + 'EF']
+
     # G-Code movement commands
     def cmd_G1(self, gcmd):
         
         # Move
         params = gcmd.get_command_parameters()
-        logging.info(f"\n\nGCodeMove: G1 starting setup with params={params}.\n\n")
+        # NOTE: parse the move words into the layout of "MOVE_WORDS",
+        #       as done by the G0/G1 fast path in GCodeDispatch.
+        coords = [None] * len(MOVE_WORDS)
         try:
-            # NOTE: XYZ(ABC) move coordinates.
-            for pos, axis in enumerate(self.axis_names):
-                if axis in params:
-                    v = float(params[axis])
-                    logging.info(f"\n\nGCodeMove: parsed axis={axis} with value={v}\n\n")
-                    if not self.absolute_coord:
-                        # value relative to position of last move
-                        self.last_position[pos] += v
-                    else:
-                        # value relative to base coordinate position
-                        self.last_position[pos] = v + self.base_position[pos]
-            # NOTE: extruder move coordinates.
-            if 'E' in params:
-                v = float(params['E']) * self.extrude_factor
-                logging.info(f"\n\nGCodeMove: parsed axis=E with value={v}\n\n")
-                if not self.absolute_coord or not self.absolute_extrude:
-                    # value relative to position of last move
-                    self.last_position[self.axis_count] += v
-                else:
-                    # value relative to base coordinate position
-                    self.last_position[self.axis_count] = v + self.base_position[self.axis_count]
-            # NOTE: move feedrate.
-            if 'F' in params:
-                gcode_speed = float(params['F'])
-                if gcode_speed <= 0.:
-                    raise gcmd.error("Invalid speed in '%s'"
-                                     % (gcmd.get_commandline(),))
-                self.speed = gcode_speed * self.speed_factor
-            
+            for w, i in self.move_words:
+                if w in params:
+                    coords[i] = float(params[w])
         except ValueError as e:
             raise gcmd.error("Unable to parse move '%s'"
                              % (gcmd.get_commandline(),))
+        self.move_G1(gcmd, coords)
+
+    def move_G1(self, gcmd, coords, move_func=None):
+        # NOTE: "move_func" replaces "move_with_transform" for moves that
+        #       are not straight lines (see "native_arcs" in gcode_arcs.py).
+        # NOTE: XYZ(ABC) move coordinates.
+        last_position = self.last_position
+        for pos, i in enumerate(self.axis_word_idxs):
+            v = coords[i]
+            if v is not None:
+                if not self.absolute_coord:
+                    # value relative to position of last move
+                    last_position[pos] += v
+                else:
+                    # value relative to base coordinate position
+                    last_position[pos] = v + self.base_position[pos]
+        # NOTE: extruder move coordinates.
+        v = coords[MOVE_WORD_INDEX['E']]
+        if v is not None:
+            v *= self.extrude_factor
+            if not self.absolute_coord or not self.absolute_extrude:
+                # value relative to position of last move
+                last_position[self.axis_count] += v
+            else:
+                # value relative to base coordinate position
+                last_position[self.axis_count] = v + self.base_position[self.axis_count]
+        # NOTE: move feedrate.
+        gcode_speed = coords[MOVE_WORD_INDEX['F']]
+        if gcode_speed is not None:
+            if gcode_speed <= 0.:
+                raise gcmd.error("Invalid speed in '%s'"
+                                 % (gcmd.get_commandline(),))
+            self.speed = gcode_speed * self.speed_factor
         
         # NOTE: send event to handlers, like "extra_toolhead.py" 
-        self.printer.send_event("gcode_move:parsing_move_command", gcmd, params)
+        self.printer.send_event("gcode_move:parsing_move_command", gcmd,
+                                gcmd.get_command_parameters())
         
         # NOTE: this is just a call to "toolhead.move".
-        self.move_with_transform(self.last_position, self.speed)
+        if move_func is None:
+            self.move_with_transform(last_position, self.speed)
+        else:
+            move_func(last_position, self.speed)
     
     # G-Code coordinate manipulation
     def cmd_G20(self, gcmd):
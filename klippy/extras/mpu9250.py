@@ -4,7 +4,7 @@
 # Copyright (C) 2020-2021 Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, time, collections, threading, multiprocessing, os
+import logging, time, collections, multiprocessing, os
 from . import bus, motion_report, adxl345
 
 MPU9250_ADDR =      0x68
@@ -70,9 +70,6 @@ class MPU9250:
         self.data_rate = config.getint('rate', 4000)
         if self.data_rate not in SAMPLE_RATE_DIVS:
             raise config.error("Invalid rate parameter: %d" % (self.data_rate,))
-        # Measurement storage (accessed from background thread)
-        self.lock = threading.Lock()
-        self.raw_samples = []
         # Setup mcu sensor_mpu9250 bulk query code
         self.i2c = bus.MCU_I2C_from_config(config,
                                            default_addr=MPU9250_ADDR,
@@ -82,7 +79,8 @@ class MPU9250:
         self.query_mpu9250_cmd = self.query_mpu9250_end_cmd = None
         self.query_mpu9250_status_cmd = None
         mcu.register_config_callback(self._build_config)
-        mcu.register_response(self._handle_mpu9250_data, "mpu9250_data", oid)
+        # Measurement storage (filled from background thread)
+        self.bulk_buffer = mcu.register_bulk_response("mpu9250_data", oid)
         # Clock tracking
         self.last_sequence = self.max_query_duration = 0
         self.last_limit_count = self.last_error_count = 0
@@ -120,9 +118,6 @@ class MPU9250:
     # Measurement collection
     def is_measuring(self):
         return self.query_rate > 0
-    def _handle_mpu9250_data(self, params):
-        with self.lock:
-            self.raw_samples.append(params)
     def _extract_samples(self, raw_samples):
         # Load variables to optimize inner loop below
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
@@ -131,11 +126,10 @@ class MPU9250:
         # Process every message in raw_samples
         count = seq = 0
         samples = [None] * (len(raw_samples) * SAMPLES_PER_BLOCK)
-        for params in raw_samples:
-            seq_diff = (last_sequence - params['sequence']) & 0xffff
+        for sequence, d in raw_samples:
+            seq_diff = (last_sequence - sequence) & 0xffff
             seq_diff -= (seq_diff & 0x8000) << 1
             seq = last_sequence - seq_diff
-            d = bytearray(params['data'])
             msg_cdiff = seq * SAMPLES_PER_BLOCK - chip_base
 
             for i in range(len(d) // BYTES_PER_SAMPLE):
@@ -215,8 +209,7 @@ class MPU9250:
         self.set_reg(REG_ACCEL_CONFIG2, SET_ACCEL_CONFIG2)
 
         # Setup samples
-        with self.lock:
-            self.raw_samples = []
+        self.bulk_buffer.clear()
         # Start bulk reading
         systime = self.printer.get_reactor().monotonic()
         print_time = self.mcu.estimated_print_time(systime) + MIN_MSG_TIME
@@ -239,8 +232,7 @@ class MPU9250:
         # Halt bulk reading
         params = self.query_mpu9250_end_cmd.send([self.oid, 0, 0])
         self.query_rate = 0
-        with self.lock:
-            self.raw_samples = []
+        self.bulk_buffer.clear()
         logging.info("MPU9250 finished '%s' measurements", self.name)
         self.set_reg(REG_PWR_MGMT_1, SET_PWR_MGMT_1_SLEEP)
         self.set_reg(REG_PWR_MGMT_2, SET_PWR_MGMT_2_OFF)
@@ -248,9 +240,7 @@ class MPU9250:
     # API interface
     def _api_update(self, eventtime):
         self._update_clock()
-        with self.lock:
-            raw_samples = self.raw_samples
-            self.raw_samples = []
+        raw_samples = self.bulk_buffer.pull()
         if not raw_samples:
             return {}
         samples = self._extract_samples(raw_samples)
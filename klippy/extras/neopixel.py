@@ -80,10 +80,9 @@ class PrinterNeoPixel:
                 diffs[i][1] = nextcount + (nextpos - pos)
                 del diffs[i+1]
         # Transmit changes
-        ucmd = self.neopixel_update_cmd.send
-        for pos, count in diffs:
-            ucmd([self.oid, pos, new_data[pos:pos+count]],
-                 reqclock=BACKGROUND_PRIORITY_CLOCK)
+        self.neopixel_update_cmd.send_many(
+            [[self.oid, pos, new_data[pos:pos+count]] for pos, count in diffs],
+            reqclock=BACKGROUND_PRIORITY_CLOCK)
         old_data[:] = new_data
         # Instruct mcu to update the LEDs
         minclock = 0
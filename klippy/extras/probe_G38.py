@@ -7,7 +7,7 @@
 # TODO: check if this is useful.
 # from . import manual_probe
 
-import logging
+import logging, math
 import pins
 from . import probe
 
@@ -25,6 +25,9 @@ class ProbeEndstopWrapperG38(probe.ProbeEndstopWrapper):
 
         # NOTE: recovery stuff, see "probe_prepare" below. Not needed.
         self.recovery_time = config.getfloat('recovery_time', 0.4, minval=0.)
+        # NOTE: Set by probing sequences after the first touch, the
+        #       retract and travel moves separate the next touches.
+        self.skip_recovery = False
 
         # NOTE: add XY steppers too, see "_handle_mcu_identify" below.
         self.printer.register_event_handler('klippy:mcu_identify',
@@ -47,7 +50,7 @@ class ProbeEndstopWrapperG38(probe.ProbeEndstopWrapper):
             
         # NOTE: borrowed code from "smart_effector", trying to
         #       avoid the "Probe triggered prior to movement" error.
-        if self.recovery_time:
+        if self.recovery_time and not self.skip_recovery:
             toolhead = self.printer.lookup_object('toolhead')
             toolhead.dwell(self.recovery_time)
 
@@ -61,16 +64,16 @@ class ProbeEndstopWrapperG38(probe.ProbeEndstopWrapper):
         kin = self.printer.lookup_object('toolhead').get_kinematics()
         for stepper in kin.get_steppers():
             # NOTE: get_steppers returns all "PrinterStepper"/"MCU_stepper" objects in the kinematic.
-            if stepper.is_active_axis('x') or stepper.is_active_axis('y') or stepper.is_active_axis('z'):
-                self.add_stepper(stepper)
-                
+            #       Every toolhead stepper can take part in a probing move,
+            #       so all of them are registered (whatever their axis name).
+            self.add_stepper(stepper)
+
         # NOTE: Register ABC steppers too.
         kin_abc = self.printer.lookup_object('toolhead').get_kinematics_abc()
         if kin_abc is not None:
             for stepper in kin_abc.get_steppers():
-                # NOTE: get_steppers returns all "PrinterStepper"/"MCU_stepper" objects in the kinematic.
-                if stepper.is_active_axis('x') or stepper.is_active_axis('y') or stepper.is_active_axis('z'):
-                    self.add_stepper(stepper)
+                # NOTE: The ABC rails use the "a", "b" and "c" axis names.
+                self.add_stepper(stepper)
         
         # NOTE: register steppers from all extruders.
         extruder_objs = self.printer.lookup_extruders()
@@ -146,8 +149,17 @@ class ProbeG38:
         # NOTE: recovery stuff
         self.recovery_time = config.getfloat('recovery_time', 0.4, minval=0.)
 
+        # NOTE: Results of the last PROBE_SEQUENCE command.
+        self.last_sequence = []
+
         # NOTE: Register commands
+        # NOTE: The sequence command can not be named "PROBE_G38_SEQUENCE",
+        #       extended command names can not contain digits (the line
+        #       would be parsed as a "PROBE_G38" command).
         self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command("PROBE_SEQUENCE",
+                                    self.cmd_PROBE_SEQUENCE,
+                                    desc=self.cmd_PROBE_SEQUENCE_help)
         
         # NOTE: From LinuxCNC: https://linuxcnc.org/docs/2.6/html/gcode/gcode.html
         #       - G38.2 - Probe toward workpiece, stop on contact, signal error if failure.
@@ -332,7 +344,7 @@ class ProbeG38:
             #       can be ignored. Else, the error should be logged with
             #       the "command_error" method, as always.
             if "Timeout during endstop homing" in reason:
-                reason += HINT_TIMEOUT
+                reason += probe.HINT_TIMEOUT
                 if error_out:
                     # NOTE: log the error as usual if it was requested.
                     raise self.printer.command_error(reason)
@@ -355,6 +367,125 @@ class ProbeG38:
         # TODO: update this to work with 6-axis klippy.
         return epos[:3]
 
+    def get_status(self, eventtime):
+        return {'last_sequence': self.last_sequence}
+
+    # Probing sequences
+    def parse_vectors(self, gcmd):
+        # NOTE: Each vector is "x,y,z,dx,dy,dz": the start position of a
+        #       touch (in G-Code coordinates) and its approach vector
+        #       (direction and maximum travel). Vectors are separated
+        #       with "|".
+        gcode_move = self.printer.lookup_object('gcode_move')
+        base_position = gcode_move.base_position
+        vectors = []
+        for vector in gcmd.get('VECTORS').split('|'):
+            try:
+                values = [float(v) for v in vector.split(',')]
+            except ValueError:
+                raise gcmd.error("Unable to parse vector '%s'" % (vector,))
+            if len(values) != 6:
+                raise gcmd.error("Vector '%s' must have six values" % (vector,))
+            start = [v + base_position[i] for i, v in enumerate(values[:3])]
+            approach = values[3:]
+            if not any(approach):
+                raise gcmd.error("Vector '%s' has no approach" % (vector,))
+            vectors.append((start, approach))
+        return vectors
+
+    def probe_sequence(self, vectors, speed, travel_speed, retract,
+                       error_out, trigger_invert):
+        # NOTE: The points are probed one after the other within a
+        #       single command: the probe is deployed once for the whole
+        #       sequence, and each touch is followed by a retract along
+        #       its approach vector and the travel to the next start.
+        #       Results are collected and reported at the end.
+        # NOTE: Each touch is still its own "probing_move" (with its own
+        #       trsync), and the retract is queued by the host once the
+        #       trigger position is known. Reusing the trsync across
+        #       touches, or retracting from the mcu on trigger, would need
+        #       mcu firmware support: a trigger stops the steppers and
+        #       discards their queued steps.
+        toolhead = self.printer.lookup_object('toolhead')
+        gcode_move = self.printer.lookup_object('gcode_move')
+        phoming = self.printer.lookup_object('homing')
+        mcu_probe = self.probe.mcu_probe
+        results = []
+        self.probe.multi_probe_begin()
+        try:
+            for start, approach in vectors:
+                pos = toolhead.get_position()
+                pos[:3] = start
+                toolhead.move(pos, travel_speed)
+                dist = math.sqrt(sum([d*d for d in approach]))
+                target = list(pos)
+                target[:3] = [s + d for s, d in zip(start, approach)]
+                probe_axes = [a for a, d in zip("xyz", approach) if d]
+                try:
+                    epos = phoming.probing_move(mcu_probe=mcu_probe,
+                                                pos=target, speed=speed,
+                                                check_triggered=True,
+                                                triggered=trigger_invert,
+                                                probe_axes=probe_axes)
+                except self.printer.command_error as e:
+                    reason = str(e)
+                    if error_out or ("No trigger" not in reason
+                                     and "Timeout during" not in reason):
+                        raise
+                    epos = None
+                results.append((start, epos))
+                # NOTE: The recovery dwell of the next touch is only
+                #       skipped when the probe was retracted from this one.
+                mcu_probe.skip_recovery = False
+                if epos is None or not retract:
+                    continue
+                # Retract along the approach vector
+                pos = toolhead.get_position()
+                pos[:3] = [p - d * retract / dist
+                           for p, d in zip(epos[:3], approach)]
+                toolhead.move(pos, travel_speed)
+                mcu_probe.skip_recovery = True
+        finally:
+            mcu_probe.skip_recovery = False
+            self.probe.multi_probe_end()
+            # NOTE: The moves above bypass gcode_move, so its position
+            #       must be updated from the toolhead.
+            gcode_move.reset_last_position()
+        return results
+
+    cmd_PROBE_SEQUENCE_help = (
+        "Probe a sequence of approach vectors and report the triggers."
+        " Usage: PROBE_SEQUENCE VECTORS=x,y,z,dx,dy,dz|... [MODE=2-5]"
+        " [SPEED=s] [TRAVEL_SPEED=s] [RETRACT=d]")
+    def cmd_PROBE_SEQUENCE(self, gcmd):
+        vectors = self.parse_vectors(gcmd)
+        # NOTE: MODE selects the G38.n logic (see cmd_PROBE_G38_2).
+        mode = gcmd.get_int('MODE', 2, minval=2, maxval=5)
+        error_out = mode in (2, 4)
+        trigger_invert = mode in (2, 3)
+        speed = gcmd.get_float('SPEED', self.probe.speed, above=0.)
+        travel_speed = gcmd.get_float('TRAVEL_SPEED', self.probe.lift_speed,
+                                      above=0.)
+        retract = gcmd.get_float('RETRACT', self.probe.sample_retract_dist,
+                                 minval=0.)
+        results = self.probe_sequence(vectors, speed, travel_speed, retract,
+                                      error_out, trigger_invert)
+        # NOTE: Positions are reported in G-Code coordinates.
+        base_position = self.printer.lookup_object('gcode_move').base_position
+        def gcode_coord(pos):
+            return [p - base_position[i] for i, p in enumerate(pos[:3])]
+        self.last_sequence = []
+        lines = ["point  start x/y/z              trigger x/y/z"]
+        for i, (start, epos) in enumerate(results):
+            trigger = "none"
+            if epos is not None:
+                epos = gcode_coord(epos)
+                trigger = "%.3f %.3f %.3f" % tuple(epos)
+            self.last_sequence.append(epos)
+            lines.append("%-5d  %-25s  %s" % (
+                i, "%.3f %.3f %.3f" % tuple(gcode_coord(start)), trigger))
+        gcmd.respond_info("\n".join(lines))
+
 
 def load_config(config):
     return ProbeG38(config)
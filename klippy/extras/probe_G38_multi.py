@@ -63,8 +63,15 @@ class ProbeG38multi(probe_G38.ProbeG38):
         # NOTE: recovery stuff
         self.recovery_time = config.getfloat('recovery_time', 0.4, minval=0.)
 
+        # NOTE: Results of the last MULTIPROBE_SEQUENCE command.
+        self.last_sequence = []
+
         # NOTE: Register commands
         self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_mux_command("MULTIPROBE_SEQUENCE", "PROBE_NAME",
+                                        self.probe_name,
+                                        self.cmd_PROBE_SEQUENCE,
+                                        desc=self.cmd_PROBE_SEQUENCE_help)
         
         # NOTE: From LinuxCNC: https://linuxcnc.org/docs/2.6/html/gcode/gcode.html
         #       - G38.2 - Probe toward workpiece, stop on contact, signal error if failure.
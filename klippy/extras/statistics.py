@@ -4,6 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import os, time, logging
+import reactor
 
 class PrinterSysStats:
     def __init__(self, config):
@@ -49,6 +50,67 @@ class PrinterSysStats:
                 'cputime': self.total_process_time,
                 'memavail': self.last_mem_avail}
 
+# Timer and fd callback timing of the reactor (see "ReactorStats")
+class PrinterReactorStats:
+    def __init__(self, config):
+        self.printer = printer = config.get_printer()
+        self.reactor = printer.get_reactor()
+        webhooks = printer.lookup_object('webhooks')
+        webhooks.register_endpoint("reactor/stats", self._handle_web_request)
+        gcode = printer.lookup_object('gcode')
+        gcode.register_command("REACTOR_STATS", self.cmd_REACTOR_STATS,
+                               desc=self.cmd_REACTOR_STATS_help)
+    def stats(self, eventtime):
+        rs = self.reactor.get_stats()
+        msg = "reactor_max=%.6f reactor_late=%.6f reactor_overshoot=%.6f" % (
+            rs.interval_max_time, rs.interval_max_late,
+            rs.interval_max_overshoot)
+        if rs.interval_max_name is not None:
+            msg += " reactor_max_cb=%s" % (rs.interval_max_name,)
+        msg += " greenlets=%d greenlet_switches=%d" % (
+            self.reactor.get_greenlet_count(), rs.greenlet_switches)
+        rs.reset_interval()
+        return (False, msg)
+    def get_report(self):
+        rs = self.reactor.get_stats()
+        return {
+            'callbacks': {name: cs.get_status()
+                          for name, cs in rs.callbacks.items() if cs.count},
+            'histogram_limits': list(reactor.STATS_BUCKETS),
+            'greenlets': self.reactor.get_greenlet_count(),
+            'greenlet_switches': rs.greenlet_switches,
+            'pause_count': rs.pause_count,
+            'max_overshoot': rs.max_overshoot}
+    def _handle_web_request(self, web_request):
+        report = self.get_report()
+        if web_request.get('reset', False, types=(bool,)):
+            self.reactor.get_stats().reset()
+        web_request.send(report)
+    cmd_REACTOR_STATS_help = "Report the slowest reactor callbacks"
+    def cmd_REACTOR_STATS(self, gcmd):
+        count = gcmd.get_int('COUNT', 10, minval=1)
+        rs = self.reactor.get_stats()
+        callbacks = sorted([cs for cs in rs.callbacks.values() if cs.count],
+                           key=(lambda cs: cs.max_time), reverse=True)
+        limits = ["<%gms" % (l * 1000.,) for l in reactor.STATS_BUCKETS]
+        limits.append(">=%gms" % (reactor.STATS_BUCKETS[-1] * 1000.,))
+        lines = ["greenlets=%d greenlet_switches=%d pauses=%d"
+                 " max_overshoot=%.3fms" % (
+                     self.reactor.get_greenlet_count(), rs.greenlet_switches,
+                     rs.pause_count, rs.max_overshoot * 1000.),
+                 "histogram: %s" % (" ".join(limits),)]
+        for cs in callbacks[:count]:
+            lines.append("%s: count=%d avg=%.3fms max=%.3fms late=%.3fms"
+                         " histogram=%s" % (
+                             cs.name, cs.count,
+                             cs.total_time * 1000. / cs.count,
+                             cs.max_time * 1000., cs.max_late * 1000.,
+                             " ".join(["%d" % (c,) for c in cs.histogram])))
+        if gcmd.get_int('RESET', 0):
+            rs.reset()
+            lines.append("Reactor statistics reset")
+        gcmd.respond_info("\n".join(lines))
+
 class PrinterStats:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -71,4 +133,6 @@ class PrinterStats:
 
 def load_config(config):
     config.get_printer().add_object('system_stats', PrinterSysStats(config))
+    config.get_printer().add_object('reactor_stats',
+                                    PrinterReactorStats(config))
     return PrinterStats(config)
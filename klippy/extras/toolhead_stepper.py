@@ -4,11 +4,11 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math, logging, importlib
-import mcu, chelper, kinematics.extruder
+import mcu, chelper, motiontrace, kinematics.extruder
 import time
 
 # Move
-from toolhead import MoveQueue, LOOKAHEAD_FLUSH_TIME, MIN_KIN_TIME, MOVE_BATCH_TIME, SDS_CHECK_TIME, DRIP_SEGMENT_TIME, DRIP_TIME, DripModeEndSignal
+from toolhead import MoveQueue, MultiTrapQ, LOOKAHEAD_FLUSH_TIME, MIN_KIN_TIME, MOVE_BATCH_TIME, SDS_CHECK_TIME, DRIP_SEGMENT_TIME, DRIP_TIME, DripModeEndSignal
 
 # GCODE
 from extras.gcode_move import GCodeMove
@@ -33,12 +33,22 @@ Within the host code, print times are generally stored in variables named print_
 
 # Class to track each move request
 class Move:
+    # NOTE: Moves are created for every G-code segment, so the attribute
+    #       set is fixed with "__slots__" to reduce the per-move allocation
+    #       and attribute access cost on dense toolpaths.
+    __slots__ = ('toolhead', 'start_pos', 'end_pos', 'accel',
+                 'junction_deviation', 'timing_callbacks',
+                 'is_kinematic_move', 'axis_names', 'min_axis_sets',
+                 'axis_count',
+                 'axes_d', 'move_d', 'axes_r', 'min_move_t',
+                 'max_start_v2', 'max_cruise_v2', 'delta_v2',
+                 'max_smoothed_v2', 'smooth_delta_v2',
+                 'start_v', 'cruise_v', 'end_v',
+                 'accel_t', 'cruise_t', 'decel_t')
     def __init__(self, toolhead, start_pos, end_pos, speed):
-        logging.info(f"\n\nExtraMove: setup with start_pos={start_pos} and end_pos={end_pos}\n\n")
-        
         self.toolhead = toolhead
-        self.start_pos = tuple(start_pos)
-        self.end_pos = tuple(end_pos)
+        self.start_pos = start_pos = tuple(start_pos)
+        self.end_pos = end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
         self.junction_deviation = toolhead.junction_deviation
         self.timing_callbacks = []
@@ -55,32 +65,31 @@ class Move:
         self.axis_names = toolhead.axis_names
         # TODO: only this bit was changed, find a way to not need to redefine "Move" here, and import from toolhead.py instead
         self.min_axis_sets = toolhead.min_axis_sets
-        self.axis_count = self.min_axis_sets*3 # len(self.axis_names)
+        self.axis_count = axis_count = self.min_axis_sets*3 # len(self.axis_names)
 
         # NOTE: Compute the components of the displacement vector.
         #       The last component is now the extruder.
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in range(self.axis_count + 1)]
+        self.axes_d = axes_d = [ep - sp for sp, ep in
+                                zip(start_pos[:axis_count + 1], end_pos)]
         
         # NOTE: compute the euclidean magnitude of the XYZ(ABC) displacement vector.
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:self.axis_count]]))
-        
-        logging.info(f"\n\nExtraMove: setup with axes_d={axes_d} and move_d={move_d}.\n\n")
+        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:axis_count]]))
         
         # NOTE: If the move in XYZ is very small, then parse it as an extrude-only move.
         if move_d < .000000001:
             # Extrude only move
             
             # NOTE: the main axes wont move, thus end=stop.
-            self.end_pos = tuple([start_pos[i] for i in range(self.axis_count)])
             # NOTE: the extruder will move.
-            self.end_pos = self.end_pos + (end_pos[self.axis_count],)
+            self.end_pos = (tuple(start_pos[:axis_count])
+                            + (end_pos[axis_count],))
             
             # NOTE: set axis displacement to zero.
-            for i in range(self.axis_count):
+            for i in range(axis_count):
                 axes_d[i] = 0.
             
             # NOTE: set move distance to the extruder's displacement.
-            self.move_d = move_d = abs(axes_d[self.axis_count])
+            self.move_d = move_d = abs(axes_d[axis_count])
             
             # NOTE: set more stuff (?)
             inv_move_d = 0.
@@ -108,6 +117,12 @@ class Move:
         self.delta_v2 = 2.0 * move_d * self.accel
         self.max_smoothed_v2 = 0.
         self.smooth_delta_v2 = 2.0 * move_d * toolhead.max_accel_to_decel
+
+        trace = toolhead.trace
+        if __debug__ and trace.enabled:
+            trace.record(motiontrace.TP_MOVE, toolhead.trace_source,
+                         move_d, self.min_move_t, self.max_cruise_v2,
+                         self.accel, self.is_kinematic_move)
     
     def limit_speed(self, speed, accel):
         speed2 = speed**2
@@ -130,8 +145,6 @@ class Move:
         if not self.is_kinematic_move or not prev_move.is_kinematic_move:
             return
         
-        logging.info("\n\nExtraMove.calc_junction: function triggered.\n\n")
-        
         # Allow extruder to calculate its maximum junction
         # NOTE: Uses the "instant_corner_v" config parameter.
         extruder_v2 = self.toolhead.extruder.calc_junction(prev_move, self)
@@ -161,7 +174,11 @@ class Move:
         self.max_smoothed_v2 = min(self.max_start_v2, 
                                    prev_move.max_smoothed_v2 + prev_move.smooth_delta_v2)
         
-        logging.info("\n\nExtraMove.calc_junction: function end.\n\n")
+        trace = self.toolhead.trace
+        if __debug__ and trace.enabled:
+            trace.record(motiontrace.TP_JUNCTION, self.toolhead.trace_source,
+                         self.max_start_v2, self.max_smoothed_v2,
+                         junction_cos_theta)
     
     def set_junction(self, start_v2, cruise_v2, end_v2):
         """Move.set_junction() implements the "trapezoid generator" on a move.
@@ -175,9 +192,6 @@ class Move:
             cruise_v2 (_type_): _description_
             end_v2 (_type_): _description_
         """
-        
-        logging.info("\n\nExtraMove.set_junction: function triggered.\n\n")
-        
         # Determine accel, cruise, and decel portions of the move distance
         half_inv_accel = .5 / self.accel
         accel_d = (cruise_v2 - start_v2) * half_inv_accel
@@ -193,7 +207,11 @@ class Move:
         self.cruise_t = cruise_d / cruise_v
         self.decel_t = decel_d / ((end_v + cruise_v) * 0.5)
         
-        logging.info("\n\nExtraMove.set_junction: function end.\n\n")
+        trace = self.toolhead.trace
+        if __debug__ and trace.enabled:
+            trace.record(motiontrace.TP_SET_JUNCTION,
+                         self.toolhead.trace_source, start_v, cruise_v, end_v,
+                         self.accel_t + self.cruise_t + self.decel_t)
 
 
 
@@ -298,7 +316,9 @@ class ExtraToolHead:
             # NOTE: This triggers if 'debugoutput' is not None in the config,
             #       see "mcu.py".
             self.can_pause = False
-        self.move_queue = MoveQueue(self)
+        planners = {'python': False, 'c': True}
+        self.move_queue = MoveQueue(self, native_planner=config.getchoice(
+            'lookahead_planner', planners, 'python'))
         self.commanded_pos = [0.0 for i in range(self.min_axis_sets*3 + 1)]  # TODO: check if this is a good idea :)
         self.printer.register_event_handler("klippy:shutdown",
                                             self._handle_shutdown)
@@ -337,6 +357,10 @@ class ExtraToolHead:
         self.print_stall = 0
         self.drip_completion = None
         
+        # Motion planning trace points (see motiontrace.py)
+        self.trace = motiontrace.lookup_motion_trace(config)
+        self.trace_source = self.trace.register_source(self.name)
+
         # Kinematic step generation scan window time tracking
         self.kin_flush_delay = SDS_CHECK_TIME
         self.kin_flush_times = []
@@ -355,6 +379,7 @@ class ExtraToolHead:
         # NOTE: Load trapq (iterative solvers) and kinematics for the requested axes.
         self.kinematics = {}
         self.load_axes(config=config)
+        self.kin_trapqs = MultiTrapQ(self.kinematics)
         
         # Create extruder kinematics class
         # NOTE: setup a dummy extruder at first, replaced later if configured.
@@ -524,9 +549,7 @@ class ExtraToolHead:
         # NOTE: It also calls "trapq_finalize_moves" on the extruder and toolhead.
         # NOTE: a possible "use case" in the code is to:
         #           "Generate steps for moves"
-        
-        logging.info(f"\n\nExtraToolHead: _update_move_time triggered with next_print_time={next_print_time}\n\n")
-
+        trace = self.trace
         kin_flush_delay = self.kin_flush_delay
         # TODO: what is "fft"? It used to be named "last_kin_flush_time".
         fft = self.force_flush_time
@@ -554,11 +577,8 @@ class ExtraToolHead:
             # NOTE: Update move times on the toolhead's trapqs, meaning:
             #       "Expire any moves older than `free_time` from
             #       the trapezoid velocity queue" (see trapq.c).
-            for axes in list(self.kinematics):
-                # Iterate over ["XYZ", "ABC"].
-                kin = self.kinematics[axes]
-                logging.info(f"\n\nExtraToolHead._update_move_time calling trapq_finalize_moves on axes={axes} with free_time={free_time}\n\n")
-                self.trapq_finalize_moves(kin.trapq, free_time)
+            #       This is done for all kinematic groups in one call.
+            self.kin_trapqs.finalize_moves(free_time)
             
             # NOTE: "free_time" is smaller than "sg_flush_time" by "kin_flush_delay",
             #       which is defined from "SDS_CHECK_TIME".
@@ -581,6 +601,10 @@ class ExtraToolHead:
                 #       prior to the given 'mcu_flush_time' (see stepcompress.c
                 #       and "flush_moves" in mcu.py).
                 m.flush_moves(mcu_flush_time)
+            if __debug__ and trace.enabled:
+                trace.record(motiontrace.TP_UPDATE_TIME, self.trace_source,
+                             self.print_time, sg_flush_time, free_time,
+                             mcu_flush_time)
             if self.print_time >= next_print_time:
                 break
     
@@ -661,9 +685,6 @@ class ExtraToolHead:
         #       the "flush" method in a "MoveQueue" class instance.
         #       The "moves" argument receives a "queue" of moves "ready to be flushed".
         
-        # NOTE: logging for tracing activity
-        logging.info("\n\n" + f"{self.name}._process_moves: function triggered.\n\n")
-        
         # Resync print_time if necessary
         if self.special_queuing_state:
             if self.special_queuing_state != "Drip":
@@ -676,7 +697,6 @@ class ExtraToolHead:
             # NOTE Update "self.print_time".
             self._calc_print_time()
             # NOTE: Also sends a "toolhead:sync_print_time" event.
-            logging.info("\n\n" + f"{self.name}._process_moves: self.print_time={str(self.print_time)}\n\n")
         
         # Queue moves into trapezoid motion queue (trapq)
         # NOTE: the "trapq" is possibly something like a CFFI object.
@@ -684,24 +704,17 @@ class ExtraToolHead:
         #       object the one responsible for sending commands to
         #       the MCUs.
         next_move_time = self.print_time
+        kin_trapqs = self.kin_trapqs
+        kin_data = []
         for move in moves:
-            logging.info("\n\n" + f"{self.name}._process_moves: next_move_time={str(next_move_time)}")
-            
-            for axes in list(self.kinematics):
-                # Iterate over["XYZ", "A"]
-                logging.info("\n\n" + f"{self.name}._process_moves: appending move to {axes} trapq.\n\n")
-                kin = self.kinematics[axes]
-                # NOTE: The moves are first placed on a "trapezoid motion queue" with trapq_append.
-                if move.is_kinematic_move:
-                    self.trapq_append(
-                        kin.trapq, next_move_time,
-                        move.accel_t, move.cruise_t, move.decel_t,
-                        # NOTE: "kin.axis" is used to select the position value that corresponds
-                        #       to the current kinematic axis (e.g. kin.axis is [0,1,2] for the XYZ axis,
-                        #       or [3,4,5] for the ABC axis).
-                        move.start_pos[kin.axis[0]], move.start_pos[kin.axis[1]], move.start_pos[kin.axis[2]],
-                        move.axes_r[kin.axis[0]], move.axes_r[kin.axis[1]], move.axes_r[kin.axis[2]],
-                        move.start_v, move.cruise_v, move.accel)
+            # NOTE: The moves are first placed on a "trapezoid motion queue".
+            #       They are gathered here and appended to the trapq of every
+            #       kinematic group (e.g. "XYZ" and "ABC") with a single call
+            #       to "trapq_append_multi" below. "kin.axis" is used to select
+            #       the position values of each group (e.g. kin.axis is [0,1,2]
+            #       for the XYZ axis, or [3,4,5] for the ABC axis).
+            if move.is_kinematic_move:
+                kin_trapqs.add_move(kin_data, next_move_time, move)
             
             # NOTE: Repeat for the extruder's trapq.
             if move.axes_d[self.axis_count]:
@@ -717,15 +730,23 @@ class ExtraToolHead:
             
             # NOTE: Execute any "callbacks" registered 
             #       to be run at the end of this move.
-            for cb in move.timing_callbacks:
-                cb(next_move_time)
-        
+            if move.timing_callbacks:
+                # NOTE: Callbacks see the trapq with every move up to
+                #       this one appended, so pending moves are queued first.
+                kin_trapqs.append_moves(kin_data)
+                del kin_data[:]
+                for cb in move.timing_callbacks:
+                    cb(next_move_time)
+        kin_trapqs.append_moves(kin_data)
+
+        trace = self.trace
+        if __debug__ and trace.enabled:
+            trace.record(motiontrace.TP_PROCESS, self.trace_source,
+                         self.print_time, next_move_time, len(moves))
+
         # Generate steps for moves
         if self.special_queuing_state:
             # NOTE: this block is executed when "special_queuing_state" is not None.
-            # NOTE: loging "next_move_time" for tracing.
-            logging.info("\n\nExtraToolHead _process_moves: calling _update_drip_move_time with " +
-                         f"next_move_time={str(next_move_time)}\n\n")
             # NOTE: this function loops "while self.print_time < next_print_time".
             #       It "pauses before sending more steps" using "drip_completion.wait",
             #       and calls "_update_move_time". 
@@ -736,16 +757,12 @@ class ExtraToolHead:
         #       Here, it is passed to "_update_move_time" (which updates
         #       "self.print_time" and calls "trapq_finalize_moves") and
         #       to overwrite "self.last_kin_move_time".
-        logging.info(f"\n\nExtraToolHead _process_moves: _update_move_time with next_move_time={next_move_time}\n\n")
         self._update_move_time(next_move_time)
         self.last_kin_move_time = max(self.last_kin_move_time, next_move_time)
-        logging.info(f"\n\nExtraToolHead _process_moves: last_kin_move_time set to next_move_time={self.last_kin_move_time}\n\n")
         
     def flush_step_generation(self):
         # Transition from "Flushed"/"Priming"/main state to "Flushed" state
         # NOTE: a "use case" for drip moves is to: 'Exit "Drip" state'
-        logging.info(f"\n\nExtraToolHead.flush_step_generation: triggered.\n\n")
-
         # NOTE: this is the "flush" method from a "MoveQueue" object.
         #       It calls "_process_moves" on the moves in the queue that
         #       are "ready to be flushed", and removes them from the queue.
@@ -885,15 +902,8 @@ class ExtraToolHead:
         logging.info("\n\n" + f"{self.name}.set_position: setting newpos={newpos} and homing_axes={homing_axes}\n\n")
         self.flush_step_generation()
             
-        # NOTE: Set the position of the axes "trapq".
-        for axes in list(self.kinematics):
-            # Iterate over["XYZ", "ABC"]
-            logging.info("\n\n" + f"{self.name}.set_position: setting {axes} trapq position.\n\n")
-            kin = self.kinematics[axes]
-            # Filter the axis IDs according to the current kinematic
-            new_kin_pos = self.get_elements(newpos, kin.axis)
-            logging.info("\n\n" + f"{self.name}.set_position: using newpos={new_kin_pos}\n\n")
-            self.set_kin_trap_position(kin.trapq, new_kin_pos)
+        # NOTE: Set the position of the axes "trapq" (all axes at once).
+        self.kin_trapqs.set_position(self.print_time, newpos)
         
         # NOTE: Also set the position of the extruder's "trapq".
         #       Runs "trapq_set_position" and "rail.set_position".
@@ -983,7 +993,6 @@ class ExtraToolHead:
             newpos (_type_): _description_
             speed (_type_): _description_
         """
-        logging.info(f"\n\n"+ f"{self.name}.move: moving to newpos={newpos}.\n\n")
         move = Move(toolhead=self, 
                     start_pos=self.commanded_pos,
                     end_pos=newpos, 
@@ -995,7 +1004,6 @@ class ExtraToolHead:
 
         # NOTE: Move checks.
         if not move.move_d:
-            logging.info(f"\n\n"+ f"{self.name}.move: early return, nothing to move. move.move_d={move.move_d}\n\n")
             return
         
         # NOTE: Kinematic move checks for XYZ and ABC axes.
@@ -1005,7 +1013,6 @@ class ExtraToolHead:
             # for axes in ["XYZ"]:
             for axes in list(self.kinematics):    
                 # Iterate over["XYZ", "ABC"]
-                logging.info("\n\n" + f"{self.name}.move: check_move on {axes} move.\n\n")
                 kin = self.kinematics[axes]
                 kin.check_move(move)
             # self.kin.check_move(move)
@@ -1015,7 +1022,6 @@ class ExtraToolHead:
             
         # NOTE: Kinematic move checks for E axis.
         if move.axes_d[self.axis_count]:
-            logging.info("\n\n" + f"{self.name}.move: check_move on E move to {move.axes_d[self.axis_count]}.\n\n")
             self.extruder.check_move(move, e_axis=self.axis_count)
         
         # NOTE: Update "commanded_pos" with the "end_pos"
@@ -1122,6 +1128,10 @@ class ExtraToolHead:
                 self.drip_completion.wait(curtime + wait_time)
                 continue
             npt = min(self.print_time + DRIP_SEGMENT_TIME, next_print_time)
+            trace = self.trace
+            if __debug__ and trace.enabled:
+                trace.record(motiontrace.TP_DRIP, self.trace_source,
+                             self.print_time, next_print_time)
             # NOTE: this updates "self.print_time" and calls "trapq_finalize_moves",
             #       possibly to "Generate steps for moves".
             self._update_move_time(next_print_time=npt)
@@ -1172,11 +1182,7 @@ class ExtraToolHead:
             #       - Flush all moves from trapq (in the case of print_time=NEVER_TIME)
             #       I am guessing here that "older" means "with a smaller timestamp",
             #       or "previous". Otherwise it would not make sense.
-            for axes in list(self.kinematics):
-                # Iterate over ["XYZ", "ABC"].
-                kin = self.kinematics[axes]
-                logging.info(f"\n\nExtraToolHead.drip_move calling trapq_finalize_moves on axes={axes} free_time=self.reactor.NEVER ({self.reactor.NEVER})\n\n")
-                self.trapq_finalize_moves(kin.trapq, self.reactor.NEVER)
+            self.kin_trapqs.finalize_moves(self.reactor.NEVER)
             
             # # NOTE: This calls a function in "trapq.c", described as:
             # #       - Expire any moves older than `print_time` from the trapezoid velocity queue
@@ -1258,6 +1264,8 @@ class ExtraToolHead:
     def get_trapq(self, axes="XYZ"):
         return self.kinematics[axes].trapq
     
+    def register_stepper(self, mcu_stepper):
+        self.step_generators.append(mcu_stepper.generate_steps)
     def register_step_generator(self, handler):
         self.step_generators.append(handler)
     
@@ -1383,6 +1391,7 @@ class ExtraGCodeMove(GCodeMove):
         # self.axis_count = len(self.axis_names)
         self.axis_names = self.toolhead.axis_names
         self.axis_count = len(self.axis_names)
+        self._build_move_words()
 
         logging.info(f"\n\nGCodeMove.{self.toolhead_name}: starting setup with axes={self.axis_names} for toolhead_id='{self.toolhead_id}'\n\n")
         
@@ -1536,19 +1545,22 @@ class ToolheadSpinner():
         speed = gcmd.get_float('SPEED', 10.0)
         accel = gcmd.get_float('ACCEL', 10.0, minval=0.)
         sync = gcmd.get_int('SYNC', 1)
-        self.spin_params = (movedist, abs(speed), accel, sync)
+        spin_params = (movedist, abs(speed), accel, sync)
 
-        if not speed:
+        # NOTE: Apply the change when the main motion queue gets to it,
+        #       instead of flushing the queues (which stalls motion).
+        main_toolhead = self.printer.lookup_object('toolhead')
+        main_toolhead.register_lookahead_callback(
+            lambda print_time: self.set_spin(print_time, spin_params))
+
+    def set_spin(self, print_time, spin_params):
+        self.spin_params = spin_params
+        if not spin_params[1]:
             self.reactor.update_timer(self.spin_timer, self.reactor.NEVER)
         elif self.reactor.NEVER == self.spin_timer.waketime:
-            # Process other moves in the queue
-            self.toolhead.flush_step_generation()
             # Trigger the timer to add moves to the queue
-            system_print_time = self.time_at_print_time()
+            system_print_time = self.time_at_print_time(print_time)
             self.reactor.update_timer(self.spin_timer, system_print_time)
-            logging.info(f"\n\ncmd_SPIN_MANUAL_STEPPER: timer dead. Triggering do_spin_move at waketime={system_print_time}.\n\n")
-        else:
-            logging.info(f"\n\ncmd_SPIN_MANUAL_STEPPER: timer alive, doing nothing.\n\n")
 
 
     # Continuous rotation (move repeat) timer callback function.
@@ -3,9 +3,150 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging, io
+import os, logging, io, array, bisect
+import gcodeanalyze
 
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
+DEFAULT_READ_SIZE = 64 * 1024
+DEFAULT_BATCH_SIZE = 32
+INDEX_STEP = 256
+INDEX_BLOCK_SIZE = 1024 * 1024
+INDEX_DELAY = .010
+ANALYZE_PAUSE_LINES = 1000
+
+# G-code file with an index of line start positions.  The index holds
+# the position of every INDEX_STEP'th line and is extended on demand (and
+# a block at a time in the background), so looking up a line only scans
+# at most INDEX_STEP lines.  The number of lines is known once the whole
+# file has been indexed.
+# NOTE: The file is read with positioned reads (not memory mapped), so a
+#       file truncated or replaced during a print is seen as ending early
+#       instead of faulting (SIGBUS) on the missing pages.
+class GCodeFileIndex:
+    def __init__(self, f):
+        self.fd = f.fileno()
+        self.size = os.fstat(self.fd).st_size
+        self.offsets = array.array('q', [0])
+        self.scan_pos = self.scan_lines = 0
+        self.line_count = None
+    def read(self, pos, size):
+        return os.pread(self.fd, size, pos)
+    def _skip_lines(self, pos, count):
+        # Return the position following "count" more newlines, or None
+        while True:
+            data = self.read(pos, DEFAULT_READ_SIZE)
+            if not data:
+                return None
+            lines = data.count(b'\n')
+            if lines < count:
+                count -= lines
+                pos += len(data)
+                continue
+            end = -1
+            for i in range(count):
+                end = data.find(b'\n', end + 1)
+            return pos + end + 1
+    def _extend(self, line=None, position=None, size=None):
+        # Index line starts until the given line or position is covered
+        # (or "size" more bytes are scanned) or the end of file is reached
+        offsets = self.offsets
+        pos, lines = self.scan_pos, self.scan_lines
+        end_pos = pos + size if size is not None else None
+        while self.line_count is None and (
+                (line is not None and line >= len(offsets) * INDEX_STEP)
+                or (position is not None and pos <= position)
+                or (end_pos is not None and pos < end_pos)):
+            data = self.read(pos, INDEX_BLOCK_SIZE)
+            if not data:
+                # A final line may not end with a newline
+                if pos and self.read(pos - 1, 1) != b'\n':
+                    self.line_count = lines + 1
+                else:
+                    self.line_count = lines
+                break
+            # Record the start of each INDEX_STEP'th line in the block
+            block_lines = lines + data.count(b'\n')
+            next_line = len(offsets) * INDEX_STEP
+            end = -1
+            while next_line <= block_lines:
+                for i in range(next_line - lines):
+                    end = data.find(b'\n', end + 1)
+                lines = next_line
+                offsets.append(pos + end + 1)
+                next_line += INDEX_STEP
+            lines = block_lines
+            pos += len(data)
+        self.scan_pos, self.scan_lines = pos, lines
+    def index_block(self):
+        # Index the next block of the file, returns True once complete
+        self._extend(size=INDEX_BLOCK_SIZE)
+        return self.line_count is not None
+    def get_line_position(self, line):
+        # Return the file position of the start of a line (0 based)
+        self._extend(line=line)
+        index, count = divmod(line, INDEX_STEP)
+        if index >= len(self.offsets):
+            return None
+        pos = self.offsets[index]
+        if count:
+            pos = self._skip_lines(pos, count)
+        if pos is None or pos >= self.size:
+            return None
+        return pos
+    def get_line_number(self, position):
+        # Return the number of the line (0 based) at a file position
+        self._extend(position=position)
+        index = bisect.bisect_right(self.offsets, position) - 1
+        start = self.offsets[index]
+        return (index * INDEX_STEP
+                + self.read(start, position - start).count(b'\n'))
+    def get_line_count(self):
+        # Return the number of lines, or None until the file is indexed
+        return self.line_count
+
+# Split a g-code file into blocks of lines, tracking the byte offset of
+# the end of each line (for exact file_position reporting on files with
+# non-ascii content).
+class GCodeFileReader:
+    def __init__(self, index, position, read_size=DEFAULT_READ_SIZE):
+        self.index = index
+        self.read_size = read_size
+        self.position = position
+    def read_lines(self):
+        # Returns a list of complete lines and a list with the file
+        # position following each of them, or None at the end of file.
+        # A final line without a newline is not returned.
+        start = self.position
+        data = self.index.read(start, self.read_size)
+        end = data.rfind(b'\n') + 1
+        while not end:
+            # No complete line in the block, look further
+            more = self.index.read(start + len(data), self.read_size)
+            if not more:
+                return None
+            data += more
+            end = data.rfind(b'\n') + 1
+        data = data[:end]
+        text = data.decode(errors='replace')
+        pos = self.position
+        ends = []
+        if len(text) == len(data):
+            # Only single byte characters - offsets follow the text
+            lines = text.split('\n')
+            lines.pop()
+            for line in lines:
+                pos += len(line) + 1
+                ends.append(pos)
+        else:
+            raw_lines = data.split(b'\n')
+            raw_lines.pop()
+            lines = []
+            for raw_line in raw_lines:
+                pos += len(raw_line) + 1
+                ends.append(pos)
+                lines.append(raw_line.decode(errors='replace'))
+        self.position = pos
+        return lines, ends
 
 class VirtualSD:
     def __init__(self, config):
@@ -15,8 +156,9 @@ class VirtualSD:
         # sdcard state
         sd = config.get('path')
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
-        self.current_file = None
+        self.current_file = self.file_index = None
         self.file_position = self.file_size = 0
+        self.line_status = (None, 0, 0)
         # Print Stat Tracking
         self.print_stats = self.printer.load_object(config, 'print_stats')
         # Work timer
@@ -24,6 +166,14 @@ class VirtualSD:
         self.must_pause_work = self.cmd_from_sd = False
         self.next_file_position = 0
         self.work_timer = None
+        self.index_timer = self.reactor.register_timer(self.index_handler)
+        self.read_size = config.getint('read_size', DEFAULT_READ_SIZE,
+                                       minval=1024)
+        self.batch_size = config.getint('batch_size', DEFAULT_BATCH_SIZE,
+                                        minval=1)
+        # Preflight analysis results by file (see SDCARD_ANALYZE)
+        self.analysis_cache = {}
+        self.analyze_file = self.analyze_error = None
         # Error handling
         gcode_macro = self.printer.load_object(config, 'gcode_macro')
         self.on_error_gcode = gcode_macro.load_template(
@@ -40,14 +190,16 @@ class VirtualSD:
         self.gcode.register_command(
             "SDCARD_PRINT_FILE", self.cmd_SDCARD_PRINT_FILE,
             desc=self.cmd_SDCARD_PRINT_FILE_help)
+        self.gcode.register_command(
+            "SDCARD_ANALYZE", self.cmd_SDCARD_ANALYZE,
+            desc=self.cmd_SDCARD_ANALYZE_help)
     def handle_shutdown(self):
         if self.work_timer is not None:
             self.must_pause_work = True
             try:
                 readpos = max(self.file_position - 1024, 0)
                 readcount = self.file_position - readpos
-                self.current_file.seek(readpos)
-                data = self.current_file.read(readcount + 128)
+                data = self.file_index.read(readpos, readcount + 128)
             except:
                 logging.exception("virtual_sdcard shutdown read")
                 return
@@ -84,12 +236,27 @@ class VirtualSD:
                 logging.exception("virtual_sdcard get_file_list")
                 raise self.gcode.error("Unable to get file list")
     def get_status(self, eventtime):
+        file_line = file_lines = 0
+        index = self.file_index
+        if index is not None:
+            # NOTE: The line numbers are only looked up again when the
+            #       file or its position changed since the last status.
+            cache = self.line_status
+            if cache[0] is not index or cache[1] != self.file_position:
+                cache = self.line_status = (
+                    index, self.file_position,
+                    index.get_line_number(self.file_position))
+            file_line = cache[2]
+            file_lines = index.get_line_count()
         return {
             'file_path': self.file_path(),
             'progress': self.progress(),
             'is_active': self.is_active(),
             'file_position': self.file_position,
             'file_size': self.file_size,
+            'file_line': file_line,
+            'file_lines': file_lines,
+            'analyze_error': self.analyze_error,
         }
     def file_path(self):
         if self.current_file:
@@ -113,11 +280,14 @@ class VirtualSD:
         self.must_pause_work = False
         self.work_timer = self.reactor.register_timer(
             self.work_handler, self.reactor.NOW)
+    def _close_file(self):
+        self.current_file.close()
+        self.current_file = self.file_index = None
+        self.line_status = (None, 0, 0)
     def do_cancel(self):
         if self.current_file is not None:
             self.do_pause()
-            self.current_file.close()
-            self.current_file = None
+            self._close_file()
             self.print_stats.note_cancel()
         self.file_position = self.file_size = 0
     # G-Code commands
@@ -126,8 +296,7 @@ class VirtualSD:
     def _reset_file(self):
         if self.current_file is not None:
             self.do_pause()
-            self.current_file.close()
-            self.current_file = None
+            self._close_file()
         self.file_position = self.file_size = 0
         self.print_stats.reset()
         self.printer.send_event("virtual_sdcard:reset_file")
@@ -148,7 +317,94 @@ class VirtualSD:
         if filename[0] == '/':
             filename = filename[1:]
         self._load_file(gcmd, filename, check_subdirs=True)
+        line = gcmd.get_int('LINE', None, minval=1)
+        if line is not None:
+            self._set_file_line(gcmd, line)
         self.do_resume()
+    cmd_SDCARD_ANALYZE_help = "Report the bounds, estimated time and feed "\
+        "limits of a SD file without moving"
+    def cmd_SDCARD_ANALYZE(self, gcmd):
+        if self.work_timer is not None:
+            raise gcmd.error("SD busy")
+        filename = gcmd.get("FILENAME", None)
+        if filename is not None:
+            if filename[0] == '/':
+                filename = filename[1:]
+            fname = self._find_file(gcmd, filename, check_subdirs=True)
+        elif self.current_file is not None:
+            fname = self.current_file.name
+        else:
+            raise gcmd.error("No file selected")
+        # Results are reused until the file or the velocity limits change
+        toolhead = self.printer.lookup_object('toolhead')
+        try:
+            key = tuple(gcodeanalyze.file_key(fname)) + (
+                toolhead.max_velocity, toolhead.max_accel,
+                toolhead.requested_accel_to_decel,
+                toolhead.square_corner_velocity)
+        except OSError:
+            raise gcmd.error("Unable to open file")
+        result = self.analysis_cache.get(key)
+        if result is not None:
+            gcmd.respond_info("%s:\n%s" % (
+                os.path.basename(fname), gcodeanalyze.format_result(result)))
+            return
+        if self.analyze_file is not None:
+            raise gcmd.error("SD analysis already in progress")
+        # Analyze in the background so the gcode mutex is not held while
+        # a long file is processed
+        gcmd.respond_info("Analyzing %s" % (os.path.basename(fname),))
+        self.analyze_file = fname
+        self.analyze_error = None
+        self.reactor.register_callback(
+            lambda eventtime: self._analyze_file(fname, key))
+    def _analyze_file(self, fname, key):
+        try:
+            analyzer = self._create_analyzer()
+            with io.open(fname, 'rb') as f:
+                # Let other work run between chunks of a long file
+                reactor = self.reactor
+                pause = lambda: reactor.pause(reactor.monotonic() + .001)
+                result = analyzer.process_file(f, pause, ANALYZE_PAUSE_LINES)
+        except Exception as e:
+            logging.exception("virtual_sdcard analyze")
+            self.analyze_error = "Unable to analyze %s: %s" % (
+                os.path.basename(fname), str(e))
+            self.gcode.respond_info(self.analyze_error)
+            return
+        finally:
+            self.analyze_file = None
+        self.analysis_cache[key] = result
+        self.gcode.respond_info("%s:\n%s" % (os.path.basename(fname),
+                                             gcodeanalyze.format_result(result)))
+    def _create_analyzer(self):
+        # Use the limits and axis ranges of the configured machine
+        toolhead = self.printer.lookup_object('toolhead')
+        axis_names = toolhead.axis_names
+        axis_limits = []
+        ranges = {}
+        home_position = {}
+        for kin in toolhead.kinematics.values():
+            # Each set of axes limits its third axis (Z or C)
+            if hasattr(kin, 'max_z_velocity'):
+                axis = kin.axis[2]
+                axis_limits.append(gcodeanalyze.AxisLimit(
+                    axis, kin.max_z_velocity, kin.max_z_accel,
+                    'max_%s_velocity' % (axis_names[axis].lower(),)))
+            for rail, axis in zip(kin.rails, kin.axis):
+                a = axis_names[axis]
+                ranges[a] = rail.get_range()
+                home_position[a] = rail.get_homing_info().position_endstop
+        arc_options = {}
+        gcode_arcs = self.printer.lookup_object('gcode_arcs', None)
+        if gcode_arcs is not None:
+            arc_options['resolution'] = gcode_arcs.mm_per_arc_segment
+            arc_options['chord_tolerance'] = gcode_arcs.chord_tolerance
+        return gcodeanalyze.GCodeAnalyzer(
+            axis_names, toolhead.max_velocity, toolhead.max_accel,
+            toolhead.requested_accel_to_decel,
+            toolhead.square_corner_velocity, axis_limits, ranges,
+            home_position, arc_options)
     def cmd_M20(self, gcmd):
         # List SD card
         files = self.get_file_list()
@@ -168,7 +424,7 @@ class VirtualSD:
         if filename.startswith('/'):
             filename = filename[1:]
         self._load_file(gcmd, filename)
-    def _load_file(self, gcmd, filename, check_subdirs=False):
+    def _find_file(self, gcmd, filename, check_subdirs=False):
         files = self.get_file_list(check_subdirs)
         flist = [f[0] for f in files]
         files_by_lower = { fname.lower(): fname for fname, fsize in files }
@@ -176,20 +432,32 @@ class VirtualSD:
         try:
             if fname not in flist:
                 fname = files_by_lower[fname.lower()]
-            fname = os.path.join(self.sdcard_dirname, fname)
-            f = io.open(fname, 'r', newline='')
-            f.seek(0, os.SEEK_END)
-            fsize = f.tell()
-            f.seek(0)
+        except KeyError:
+            raise gcmd.error("Unable to open file")
+        return os.path.join(self.sdcard_dirname, fname)
+    def _load_file(self, gcmd, filename, check_subdirs=False):
+        fname = self._find_file(gcmd, filename, check_subdirs)
+        try:
+            f = io.open(fname, 'rb')
+            index = GCodeFileIndex(f)
+            fsize = index.size
         except:
             logging.exception("virtual_sdcard file open")
             raise gcmd.error("Unable to open file")
         gcmd.respond_raw("File opened:%s Size:%d" % (filename, fsize))
         gcmd.respond_raw("File selected")
         self.current_file = f
+        self.file_index = index
         self.file_position = 0
         self.file_size = fsize
         self.print_stats.set_current_file(filename)
+        self.reactor.update_timer(self.index_timer, self.reactor.NOW)
+    def index_handler(self, eventtime):
+        # Index the loaded file a block at a time to count its lines
+        index = self.file_index
+        if index is None or index.index_block():
+            return self.reactor.NEVER
+        return eventtime + INDEX_DELAY
     def cmd_M24(self, gcmd):
         # Start/resume SD print
         self.do_resume()
@@ -200,8 +468,20 @@ class VirtualSD:
         # Set SD position
         if self.work_timer is not None:
             raise gcmd.error("SD busy")
+        line = gcmd.get_int('L', None, minval=1)
+        if line is not None:
+            # Set position by line number (1 based)
+            if self.file_index is None:
+                raise gcmd.error("No file selected")
+            self._set_file_line(gcmd, line)
+            return
         pos = gcmd.get_int('S', minval=0)
         self.file_position = pos
+    def _set_file_line(self, gcmd, line):
+        pos = self.file_index.get_line_position(line - 1)
+        if pos is None:
+            raise gcmd.error("Line %d is past the end of the file" % (line,))
+        self.file_position = pos
     def cmd_M27(self, gcmd):
         # Report SD print status
         if self.current_file is None:
@@ -220,70 +500,87 @@ class VirtualSD:
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
         try:
-            self.current_file.seek(self.file_position)
+            reader = GCodeFileReader(self.file_index, self.file_position,
+                                     self.read_size)
         except:
             logging.exception("virtual_sdcard seek")
             self.work_timer = None
             return self.reactor.NEVER
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
-        lines = []
+        run_script = self.gcode.run_script_from_command
+        lines, ends = [], []
+        index = 0
         error_message = None
         while not self.must_pause_work:
-            if not lines:
+            if index >= len(lines):
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    data = reader.read_lines()
                 except:
                     logging.exception("virtual_sdcard read")
                     break
-                if not data:
+                if data is None:
                     # End of file
-                    self.current_file.close()
-                    self.current_file = None
+                    self._close_file()
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
+                lines, ends = data
+                index = 0
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
                 continue
-            # Dispatch command
+            # Dispatch a batch of commands with a single mutex acquisition
+            # NOTE: the batch ends early on a pause request, a change of
+            #       the file position, or when another request is waiting
+            #       for the gcode mutex.
             self.cmd_from_sd = True
-            line = lines.pop()
-            next_file_position = self.file_position + len(line) + 1
-            self.next_file_position = next_file_position
-            try:
-                self.gcode.run_script(line)
-            except self.gcode.error as e:
-                error_message = str(e)
-                try:
-                    self.gcode.run_script(self.on_error_gcode.render())
-                except:
-                    logging.exception("virtual_sdcard on_error")
-                break
-            except:
-                logging.exception("virtual_sdcard dispatch")
+            batch_end = min(index + self.batch_size, len(lines))
+            is_done = False
+            with gcode_mutex:
+                while index < batch_end:
+                    line = lines[index]
+                    next_file_position = ends[index]
+                    index += 1
+                    self.next_file_position = next_file_position
+                    try:
+                        run_script(line)
+                    except self.gcode.error as e:
+                        error_message = str(e)
+                        try:
+                            run_script(self.on_error_gcode.render())
+                        except:
+                            logging.exception("virtual_sdcard on_error")
+                        is_done = True
+                        break
+                    except:
+                        logging.exception("virtual_sdcard dispatch")
+                        is_done = True
+                        break
+                    self.file_position = self.next_file_position
+                    # Do we need to skip around?
+                    if self.next_file_position != next_file_position:
+                        try:
+                            reader = GCodeFileReader(
+                                self.file_index, self.file_position,
+                                self.read_size)
+                        except:
+                            logging.exception("virtual_sdcard seek")
+                            self.work_timer = None
+                            self.cmd_from_sd = False
+                            return self.reactor.NEVER
+                        lines, ends = [], []
+                        index = 0
+                        break
+                    if self.must_pause_work or gcode_mutex.has_waiters():
+                        break
+            if is_done:
                 break
             self.cmd_from_sd = False
-            self.file_position = self.next_file_position
-            # Do we need to skip around?
-            if self.next_file_position != next_file_position:
-                try:
-                    self.current_file.seek(self.file_position)
-                except:
-                    logging.exception("virtual_sdcard seek")
-                    self.work_timer = None
-                    return self.reactor.NEVER
-                lines = []
-                partial_input = ""
         logging.info("Exiting SD card print (position %d)", self.file_position)
         self.work_timer = None
         self.cmd_from_sd = False
@@ -11,6 +11,12 @@ class CommandError(Exception):
 Coord = collections.namedtuple('Coord', ('x', 'y', 'z', 'e', 'a', 'b', 'c'), 
                                defaults = (None,None,None,None,None,None,None))
 
+# Words recognized on plain G0/G1/G2/G3 lines by the dispatch fast path.
+# Move handlers receive their values in this order (see
+# GCodeDispatch.register_move_handler).
+MOVE_WORDS = "XYZABCEFIJKR"
+MOVE_WORD_INDEX = {w: i for i, w in enumerate(MOVE_WORDS)}
+
 class GCodeCommand:
     error = CommandError
     def __init__(self, gcode, command, commandline, params, need_ack: bool):
@@ -113,6 +119,7 @@ class GCodeDispatch:
         self.base_gcode_handlers = self.gcode_handlers = {}
         self.ready_gcode_handlers = {}
         self.mux_commands = {}
+        self.move_handlers = {}
         self.gcode_help = {}
         # Register commands needed before config file is loaded
         handlers = ['M110', 'M112', 'M115',
@@ -139,6 +146,7 @@ class GCodeDispatch:
                 del self.ready_gcode_handlers[cmd]
             if cmd in self.base_gcode_handlers:
                 del self.base_gcode_handlers[cmd]
+            self.move_handlers.pop(cmd, None)
             # logging.info("\n" + f"gcode: command '{cmd}' deleted.")
             return old_cmd
         if cmd in self.ready_gcode_handlers:
@@ -155,6 +163,25 @@ class GCodeDispatch:
         if desc is not None:
             self.gcode_help[cmd] = desc
 
+    def register_move_handler(self, cmd, move_func):
+        # NOTE: Plain G0/G1/G2/G3 lines are tokenized by a fast path in
+        #       "_process_commands". If a move handler is registered, it
+        #       is called as "move_func(gcmd, coords)", where "coords" is a
+        #       list with the float value (or None) of each of the words in
+        #       MOVE_WORDS. It is only used while "cmd" is still handled
+        #       by the function registered with "register_command".
+        if cmd not in self.move_cmds:
+            raise self.printer.config_error(
+                "gcode command %s can not have a move handler" % (cmd,))
+        if move_func is None:
+            self.move_handlers.pop(cmd, None)
+            return
+        func = self.ready_gcode_handlers.get(cmd)
+        if func is None:
+            raise self.printer.config_error(
+                "gcode command %s is not registered" % (cmd,))
+        self.move_handlers[cmd] = (func, move_func)
+
     def register_mux_command(self, cmd, key, value, func, desc=None):
         prev = self.mux_commands.get(cmd)
         if prev is None:
@@ -190,32 +217,69 @@ class GCodeDispatch:
         self._respond_state("Ready")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    move_cmds = ('G0', 'G1', 'G2', 'G3')
+    def _parse_move(self, words):
+        # Fast path for plain G0-G3 lines with space separated upper case
+        # words (no line number or checksum). Returns the "params" and the
+        # pre-parsed word values, or None to use the generic parser.
+        params = {'G': words[0][1:]}
+        coords = [None] * len(MOVE_WORDS)
+        for word in words[1:]:
+            w, v = word[0], word[1:]
+            i = MOVE_WORD_INDEX.get(w)
+            # NOTE: values such as "1E3" or "1_0" are valid python
+            #       floats, but are split differently by the generic
+            #       parser, leave them to it.
+            if i is None or not v or v.strip('0123456789.+-'):
+                return None
+            try:
+                coords[i] = float(v)
+            except ValueError:
+                return None
+            params[w] = v
+        return params, coords
     def _process_commands(self, commands, need_ack=True):
         # NOTE: "run_script" calls this method with "need_ack=False".
+        move_handlers = self.move_handlers
         for line in commands:
             # Ignore comments and leading/trailing spaces
             line = origline = line.strip()
             cpos = line.find(';')
             if cpos >= 0:
                 line = line[:cpos]
-            # Break line into parts and determine command
-            parts = self.args_r.split(line.upper())
-            numparts = len(parts)
-            cmd = ""
-            if numparts >= 3 and parts[1] != 'N':
-                cmd = parts[1] + parts[2].strip()
-            elif numparts >= 5 and parts[1] == 'N':
-                # Skip line number at start of command
-                cmd = parts[3] + parts[4].strip()
-            # Build gcode "params" dictionary
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(1, numparts, 2) }
+            move_func = None
+            words = line.split()
+            move_handler = move_handlers.get(words[0]) if words else None
+            if move_handler is not None:
+                cmd = words[0]
+                handler = self.gcode_handlers.get(cmd, self.cmd_default)
+                if move_handler[0] is handler:
+                    move = self._parse_move(words)
+                    if move is not None:
+                        params, coords = move
+                        move_func = move_handler[1]
+            if move_func is None:
+                # Break line into parts and determine command
+                parts = self.args_r.split(line.upper())
+                numparts = len(parts)
+                cmd = ""
+                if numparts >= 3 and parts[1] != 'N':
+                    cmd = parts[1] + parts[2].strip()
+                elif numparts >= 5 and parts[1] == 'N':
+                    # Skip line number at start of command
+                    cmd = parts[3] + parts[4].strip()
+                # Build gcode "params" dictionary
+                params = { parts[i]: parts[i+1].strip()
+                           for i in range(1, numparts, 2) }
+                handler = self.gcode_handlers.get(cmd, self.cmd_default)
             gcmd = GCodeCommand(gcode=self, command=cmd, commandline=origline, params=params, need_ack=need_ack)
             # Invoke handler for command
-            handler = self.gcode_handlers.get(cmd, self.cmd_default)
             try:
-                # The default is to call "cmd_default" as a "handler".
-                handler(gcmd)
+                if move_func is not None:
+                    move_func(gcmd, coords)
+                else:
+                    # The default is to call "cmd_default" as a "handler".
+                    handler(gcmd)
             except self.error as e:
                 # NOTE: "self.error" is an instance of "CommandError",
                 #       a simple subclass of "Exception".
@@ -0,0 +1,315 @@
+# Preflight analysis of g-code files (bounds, run time, feed limits)
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, math, collections
+import gcode, toolhead
+from extras import gcode_move, gcode_arcs
+
+# NOTE: The analyzer runs a file through a private GCodeDispatch and
+#       GCodeMove, so coordinate handling (G90/G91/G92, offsets, M220,
+#       arcs) matches a real print.  Moves end up in an AnalyzerToolHead
+#       that plans them with the regular lookahead queue but never
+#       generates steps, so no MCU is involved.
+
+class error(Exception):
+    pass
+
+class DummyMutex:
+    def __enter__(self):
+        pass
+    def __exit__(self, type, value, tb):
+        pass
+
+class DummyReactor:
+    def mutex(self):
+        return DummyMutex()
+
+class DummyTrace:
+    enabled = False
+
+class DummyExtruder:
+    def calc_junction(self, prev_move, move):
+        return move.max_cruise_v2
+
+# Minimal printer holding the analyzer objects and their event handlers
+class AnalyzerPrinter:
+    config_error = error
+    def __init__(self):
+        self.objects = {}
+        self.event_handlers = {}
+    def get_start_args(self):
+        return {}
+    def get_reactor(self):
+        return DummyReactor()
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+    def load_object(self, config, name, default=None):
+        return self.objects[name]
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+    def invoke_shutdown(self, msg):
+        pass
+    def request_exit(self, result):
+        pass
+
+# Config section stub returning values from a dict (or the defaults)
+class AnalyzerConfig:
+    def __init__(self, printer, options, sections=None):
+        self.printer = printer
+        self.options = options
+        self.sections = sections or {}
+    def get_printer(self):
+        return self.printer
+    def getsection(self, section):
+        return AnalyzerConfig(self.printer, self.sections.get(section, {}))
+    def get(self, option, default=None, **kw):
+        return self.options.get(option, default)
+    getint = getfloat = getboolean = getchoice = get
+
+# Per-axis speed limit (like the Z limit of cartesian kinematics)
+AxisLimit = collections.namedtuple('AxisLimit', [
+    'axis', 'max_velocity', 'max_accel', 'name'])
+
+# Toolhead replacement that plans moves and collects statistics
+class AnalyzerToolHead:
+    def __init__(self, axis_names, max_velocity, max_accel,
+                 max_accel_to_decel=None, square_corner_velocity=5.,
+                 axis_limits=(), ranges=None, home_position=None):
+        self.axis_names = axis_names
+        self.axis_count = axis_count = len(axis_names)
+        self.max_velocity = max_velocity
+        self.max_accel = max_accel
+        if max_accel_to_decel is None:
+            max_accel_to_decel = max_accel * .5
+        self.max_accel_to_decel = min(max_accel_to_decel, max_accel)
+        scv2 = square_corner_velocity**2
+        self.junction_deviation = scv2 * (math.sqrt(2.) - 1.) / max_accel
+        self.axis_limits = list(axis_limits)
+        self.ranges = ranges or {}
+        self.home_position = home_position or {}
+        self.extruder = DummyExtruder()
+        self.trace = DummyTrace()
+        self.trace_source = 0
+        self.move_queue = toolhead.MoveQueue(self)
+        self.commanded_pos = [0.] * (axis_count + 1)
+        # Statistics
+        self.line_number = 0
+        self.move_time = self.dwell_time = 0.
+        self.move_count = 0
+        self.requested_v = collections.deque()
+        self.axis_min = [None] * axis_count
+        self.axis_max = [None] * axis_count
+        self.need_start = True
+        self.out_of_range = {}
+        self.feed_limits = {'max_velocity': 0, 'accel': 0}
+        for limit in self.axis_limits:
+            self.feed_limits[limit.name] = 0
+        self.max_requested_velocity = 0.
+    # Toolhead interface used by GCodeMove
+    def get_position(self):
+        return list(self.commanded_pos)
+    def set_position(self, newpos):
+        self.move_queue.flush()
+        self.commanded_pos[:] = newpos
+        self.need_start = True
+    def move(self, newpos, speed):
+        move = toolhead.Move(self, self.commanded_pos, newpos, speed)
+        if not move.move_d:
+            return
+        if speed > self.max_requested_velocity:
+            self.max_requested_velocity = speed
+        if speed > self.max_velocity:
+            self.feed_limits['max_velocity'] += 1
+        if move.is_kinematic_move:
+            if self.need_start:
+                self._note_position(move.start_pos)
+                self.need_start = False
+            self._note_position(move.end_pos)
+            axes_d = move.axes_d
+            for limit in self.axis_limits:
+                if not axes_d[limit.axis]:
+                    continue
+                ratio = move.move_d / abs(axes_d[limit.axis])
+                if limit.max_velocity * ratio < min(speed, self.max_velocity):
+                    self.feed_limits[limit.name] += 1
+                move.limit_speed(limit.max_velocity * ratio,
+                                 limit.max_accel * ratio)
+        self.commanded_pos[:] = move.end_pos
+        self.requested_v.append(math.sqrt(move.max_cruise_v2))
+        self.move_queue.add_move(move)
+    def _note_position(self, pos):
+        axis_min, axis_max = self.axis_min, self.axis_max
+        for i in range(self.axis_count):
+            p = pos[i]
+            if axis_min[i] is None or p < axis_min[i]:
+                axis_min[i] = p
+            if axis_max[i] is None or p > axis_max[i]:
+                axis_max[i] = p
+            if i in self.out_of_range:
+                continue
+            r = self.ranges.get(self.axis_names[i])
+            if r is not None and (p < r[0] or p > r[1]):
+                self.out_of_range[i] = (self.line_number, p)
+    def _process_moves(self, moves):
+        requested_v = self.requested_v
+        for m in moves:
+            self.move_time += m.accel_t + m.cruise_t + m.decel_t
+            if m.cruise_v < requested_v.popleft() - .000001:
+                self.feed_limits['accel'] += 1
+        self.move_count += len(moves)
+    def dwell(self, delay):
+        self.move_queue.flush()
+        self.dwell_time += max(0., delay)
+    def wait_moves(self):
+        self.move_queue.flush()
+    def home(self, axes):
+        newpos = self.get_position()
+        for axis in axes:
+            newpos[axis] = self.home_position.get(self.axis_names[axis], 0.)
+        self.set_position(newpos)
+
+# Homing state passed to the "homing:home_rails_end" event
+class AnalyzerHomingState:
+    def __init__(self, axes):
+        self.axes = axes
+    def get_axes(self):
+        return self.axes
+
+# GCodeDispatch that records unknown commands instead of warning
+class AnalyzerDispatch(gcode.GCodeDispatch):
+    def __init__(self, printer):
+        gcode.GCodeDispatch.__init__(self, printer)
+        self.unknown_commands = {}
+    def cmd_default(self, gcmd):
+        cmd = gcmd.get_command()
+        if cmd:
+            self.unknown_commands[cmd] = self.unknown_commands.get(cmd, 0) + 1
+    def _respond_error(self, msg):
+        pass
+    def respond_raw(self, msg):
+        pass
+    def respond_info(self, msg, log=True):
+        pass
+
+class GCodeAnalyzer:
+    def __init__(self, axis_names, max_velocity, max_accel,
+                 max_accel_to_decel=None, square_corner_velocity=5.,
+                 axis_limits=(), ranges=None, home_position=None,
+                 arc_options=None):
+        self.printer = printer = AnalyzerPrinter()
+        self.gcode = AnalyzerDispatch(printer)
+        printer.objects['gcode'] = self.gcode
+        self.toolhead = AnalyzerToolHead(
+            axis_names, max_velocity, max_accel, max_accel_to_decel,
+            square_corner_velocity, axis_limits, ranges, home_position)
+        printer.objects['toolhead'] = self.toolhead
+        config = AnalyzerConfig(printer, {},
+                                {'printer': {'axis': axis_names}})
+        self.gcode_move = gcode_move.GCodeMove(config)
+        printer.objects['gcode_move'] = self.gcode_move
+        gcode_arcs.ArcSupport(AnalyzerConfig(printer, arc_options or {}))
+        for cmd in ['G4', 'G28', 'M400']:
+            self.gcode.register_command(cmd, getattr(self, 'cmd_' + cmd))
+        # Position reports need the real kinematics and do not move
+        for cmd in ['M114', 'GET_POSITION']:
+            self.gcode.register_command(cmd, None)
+            self.gcode.register_command(cmd, self.cmd_ignore)
+        printer.send_event("klippy:ready")
+        self.errors = []
+        self.line_count = 0
+    def cmd_G4(self, gcmd):
+        if 'S' in gcmd.get_command_parameters():
+            delay = gcmd.get_float('S', 0., minval=0.)
+        else:
+            delay = gcmd.get_float('P', 0., minval=0.) / 1000.
+        self.toolhead.dwell(delay)
+    def cmd_G28(self, gcmd):
+        axis_names = self.toolhead.axis_names
+        axes = [i for i, a in enumerate(axis_names)
+                if gcmd.get(a, None) is not None]
+        if not axes:
+            axes = list(range(len(axis_names)))
+        self.toolhead.home(axes)
+        self.printer.send_event("homing:home_rails_end",
+                                AnalyzerHomingState(axes), [])
+    def cmd_M400(self, gcmd):
+        self.toolhead.wait_moves()
+    def cmd_ignore(self, gcmd):
+        pass
+    def process_line(self, line):
+        self.line_count += 1
+        self.toolhead.line_number = self.line_count
+        try:
+            self.gcode._process_commands([line], need_ack=False)
+        except self.gcode.error as e:
+            self.errors.append((self.line_count, str(e)))
+        except Exception as e:
+            self.errors.append((self.line_count, "Internal error: %s" % (e,)))
+    def process_file(self, f, pause=None, pause_lines=10000):
+        # Process an open (binary) file, calling pause() periodically
+        for i, line in enumerate(f):
+            self.process_line(line.decode(errors='replace'))
+            if pause is not None and not i % pause_lines:
+                pause()
+        return self.get_result()
+    def get_result(self):
+        th = self.toolhead
+        th.move_queue.flush()
+        axes = {}
+        for i, a in enumerate(th.axis_names):
+            if th.axis_min[i] is not None:
+                axes[a] = [th.axis_min[i], th.axis_max[i]]
+        return {
+            'lines': self.line_count,
+            'moves': th.move_count,
+            'print_time': th.move_time + th.dwell_time,
+            'dwell_time': th.dwell_time,
+            'axes': axes,
+            'out_of_range': {th.axis_names[i]: list(v)
+                             for i, v in th.out_of_range.items()},
+            'feed_limits': dict(th.feed_limits),
+            'max_requested_velocity': th.max_requested_velocity,
+            'errors': [list(e) for e in self.errors[:MAX_ERRORS]],
+            'error_count': len(self.errors),
+            'unknown_commands': dict(self.gcode.unknown_commands),
+        }
+
+MAX_ERRORS = 10
+
+# Cache key of a file; results are reused while this does not change
+def file_key(filename):
+    st = os.stat(filename)
+    return [os.path.abspath(filename), st.st_mtime_ns, st.st_size]
+
+def format_time(seconds):
+    seconds = int(seconds + .5)
+    return "%d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60,
+                             seconds % 60)
+
+def format_result(result):
+    lines = ["Lines: %d  Moves: %d  Estimated time: %s (dwell %.1fs)" % (
+        result['lines'], result['moves'], format_time(result['print_time']),
+        result['dwell_time'])]
+    for a, (amin, amax) in sorted(result['axes'].items(),
+                                  key=lambda i: gcode.MOVE_WORDS.find(i[0])):
+        msg = "%s: min=%.3f max=%.3f" % (a, amin, amax)
+        if a in result['out_of_range']:
+            line, pos = result['out_of_range'][a]
+            msg += " OUT OF RANGE (%.3f on line %d)" % (pos, line)
+        lines.append(msg)
+    limits = ["%s=%d" % (n, c) for n, c in sorted(
+        result['feed_limits'].items()) if c]
+    lines.append("Max requested velocity: %.1f  Moves limited by: %s" % (
+        result['max_requested_velocity'], " ".join(limits) or "none"))
+    if result['unknown_commands']:
+        lines.append("Unhandled commands: %s" % (" ".join(
+            "%s(%d)" % (c, n) for c, n in sorted(
+                result['unknown_commands'].items())),))
+    for line, msg in result['errors']:
+        lines.append("Error on line %d: %s" % (line, msg))
+    if result['error_count'] > len(result['errors']):
+        lines.append("... %d more errors" % (
+            result['error_count'] - len(result['errors']),))
+    return "\n".join(lines)
@@ -36,7 +36,7 @@ class CartKinematics:
             rail.setup_itersolve('cartesian_stepper_alloc', axis.encode())
         for s in self.get_steppers():
             s.set_trapq(self.trapq)
-            toolhead.register_step_generator(s.generate_steps)
+            toolhead.register_stepper(s)
         self.printer.register_event_handler("stepper_enable:motor_off",
                                             self._motor_off)
         # Setup boundary checks
@@ -57,7 +57,7 @@ class CartKinematics:
             dc_rail = stepper.LookupMultiRail(dc_config)
             dc_rail.setup_itersolve('cartesian_stepper_alloc', dc_axis.encode())
             for s in dc_rail.get_steppers():
-                toolhead.register_step_generator(s.generate_steps)
+                toolhead.register_stepper(s)
             self.dual_carriage_rails = [
                 self.rails[self.dual_carriage_axis], dc_rail]
             self.printer.lookup_object('gcode').register_command(
@@ -141,7 +141,6 @@ class CartKinematics:
         self.limits = [(1.0, -1.0)] * 3
     
     def _check_endstops(self, move):
-        logging.info("\n\n" + f"cartesian._check_endstops: triggered on {self.axis_names}/{self.axis} move.\n\n")
         end_pos = move.end_pos
         for i, axis in enumerate(self.axis):
             if (move.axes_d[axis]
@@ -157,7 +156,6 @@ class CartKinematics:
     def check_move(self, move):
         limits = self.limits
         xpos, ypos = [move.end_pos[axis] for axis in self.axis[:2]]  # move.end_pos[:2]
-        logging.info("\n\n" + f"cartesian.check_move: checking move ending on xpos={xpos} and ypos={ypos}.\n\n")
         if (xpos < limits[0][0] or xpos > limits[0][1]
             or ypos < limits[1][0] or ypos > limits[1][1]):
             self._check_endstops(move)
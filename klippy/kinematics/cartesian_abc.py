@@ -77,21 +77,20 @@ class CartKinematicsABC(CartKinematics):
         self.rails = [stepper.LookupMultiRail(config.getsection('stepper_' + n))
                       for n in self.axis_names.lower()]
         
-        # NOTE: this must be "xyz" and not "abc", see "cartesian_stepper_alloc" in C code.
-        # for rail, axis in zip(self.rails, self.axis_names.lower()):
-        # TODO: Check if it needs to be length 3 every time.
-        xyz_axis_names = "xyz"[:len(self.axis_names)]  # Can be "xyz", "xy", or "x".
-        for rail, axis in zip(self.rails, xyz_axis_names):
+        # NOTE: "cartesian_stepper_alloc" accepts any of the nine trapq axes
+        #       (see "trapq_axis_index" in C code), selected here by the
+        #       absolute index of each axis in the toolhead position.
+        #       For example "a", "b" and "c" for axis indexes [3, 4, 5].
+        for rail, axis_id in zip(self.rails, self.axis_config):
+            axis = "xyzabcuvw"[axis_id]
             rail.setup_itersolve('cartesian_stepper_alloc', axis.encode())
         
         for s in self.get_steppers():
             s.set_trapq(self.trapq)
-            # TODO: check if this "generator" should be appended to 
-            #       the "self.step_generators" list in the toolhead,
-            #       or to the list in the new TrapQ.
-            #       Using the toolhead for now.
-            #       This object is used by "toolhead._update_move_time".
-            toolhead.register_step_generator(s.generate_steps)
+            # NOTE: All sets of axes share the toolhead's trapq, so the
+            #       steppers are registered with the toolhead, which
+            #       generates their steps in "_update_move_time".
+            toolhead.register_stepper(s)
         
         # Register a handler for turning off the steppers.
         self.printer.register_event_handler("stepper_enable:motor_off",
@@ -125,7 +124,7 @@ class CartKinematicsABC(CartKinematics):
         #     dc_rail = stepper.LookupMultiRail(dc_config)
         #     dc_rail.setup_itersolve('cartesian_stepper_alloc', dc_axis.encode())
         #     for s in dc_rail.get_steppers():
-        #         toolhead.register_step_generator(s.generate_steps)
+        #         toolhead.register_stepper(s)
         #     self.dual_carriage_rails = [
         #         self.rails[self.dual_carriage_axis], dc_rail]
         #     self.printer.lookup_object('gcode').register_command(
@@ -153,9 +152,12 @@ class CartKinematicsABC(CartKinematics):
         logging.info("\n\n" +
                      f"CartKinematicsABC.set_position: setting kinematic position of {len(self.rails)} rails " +
                      f"with newpos={newpos} and homing_axes={homing_axes}\n\n")
+        # NOTE: the stepper kinematics read their axis at its absolute
+        #       index, place the (length 3) position accordingly.
+        coord = [0.] * self.axis[0] + list(newpos)
         for i, rail in enumerate(self.rails):
             logging.info(f"\n\nCartKinematicsABC: setting newpos={newpos} on stepper: {rail.get_name()}\n\n")
-            rail.set_position(newpos)
+            rail.set_position(coord)
             if i in homing_axes:
                 logging.info(f"\n\nCartKinematicsABC: setting limits={rail.get_range()} on stepper: {rail.get_name()}\n\n")
                 self.limits[i] = rail.get_range()
@@ -193,7 +195,6 @@ class CartKinematicsABC(CartKinematics):
         self.limits = [(1.0, -1.0)] * len(self.axis)
     
     def _check_endstops(self, move):
-        logging.info("\n\n" + f"cartesian_abc._check_endstops: triggered on {self.axis_names}/{self.axis} move.\n\n")
         end_pos = move.end_pos
         for i, axis in enumerate(self.axis):
             if (move.axes_d[axis]
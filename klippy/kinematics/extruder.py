@@ -76,7 +76,7 @@ class ExtruderStepper:
                                    desc=self.cmd_SYNC_STEPPER_TO_EXTRUDER_help)
     def _handle_connect(self):
         toolhead = self.printer.lookup_object('toolhead')
-        toolhead.register_step_generator(self.stepper.generate_steps)
+        toolhead.register_stepper(self.stepper)
         self._set_pressure_advance(self.config_pa, self.config_smooth_time)
 
         # NOTE: Setup attributes for limit checks, useful for syringe extruders.
@@ -136,17 +136,13 @@ class ExtruderStepper:
 
         if self.can_home:
             # NOTE: Software limit checks, borrowed from "cartesian.py".
-            logging.info("\n\n" + f"extruder_stepper.check_move_limits: checking move ending on epos={epos}" + "\n\n")
             if (epos < self.limits[0][0] or epos > self.limits[0][1]):
                 self._check_endstops(move, e_axis)
-        else:
-            logging.info("\n\n" + f"extruder_stepper.check_move_limits: E stepper not home-able, skipping check on move ending on epos={epos}" + "\n\n")
         
     def _check_endstops(self, move, e_axis=3):
         """ExtruderStepper version of _check_endstops in toolhead.py"""
 
         # NOTE: Software limit checks, borrowed from "cartesian.py".
-        logging.info("\n\n" + f"extruder_stepper._check_endstops: move limit check triggered.\n\n")
         end_pos = move.end_pos[e_axis]
         
         # NOTE: Check if the extruder move is out of bounds.
@@ -158,9 +154,6 @@ class ExtruderStepper:
                 raise move.move_error(f"Must home extruder axis ({e_axis}) first.")
             # NOTE: Else raise a move error without a message.
             raise move.move_error()
-        else:
-            # NOTE: Everything seems fine.
-            logging.info(f"extruder_stepper._check_endstops: The extruder's move to {end_pos} on axis {e_axis} checks out.")
     
     def set_position(self, newpos_e, homing_e=False, print_time=None):
         """ExtruderStepper version of set_position in toolhead.py"""
@@ -460,7 +453,6 @@ class PrinterExtruder:
                           1., can_pressure_advance, 0.,
                           start_v, cruise_v, accel)
         self.last_position = move.end_pos[3]
-        logging.info(f"\n\nextruder: move.end_pos[3]={str(move.end_pos[3])}\n\n")
     def find_past_position(self, print_time):
         if self.extruder_stepper is None:
             return 0.
@@ -372,6 +372,9 @@ def main():
     opts.add_option("-d", "--dictionary", dest="dictionary", type="string",
                     action="callback", callback=arg_dictionary,
                     help="file to read for mcu protocol dictionary")
+    opts.add_option("--reactor", dest="reactor", type="choice",
+                    choices=sorted(reactor.REACTORS), default=None,
+                    help="event loop implementation (default is poll)")
     opts.add_option("--import-test", action="store_true",
                     help="perform an import module test")
     options, args = opts.parse_args()
@@ -394,6 +397,9 @@ def main():
     if options.debugoutput:
         start_args['debugoutput'] = options.debugoutput
         start_args.update(options.dictionary)
+    reactor_class = reactor.Reactor
+    if options.reactor is not None:
+        reactor_class = reactor.REACTORS[options.reactor]
     bglogger = None
     if options.logfile:
         start_args['log_file'] = options.logfile
@@ -449,7 +455,7 @@ def main():
         #       This reactor class allows one to schedule timers, 
         #       wait for input on file descriptors, and to "sleep" 
         #       the host code."
-        main_reactor = reactor.Reactor(gc_checking=True)
+        main_reactor = reactor_class(gc_checking=True)
         
         printer = Printer(main_reactor, bglogger, start_args)
         res = printer.run()
@@ -85,10 +85,34 @@ class CommandWrapper:
         if cmd_queue is None:
             cmd_queue = serial.get_default_command_queue()
         self._cmd_queue = cmd_queue
-        self._msgtag = msgparser.lookup_msgtag(msgformat) & 0xffffffff
+        msgtag = msgparser.lookup_msgtag(msgformat)
+        self._msgtag = msgtag & 0xffffffff
+        # Commands with only integer parameters are encoded in C
+        param_types = self._cmd.param_types
+        self._int_tag = None
+        if all([t.is_int for t in param_types]):
+            self._int_tag = [msgtag]
+        self._msg_len = len(param_types) + 1
     def send(self, data=(), minclock=0, reqclock=0):
+        if self._int_tag is not None:
+            self._serial.raw_send_ints(self._int_tag + list(data),
+                                       self._msg_len, 1, minclock, reqclock,
+                                       self._cmd_queue)
+            return
         cmd = self._cmd.encode(data)
         self._serial.raw_send(cmd, minclock, reqclock, self._cmd_queue)
+    def send_many(self, data_list, minclock=0, reqclock=0):
+        # Queue one message per entry of data_list
+        if self._int_tag is None:
+            for data in data_list:
+                self.send(data, minclock, reqclock)
+            return
+        msgs = []
+        for data in data_list:
+            msgs.extend(self._int_tag)
+            msgs.extend(data)
+        self._serial.raw_send_ints(msgs, self._msg_len, len(data_list),
+                                   minclock, reqclock, self._cmd_queue)
     def get_command_tag(self):
         return self._msgtag
 
@@ -201,8 +225,8 @@ class MCU_trsync:
                                     "trsync_state", self._oid)
         self._trsync_start_cmd.send([self._oid, clock, report_ticks,
                                      self.REASON_COMMS_TIMEOUT], reqclock=clock)
-        for s in self._steppers:
-            self._stepper_stop_cmd.send([s.get_oid(), self._oid])
+        self._stepper_stop_cmd.send_many([[s.get_oid(), self._oid]
+                                          for s in self._steppers])
         self._trsync_set_timeout_cmd.send([self._oid, expire_clock],
                                           reqclock=expire_clock)
     
@@ -895,6 +919,8 @@ class MCU:
         return self._name
     def register_response(self, cb, msg, oid=None):
         self._serial.register_response(cb, msg, oid)
+    def register_bulk_response(self, msg, oid=None):
+        return self._serial.register_bulk_response(msg, oid)
     def alloc_command_queue(self):
         return self._serial.alloc_command_queue()
     def lookup_command(self, msgformat, cq=None):
@@ -985,6 +1011,8 @@ class MCU:
     def get_shutdown_clock(self):
         return self._shutdown_clock
     
+    def get_steppersync(self):
+        return self._steppersync
     def flush_moves(self, print_time):
         if self._steppersync is None:
             return
@@ -1059,11 +1087,15 @@ def error_help(msg):
 def add_printer_objects(config):
     printer = config.get_printer()
     reactor = printer.get_reactor()
-    mainsync = clocksync.ClockSync(reactor)
-    printer.add_object('mcu', MCU(config.getsection('mcu'), mainsync))
+    estimators = {'decay': 'decay', 'window': 'window'}
+    mcu_config = config.getsection('mcu')
+    mainsync = clocksync.ClockSync(reactor, mcu_config.getchoice(
+        'clock_estimator', estimators, 'decay'))
+    printer.add_object('mcu', MCU(mcu_config, mainsync))
     for s in config.get_prefix_sections('mcu '):
-        printer.add_object(s.section, MCU(
-            s, clocksync.SecondarySync(reactor, mainsync)))
+        printer.add_object(s.section, MCU(s, clocksync.SecondarySync(
+            reactor, mainsync,
+            s.getchoice('clock_estimator', estimators, 'decay'))))
 
 def get_printer_mcu(printer, name):
     if name == 'mcu':
@@ -0,0 +1,129 @@
+# Low overhead binary tracing of motion planning events
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import struct, logging
+
+# Trace points are written in the motion hot path as:
+#
+#   if __debug__ and trace.enabled:
+#       trace.record(motiontrace.TP_MOVE, source, a0, a1, a2, a3, a4)
+#
+# When tracing is disabled this costs a single attribute test (no string
+# formatting and no logging queue traffic).  When klippy is started with
+# "python -O" the whole statement is removed by the bytecode compiler.
+#
+# Each record has a fixed binary layout: trace point id, source id,
+# sequence number and five double precision arguments.  Records are
+# stored in a preallocated ring buffer and can be written to disk with
+# the SET_MOTION_TRACE command and decoded offline with
+# scripts/motion_trace.py.
+
+RECORD = struct.Struct('<HHI5d')
+RECORD_SIZE = RECORD.size
+HEADER = struct.Struct('<8sIIII')
+TRACE_MAGIC = b'KMTRACE1'
+DEFAULT_SIZE = 16384
+
+# Trace point ids and the meaning of their arguments.  Keep in sync
+# with the TRACE_POINTS table in scripts/motion_trace.py.
+TP_MOVE = 1           # move_d, min_move_t, max_cruise_v2, accel, is_kin
+TP_JUNCTION = 2       # max_start_v2, max_smoothed_v2, cos_theta
+TP_SET_JUNCTION = 3   # start_v, cruise_v, end_v, accel_t+cruise_t+decel_t
+TP_FLUSH = 4          # queue_len, flush_count, lazy
+TP_PROCESS = 5        # print_time, next_move_time, move_count
+TP_UPDATE_TIME = 6    # print_time, sg_flush_time, free_time, mcu_flush_time
+TP_SET_POSITION = 7   # print_time, x, y, z, e
+TP_DRIP = 8           # print_time, next_print_time
+
+TRACE_POINT_NAMES = {
+    TP_MOVE: "move", TP_JUNCTION: "junction", TP_SET_JUNCTION: "set_junction",
+    TP_FLUSH: "flush", TP_PROCESS: "process_moves",
+    TP_UPDATE_TIME: "update_move_time", TP_SET_POSITION: "set_position",
+    TP_DRIP: "drip",
+}
+
+class MotionTrace:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.enabled = config.getboolean('motion_trace', False)
+        self.size = config.getint('motion_trace_size', DEFAULT_SIZE,
+                                  minval=16)
+        self.sources = []
+        self.buf = bytearray(self.size * RECORD_SIZE)
+        self.pos = self.seq = 0
+        self.pack_into = RECORD.pack_into
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command('SET_MOTION_TRACE', self.cmd_SET_MOTION_TRACE,
+                               desc=self.cmd_SET_MOTION_TRACE_help)
+    def register_source(self, name):
+        self.sources.append(name)
+        return len(self.sources) - 1
+    def record(self, tp, source, a0=0., a1=0., a2=0., a3=0., a4=0.):
+        pos = self.pos
+        self.pack_into(self.buf, pos * RECORD_SIZE, tp, source,
+                       self.seq & 0xffffffff, a0, a1, a2, a3, a4)
+        self.seq += 1
+        pos += 1
+        if pos >= self.size:
+            pos = 0
+        self.pos = pos
+    def reset(self, size=None):
+        if size is not None and size != self.size:
+            self.size = size
+            self.buf = bytearray(size * RECORD_SIZE)
+        else:
+            self.buf[:] = bytes(len(self.buf))
+        self.pos = self.seq = 0
+    def get_records(self):
+        # Return the raw ring buffer contents in chronological order
+        count = min(self.seq, self.size)
+        if self.seq <= self.size:
+            return bytes(self.buf[:count * RECORD_SIZE]), count
+        split = self.pos * RECORD_SIZE
+        return bytes(self.buf[split:] + self.buf[:split]), count
+    def dump(self, filename):
+        data, count = self.get_records()
+        names = '\n'.join(self.sources).encode()
+        with open(filename, 'wb') as f:
+            f.write(HEADER.pack(TRACE_MAGIC, RECORD_SIZE, count,
+                                self.seq & 0xffffffff, len(names)))
+            f.write(names)
+            f.write(data)
+        return count
+    def get_status(self, eventtime):
+        return {'enabled': self.enabled, 'size': self.size,
+                'records': min(self.seq, self.size)}
+    cmd_SET_MOTION_TRACE_help = "Enable, disable or dump the motion trace"
+    def cmd_SET_MOTION_TRACE(self, gcmd):
+        enable = gcmd.get_int('ENABLE', None, minval=0, maxval=1)
+        size = gcmd.get_int('SIZE', None, minval=16)
+        filename = gcmd.get('DUMP', None)
+        if filename is not None:
+            try:
+                count = self.dump(filename)
+            except (IOError, OSError):
+                logging.exception("Unable to write motion trace")
+                raise gcmd.error("Unable to write motion trace '%s'"
+                                 % (filename,))
+            gcmd.respond_info("Wrote %d motion trace records to %s"
+                              % (count, filename))
+        if size is not None or gcmd.get_int('RESET', 0, minval=0, maxval=1):
+            self.reset(size)
+        if enable is not None:
+            self.enabled = not not enable
+        if not __debug__ and self.enabled:
+            gcmd.respond_info("Motion trace points are compiled out"
+                              " (klippy was started with python -O)")
+        if enable is None and size is None and filename is None:
+            gcmd.respond_info("motion_trace: enabled=%d size=%d records=%d"
+                              % (self.enabled, self.size,
+                                 min(self.seq, self.size)))
+
+# Return the printer wide trace object, creating it on first use
+def lookup_motion_trace(config):
+    printer = config.get_printer()
+    trace = printer.lookup_object('motion_trace', None)
+    if trace is None:
+        trace = MotionTrace(config.getsection('printer'))
+        printer.add_object('motion_trace', trace)
+    return trace
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, queue
+import os, gc, select, math, time, logging, queue, heapq, bisect
 import greenlet
 import chelper, util
 
@@ -20,6 +20,92 @@ class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        self.stats = None
+
+# Upper limits (in seconds) of the callback execution time histogram
+STATS_BUCKETS = [.0001, .0005, .001, .005, .010, .050, .100, .500]
+
+def callback_name(callback):
+    owner = getattr(callback, '__self__', None)
+    if isinstance(owner, greenlet.greenlet):
+        return "greenlet"
+    func = getattr(callback, '__func__', callback)
+    return "%s.%s" % (getattr(func, '__module__', None),
+                      getattr(func, '__qualname__', repr(func)))
+
+# Execution time of a timer or fd callback
+class CallbackStats:
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+    def reset(self):
+        self.count = 0
+        self.total_time = self.max_time = self.max_late = 0.
+        self.histogram = [0] * (len(STATS_BUCKETS) + 1)
+    def get_status(self):
+        return {'count': self.count, 'total_time': self.total_time,
+                'max_time': self.max_time, 'max_late': self.max_late,
+                'histogram': list(self.histogram)}
+
+# Callback timing, greenlet switches and pause overshoot of a reactor.
+# The "interval_" values are reset by "reset_interval()" (once a second
+# by the statistics module).
+class ReactorStats:
+    def __init__(self):
+        self.callbacks = {}
+        self.by_code = {}
+        self.greenlet_switches = self.pause_count = 0
+        self.max_overshoot = 0.
+        self.reset_interval()
+    def reset_interval(self):
+        self.interval_max_time = self.interval_max_late = 0.
+        self.interval_max_overshoot = 0.
+        self.interval_max_name = None
+    def reset(self):
+        for cs in self.callbacks.values():
+            cs.reset()
+        self.greenlet_switches = self.pause_count = 0
+        self.max_overshoot = 0.
+        self.reset_interval()
+    def lookup(self, callback):
+        # The stats of a function are cached by its code object, so the
+        # name is only built the first time the function is registered
+        owner = getattr(callback, '__self__', None)
+        if isinstance(owner, greenlet.greenlet):
+            key = greenlet.greenlet
+        else:
+            func = getattr(callback, '__func__', callback)
+            key = getattr(func, '__code__', None)
+        cs = self.by_code.get(key)
+        if cs is not None:
+            return cs
+        name = callback_name(callback)
+        cs = self.callbacks.get(name)
+        if cs is None:
+            cs = self.callbacks[name] = CallbackStats(name)
+        if key is not None:
+            self.by_code[key] = cs
+        return cs
+    def note_callback(self, cs, start, end, late):
+        elapsed = end - start
+        cs.count += 1
+        cs.total_time += elapsed
+        cs.histogram[bisect.bisect_left(STATS_BUCKETS, elapsed)] += 1
+        if elapsed > cs.max_time:
+            cs.max_time = elapsed
+        if late > cs.max_late:
+            cs.max_late = late
+        if elapsed > self.interval_max_time:
+            self.interval_max_time = elapsed
+            self.interval_max_name = cs.name
+        if late > self.interval_max_late:
+            self.interval_max_late = late
+    def note_pause(self, overshoot):
+        self.pause_count += 1
+        if overshoot > self.max_overshoot:
+            self.max_overshoot = overshoot
+        if overshoot > self.interval_max_overshoot:
+            self.interval_max_overshoot = overshoot
 
 class ReactorCompletion:
     class sentinel: pass
@@ -46,7 +132,8 @@ class ReactorCompletion:
 class ReactorCallback:
     def __init__(self, reactor, callback, waketime):
         self.reactor = reactor
-        self.timer = reactor.register_timer(self.invoke, waketime)
+        self.timer = reactor.register_timer(self.invoke, waketime,
+                                            stats_callback=callback)
         self.callback = callback
         self.completion = ReactorCompletion(reactor)
     def invoke(self, eventtime):
@@ -60,6 +147,7 @@ class ReactorFileHandler:
         self.fd = fd
         self.read_callback = read_callback
         self.write_callback = write_callback
+        self.read_stats = self.write_stats = None
     def fileno(self):
         return self.fd
 
@@ -80,6 +168,8 @@ class ReactorMutex:
         self.unlock = self.__exit__
     def test(self):
         return self.is_locked
+    def has_waiters(self):
+        return not not self.queue
     def __enter__(self):
         if not self.is_locked:
             self.is_locked = True
@@ -124,14 +214,29 @@ class SelectReactor:
         self._g_dispatch = None
         self._greenlets = []
         self._all_greenlets = []
+        # Statistics
+        self._stats = ReactorStats()
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    def get_stats(self):
+        return self._stats
+    def get_greenlet_count(self):
+        return len(self._all_greenlets)
+    def _note_pause(self, waketime):
+        # Record how late a paused greenlet resumed after its waketime
+        overshoot = 0.
+        if waketime > self.NOW and waketime < self.NEVER:
+            overshoot = max(0., self.monotonic() - waketime)
+        self._stats.note_pause(overshoot)
     # Timers
     def update_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
         self._next_timer = min(self._next_timer, waketime)
-    def register_timer(self, callback, waketime=NEVER):
+    def register_timer(self, callback, waketime=NEVER, stats_callback=None):
+        # The execution time is reported under "stats_callback" if given
+        # (the callback wrapped by "callback")
         timer_handler = ReactorTimer(callback, waketime)
+        timer_handler.stats = self._stats.lookup(stats_callback or callback)
         timers = list(self._timers)
         timers.append(timer_handler)
         self._timers = timers
@@ -142,34 +247,42 @@ class SelectReactor:
         timers = list(self._timers)
         timers.pop(timers.index(timer_handler))
         self._timers = timers
+    def _idle_timeout(self, eventtime, busy):
+        # Return the wait time when no timer is due
+        if busy:
+            return 0.
+        if self._check_gc:
+            gi = gc.get_count()
+            if gi[0] >= 700:
+                # Reactor looks idle and gc is due - run it
+                gc_level = 0
+                if gi[1] >= 10:
+                    gc_level = 1
+                    if gi[2] >= 10:
+                        gc_level = 2
+                self._last_gc_times[gc_level] = eventtime
+                gc.collect(gc_level)
+                return 0.
+        return min(1., max(.001, self._next_timer - eventtime))
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
-            if busy:
-                return 0.
-            if self._check_gc:
-                gi = gc.get_count()
-                if gi[0] >= 700:
-                    # Reactor looks idle and gc is due - run it
-                    gc_level = 0
-                    if gi[1] >= 10:
-                        gc_level = 1
-                        if gi[2] >= 10:
-                            gc_level = 2
-                    self._last_gc_times[gc_level] = eventtime
-                    gc.collect(gc_level)
-                    return 0.
-            return min(1., max(.001, self._next_timer - eventtime))
+            return self._idle_timeout(eventtime, busy)
         self._next_timer = self.NEVER
         g_dispatch = self._g_dispatch
+        monotonic = self.monotonic
         for t in self._timers:
             waketime = t.waketime
             if eventtime >= waketime:
+                start = monotonic()
                 t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
+                t.waketime = new_waketime = t.callback(eventtime)
                 if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
+                    self._next_timer = min(self._next_timer, new_waketime)
                     self._end_greenlet(g_dispatch)
                     return 0.
+                self._stats.note_callback(t.stats, start, monotonic(),
+                                          start - waketime if waketime else 0.)
+                waketime = new_waketime
             self._next_timer = min(self._next_timer, waketime)
         return 0.
     # Callbacks and Completions
@@ -221,7 +334,9 @@ class SelectReactor:
             if self._g_dispatch is None:
                 return self._sys_pause(waketime)
             # Switch to _check_timers (via g.timer.callback return)
-            return self._g_dispatch.switch(waketime)
+            eventtime = self._g_dispatch.switch(waketime)
+            self._note_pause(waketime)
+            return eventtime
         # Pausing the dispatch greenlet - prepare a new greenlet to do dispatch
         if self._greenlets:
             g_next = self._greenlets.pop()
@@ -231,11 +346,14 @@ class SelectReactor:
         g_next.parent = g.parent
         g.timer = self.register_timer(g.switch, waketime)
         self._next_timer = self.NOW
+        self._stats.greenlet_switches += 1
         # Switch to _dispatch_loop (via _end_greenlet or direct)
         eventtime = g_next.switch()
         # This greenlet activated from g.timer.callback (via _check_timers)
+        self._note_pause(waketime)
         return eventtime
     def _end_greenlet(self, g_old):
+        self._stats.greenlet_switches += 1
         # Cache this greenlet for later use
         self._greenlets.append(g_old)
         self.unregister_timer(g_old.timer)
@@ -248,8 +366,15 @@ class SelectReactor:
     def mutex(self, is_locked=False):
         return ReactorMutex(self, is_locked)
     # File descriptors
-    def register_fd(self, fd, read_callback, write_callback=None):
+    def _new_file_handler(self, fd, read_callback, write_callback):
         file_handler = ReactorFileHandler(fd, read_callback, write_callback)
+        file_handler.read_stats = self._stats.lookup(read_callback)
+        if write_callback is not None:
+            file_handler.write_stats = self._stats.lookup(write_callback)
+        return file_handler
+    def register_fd(self, fd, read_callback, write_callback=None):
+        file_handler = self._new_file_handler(fd, read_callback,
+                                              write_callback)
         self.set_fd_wake(file_handler, True, False)
         return file_handler
     def unregister_fd(self, file_handler):
@@ -276,22 +401,28 @@ class SelectReactor:
         while self._process:
             timeout = self._check_timers(eventtime, busy)
             busy = False
-            res = select.select(self._read_fds, self.write_fds, [], timeout)
+            res = select.select(self._read_fds, self._write_fds, [], timeout)
             eventtime = self.monotonic()
             for fd in res[0]:
                 busy = True
+                start = self.monotonic()
                 fd.read_callback(eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
                     break
+                self._stats.note_callback(fd.read_stats, start,
+                                          self.monotonic(), 0.)
             for fd in res[1]:
                 busy = True
+                start = self.monotonic()
                 fd.write_callback(eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
                     break
+                self._stats.note_callback(fd.write_stats, start,
+                                          self.monotonic(), 0.)
         self._g_dispatch = None
     def run(self):
         if self._pipe_fds is None:
@@ -323,7 +454,8 @@ class PollReactor(SelectReactor):
         self._fds = {}
     # File descriptors
     def register_fd(self, fd, read_callback, write_callback=None):
-        file_handler = ReactorFileHandler(fd, read_callback, write_callback)
+        file_handler = self._new_file_handler(fd, read_callback,
+                                              write_callback)
         fds = self._fds.copy()
         fds[fd] = file_handler
         self._fds = fds
@@ -353,18 +485,25 @@ class PollReactor(SelectReactor):
             eventtime = self.monotonic()
             for fd, event in res:
                 busy = True
+                handler = self._fds[fd]
                 if event & (select.POLLIN | select.POLLHUP):
-                    self._fds[fd].read_callback(eventtime)
+                    start = self.monotonic()
+                    handler.read_callback(eventtime)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
                         break
+                    self._stats.note_callback(handler.read_stats, start,
+                                              self.monotonic(), 0.)
                 if event & select.POLLOUT:
-                    self._fds[fd].write_callback(eventtime)
+                    start = self.monotonic()
+                    handler.write_callback(eventtime)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
                         break
+                    self._stats.note_callback(handler.write_stats, start,
+                                              self.monotonic(), 0.)
         self._g_dispatch = None
 
 class EPollReactor(SelectReactor):
@@ -372,16 +511,24 @@ class EPollReactor(SelectReactor):
         SelectReactor.__init__(self, gc_checking)
         self._epoll = select.epoll()
         self._fds = {}
+        # NOTE: epoll rejects regular files (eg, the "-i" batch input),
+        #       those are always ready, as with poll.
+        self._file_events = {}
     # File descriptors
     def register_fd(self, fd, read_callback, write_callback=None):
-        file_handler = ReactorFileHandler(fd, read_callback, write_callback)
+        file_handler = self._new_file_handler(fd, read_callback,
+                                              write_callback)
         fds = self._fds.copy()
-        fds[fd] = read_callback
+        fds[fd] = file_handler
         self._fds = fds
-        self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
+        try:
+            self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
+        except PermissionError:
+            self._file_events[fd] = select.EPOLLIN
         return file_handler
     def unregister_fd(self, file_handler):
-        self._epoll.unregister(file_handler.fd)
+        if self._file_events.pop(file_handler.fd, None) is None:
+            self._epoll.unregister(file_handler.fd)
         fds = self._fds.copy()
         del fds[file_handler.fd]
         self._fds = fds
@@ -391,6 +538,9 @@ class EPollReactor(SelectReactor):
             flags |= select.EPOLLIN
         if is_writeable:
             flags |= select.EPOLLOUT
+        if file_handler.fd in self._file_events:
+            self._file_events[file_handler.fd] = flags & ~select.POLLHUP
+            return
         self._epoll.modify(file_handler, flags)
     # Main loop
     def _dispatch_loop(self):
@@ -400,24 +550,143 @@ class EPollReactor(SelectReactor):
         while self._process:
             timeout = self._check_timers(eventtime, busy)
             busy = False
-            res = self._epoll.poll(timeout)
+            file_res = [(fd, event) for fd, event
+                        in self._file_events.items() if event]
+            if file_res:
+                res = self._epoll.poll(0.) + file_res
+            else:
+                res = self._epoll.poll(timeout)
             eventtime = self.monotonic()
             for fd, event in res:
                 busy = True
+                handler = self._fds[fd]
                 if event & (select.EPOLLIN | select.EPOLLHUP):
-                    self._fds[fd].read_callback(eventtime)
+                    start = self.monotonic()
+                    handler.read_callback(eventtime)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
                         break
+                    self._stats.note_callback(handler.read_stats, start,
+                                              self.monotonic(), 0.)
                 if event & select.EPOLLOUT:
-                    self._fds[fd].write_callback(eventtime)
+                    start = self.monotonic()
+                    handler.write_callback(eventtime)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
                         break
+                    self._stats.note_callback(handler.write_stats, start,
+                                              self.monotonic(), 0.)
         self._g_dispatch = None
 
+# Timers kept in a binary heap ordered by waketime.  Updating a timer
+# pushes a new heap entry (O(log n)) and entries made stale by a later
+# update are dropped when they reach the top of the heap, so a dispatch
+# pass only visits the timers that are due.  As with SelectReactor, a
+# timer runs at most once per pass and timers due at the same time run
+# in the order they were scheduled.
+class HeapReactorTimer(ReactorTimer):
+    def __init__(self, callback, waketime):
+        ReactorTimer.__init__(self, callback, waketime)
+        self.registered = True
+        self.run_pass = 0
+
+class TimerHeapMixin:
+    def _setup_timer_heap(self):
+        self._timer_heap = []
+        self._timer_seq = 0
+        self._timer_pass = 0
+    def _push_timer(self, timer_handler, waketime):
+        self._timer_seq += 1
+        heapq.heappush(self._timer_heap,
+                       (waketime, self._timer_seq, timer_handler))
+        if len(self._timer_heap) > 2 * len(self._timers) + 64:
+            self._compact_timers()
+    def _compact_timers(self):
+        # Drop the stale entries left behind by timer updates (in place,
+        # a dispatch pass may be iterating over the heap)
+        heap = self._timer_heap
+        heap[:] = [e for e in heap
+                   if e[2].registered and e[0] == e[2].waketime]
+        heapq.heapify(heap)
+    # Timers
+    def update_timer(self, timer_handler, waketime):
+        if waketime == timer_handler.waketime:
+            return
+        timer_handler.waketime = waketime
+        if waketime != self.NEVER and timer_handler.registered:
+            self._push_timer(timer_handler, waketime)
+            self._next_timer = min(self._next_timer, waketime)
+    def register_timer(self, callback, waketime=_NEVER, stats_callback=None):
+        timer_handler = HeapReactorTimer(callback, self.NEVER)
+        timer_handler.stats = self._stats.lookup(stats_callback or callback)
+        self._timers.append(timer_handler)
+        self.update_timer(timer_handler, waketime)
+        return timer_handler
+    def unregister_timer(self, timer_handler):
+        timer_handler.waketime = self.NEVER
+        timer_handler.registered = False
+        self._timers.remove(timer_handler)
+    def _check_timers(self, eventtime, busy):
+        if eventtime < self._next_timer:
+            return self._idle_timeout(eventtime, busy)
+        heap = self._timer_heap
+        heappop = heapq.heappop
+        self._timer_pass += 1
+        run_pass = self._timer_pass
+        g_dispatch = self._g_dispatch
+        monotonic = self.monotonic
+        rerun = []
+        while heap and heap[0][0] <= eventtime:
+            entry = heappop(heap)
+            t = entry[2]
+            if entry[0] != t.waketime or not t.registered:
+                # Stale entry (timer updated or unregistered)
+                continue
+            if t.run_pass == run_pass:
+                # Already run in this pass - run again on the next pass
+                rerun.append(entry)
+                continue
+            t.run_pass = run_pass
+            start = monotonic()
+            t.waketime = self.NEVER
+            waketime = t.callback(eventtime)
+            t.waketime = self.NEVER
+            self.update_timer(t, waketime)
+            if g_dispatch is not self._g_dispatch:
+                self._finish_timer_pass(rerun)
+                self._end_greenlet(g_dispatch)
+                return 0.
+            self._stats.note_callback(t.stats, start, monotonic(),
+                                      start - entry[0] if entry[0] else 0.)
+        self._finish_timer_pass(rerun)
+        return 0.
+    def _finish_timer_pass(self, rerun):
+        heap = self._timer_heap
+        for entry in rerun:
+            heapq.heappush(heap, entry)
+        while heap and (heap[0][0] != heap[0][2].waketime
+                        or not heap[0][2].registered):
+            heapq.heappop(heap)
+        self._next_timer = heap[0][0] if heap else self.NEVER
+
+class HeapPollReactor(TimerHeapMixin, PollReactor):
+    def __init__(self, gc_checking=False):
+        PollReactor.__init__(self, gc_checking)
+        self._setup_timer_heap()
+
+class HeapEPollReactor(TimerHeapMixin, EPollReactor):
+    def __init__(self, gc_checking=False):
+        EPollReactor.__init__(self, gc_checking)
+        self._setup_timer_heap()
+
+# Reactors that may be selected at startup (see "klippy.py --reactor")
+REACTORS = {
+    'select': SelectReactor, 'poll': PollReactor, 'epoll': EPollReactor,
+    'heap-poll': HeapPollReactor, 'heap-epoll': HeapEPollReactor,
+}
+
 # Use the poll based reactor if it is available
 try:
     # NOTE: See: https://docs.python.org/3/library/select.html
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading, os
+import logging, threading, os, array
 import serial
 
 import msgproto, chelper, util
@@ -11,6 +11,92 @@ import msgproto, chelper, util
 class error(Exception):
     pass
 
+# Number of messages taken from the serialqueue per call
+PULL_BATCH = 16
+
+# Messages taken from a BulkDataBuffer; iterating returns a
+# (sequence, data) tuple per message
+class BulkData:
+    def __init__(self, sequences, lengths, data):
+        self.sequences = sequences
+        self.lengths = lengths
+        self.data = data
+    def __len__(self):
+        return len(self.sequences)
+    def __iter__(self):
+        data = self.data
+        pos = 0
+        for sequence, length in zip(self.sequences, self.lengths):
+            yield sequence, data[pos:pos+length]
+            pos += length
+
+# Storage for a high rate stream of "sequence" and "data" messages (such
+# as "adxl345_data") filled directly by the serial background thread
+class BulkDataBuffer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+    def _reset(self):
+        self.sequences = array.array('H')
+        self.lengths = array.array('B')
+        self.data = bytearray()
+    def add(self, sequence, data):
+        with self.lock:
+            self.sequences.append(sequence)
+            self.lengths.append(len(data))
+            self.data += data
+    def pull(self):
+        with self.lock:
+            bulk_data = BulkData(self.sequences, self.lengths, self.data)
+            self._reset()
+        return bulk_data
+    def clear(self):
+        with self.lock:
+            self._reset()
+
+# Compiled decoding of the responses described by a data dictionary
+class MessageDecoder:
+    def __init__(self, ffi_main, ffi_lib, msgparser):
+        self.decoder = ffi_main.gc(ffi_lib.msgdecoder_alloc(),
+                                   ffi_lib.msgdecoder_free)
+        # msgid -> (name, param_names, buffer_indexes, oid_index)
+        self.formats = {}
+        # msgid -> (sequence_index, data_index) of bulk data messages
+        self.bulk_formats = {}
+        # (msgid, oid) -> (bulk_buffer, handler) (see SerialReader._bg_thread)
+        self.handlers = {}
+        for msgid, mf in msgparser.messages_by_id.items():
+            types = self._lookup_types(mf)
+            if types is None:
+                continue
+            ffi_lib.msgdecoder_set_format(self.decoder, msgid, types.encode())
+            names = tuple([name for name, t in mf.param_names])
+            buffers = [i for i, c in enumerate(types) if c == 's']
+            oid_index = -1
+            if 'oid' in names:
+                oid_index = names.index('oid')
+            self.formats[msgid] = (mf.name, names, buffers, oid_index)
+            if 'sequence' in names and 'data' in names:
+                data_index = names.index('data')
+                if data_index in buffers:
+                    self.bulk_formats[msgid] = (names.index('sequence'),
+                                                data_index)
+    def _lookup_types(self, mf):
+        # Output formats and enumerations are left to MessageParser.parse
+        if not isinstance(mf, msgproto.MessageFormat):
+            return None
+        types = []
+        for t in mf.param_types:
+            if isinstance(t, msgproto.Enumeration):
+                return None
+            if t.is_dynamic_string:
+                types.append('s')
+            elif t.signed:
+                types.append('i')
+            else:
+                types.append('u')
+        return "".join(types)
+
 class SerialReader:
     def __init__(self, reactor, warn_prefix=""):
         self.reactor = reactor
@@ -20,6 +106,8 @@ class SerialReader:
         self.msgparser = msgproto.MessageParser(warn_prefix=warn_prefix)
         # C interface
         self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.msgdecoder = MessageDecoder(self.ffi_main, self.ffi_lib,
+                                         self.msgparser)
         self.serialqueue = None
         self.default_cmd_queue = self.alloc_command_queue()
         self.stats_buf = self.ffi_main.new('char[4096]')
@@ -28,35 +116,92 @@ class SerialReader:
         self.background_thread = None
         # Message handlers
         self.handlers = {}
+        self.bulk_buffers = {}
         self.register_response(self._handle_unknown_init, '#unknown')
         self.register_response(self.handle_output, '#output')
         # Sent message notification tracking
         self.last_notify_id = 0
         self.pending_notifications = {}
     def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
+        responses = self.ffi_main.new('struct pull_queue_message[%d]'
+                                      % (PULL_BATCH,))
+        msgbuf = self.ffi_main.buffer(responses)
+        msg_stride = self.ffi_main.sizeof('struct pull_queue_message')
+        values = self.ffi_main.new('int64_t[%d]' % (msgproto.MESSAGE_MAX,))
+        decode = self.ffi_lib.msgdecoder_decode
+        pull_batch = self.ffi_lib.serialqueue_pull_batch
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
-            if count < 0:
+            pull_count = pull_batch(self.serialqueue, responses, PULL_BATCH)
+            if pull_count < 0:
                 break
-            if response.notify_id:
-                params = {'#sent_time': response.sent_time,
-                          '#receive_time': response.receive_time}
-                completion = self.pending_notifications.pop(response.notify_id)
-                self.reactor.async_complete(completion, params)
-                continue
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
-            try:
+            for r in range(pull_count):
+                response = responses[r]
+                if response.notify_id:
+                    params = {'#sent_time': response.sent_time,
+                              '#receive_time': response.receive_time}
+                    completion = self.pending_notifications.pop(
+                        response.notify_id)
+                    self.reactor.async_complete(completion, params)
+                    continue
+                self._handle_response(response, r * msg_stride, msgbuf,
+                                      values, decode)
+    def _handle_response(self, response, base, msgbuf, values, decode):
+        count = response.len
+        msgdecoder = self.msgdecoder
+        msgid = decode(msgdecoder.decoder, response.msg, count,
+                       values, msgproto.MESSAGE_MAX)
+        try:
+            if msgid < 0:
+                # Not handled by the compiled decoder (output, enumerations,
+                # unknown or invalid messages)
+                params = self.msgparser.parse(response.msg[0:count])
+                hdl = (params['#name'], params.get('oid'))
+                bulk = self.bulk_buffers.get(hdl)
+                if bulk is not None:
+                    bulk.add(params['sequence'], params['data'])
+                    return
+                params['#sent_time'] = response.sent_time
+                params['#receive_time'] = response.receive_time
                 with self.lock:
                     hdl = self.handlers.get(hdl, self.handle_default)
                     hdl(params)
-            except:
-                logging.exception("%sException in serial callback",
-                                  self.warn_prefix)
+                return
+            name, names, buffers, oid_index = msgdecoder.formats[msgid]
+            oid = values[oid_index] if oid_index >= 0 else None
+            # NOTE: Handlers are cached by (msgid, oid), the cache is
+            #       reset by register_response().
+            key = (msgid, oid)
+            # NOTE: The handler is looked up and called under the lock, so
+            #       a handler is never called after it was unregistered.
+            with self.lock:
+                entry = msgdecoder.handlers.get(key)
+                if entry is None:
+                    hdl = (name, oid)
+                    bulk = self.bulk_buffers.get(hdl)
+                    if msgid not in msgdecoder.bulk_formats:
+                        bulk = None
+                    entry = msgdecoder.handlers[key] = (
+                        bulk, self.handlers.get(hdl, self.handle_default))
+                bulk, hdl = entry
+                if bulk is not None:
+                    # Store the data without building a params dict
+                    seq_index, data_index = msgdecoder.bulk_formats[msgid]
+                    v = values[data_index]
+                    pos = base + (v >> 8)
+                    bulk.add(values[seq_index], msgbuf[pos:pos + (v & 0xff)])
+                    return
+                params = dict(zip(names, values[0:len(names)]))
+                for i in buffers:
+                    v = values[i]
+                    pos = base + (v >> 8)
+                    params[names[i]] = msgbuf[pos:pos + (v & 0xff)]
+                params['#name'] = name
+                params['#sent_time'] = response.sent_time
+                params['#receive_time'] = response.receive_time
+                hdl(params)
+        except:
+            logging.exception("%sException in serial callback",
+                              self.warn_prefix)
     def _error(self, msg, *params):
         raise error(self.warn_prefix + (msg % params))
     def _get_identify_data(self, eventtime):
@@ -94,6 +239,8 @@ class SerialReader:
         msgparser = msgproto.MessageParser(warn_prefix=self.warn_prefix)
         msgparser.process_identify(identify_data)
         self.msgparser = msgparser
+        self.msgdecoder = MessageDecoder(self.ffi_main, self.ffi_lib,
+                                         msgparser)
         self.register_response(self.handle_unknown, '#unknown')
         # Setup baud adjust
         if serial_fd_type == b'c':
@@ -198,6 +345,8 @@ class SerialReader:
     def connect_file(self, debugoutput, dictionary, pace=False):
         self.serial_dev = debugoutput
         self.msgparser.process_identify(dictionary, decompress=False)
+        self.msgdecoder = MessageDecoder(self.ffi_main, self.ffi_lib,
+                                         self.msgparser)
         self.serialqueue = self.ffi_main.gc(
             self.ffi_lib.serialqueue_alloc(self.serial_dev.fileno(), b'f', 0),
             self.ffi_lib.serialqueue_free)
@@ -237,10 +386,27 @@ class SerialReader:
                 del self.handlers[name, oid]
             else:
                 self.handlers[name, oid] = callback
+            self.msgdecoder.handlers.clear()
+    def register_bulk_response(self, name, oid=None):
+        # Messages with "sequence" and "data" parameters are stored in
+        # the returned BulkDataBuffer instead of calling a handler
+        bulk = BulkDataBuffer()
+        with self.lock:
+            self.bulk_buffers[name, oid] = bulk
+            self.msgdecoder.handlers.clear()
+        return bulk
     # Command sending
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(self.serialqueue, cmd_queue,
                                       cmd, len(cmd), minclock, reqclock, 0)
+    def raw_send_ints(self, data, msg_len, count, minclock, reqclock,
+                      cmd_queue):
+        # Encode (in C) and queue "count" integer only messages
+        if len(data) != msg_len * count:
+            self._error("Invalid command parameters")
+        self.ffi_lib.serialqueue_send_ints(self.serialqueue, cmd_queue,
+                                           data, msg_len, count,
+                                           minclock, reqclock)
     def raw_send_wait_ack(self, cmd, minclock, reqclock, cmd_queue):
         self.last_notify_id += 1
         nid = self.last_notify_id
@@ -73,7 +73,12 @@ class MCU_stepper:
         #       produce a "stepper_kinematics" C object of type "r" or "a"
         #       ("radius" and "angle", respectively).
         ffi_main, ffi_lib = chelper.get_ffi()
-        sk = ffi_main.gc(getattr(ffi_lib, alloc_func)(*params), ffi_lib.free)
+        sk = getattr(ffi_lib, alloc_func)(*params)
+        if sk == ffi_main.NULL:
+            raise self._mcu.get_printer().config_error(
+                "Unable to setup kinematics of stepper '%s' (%s)"
+                % (self._name, alloc_func))
+        sk = ffi_main.gc(sk, ffi_lib.free)
         self.set_stepper_kinematics(sk)
     def _build_config(self):
         if self._step_pulse_duration is None:
@@ -131,8 +136,12 @@ class MCU_stepper:
         self._mcu.get_printer().send_event("stepper:set_dir_inverted", self)
     def calc_position_from_coord(self, coord):
         ffi_main, ffi_lib = chelper.get_ffi()
-        return ffi_lib.itersolve_calc_position_from_coord(
-            self._stepper_kinematics, coord[0], coord[1], coord[2])
+        # NOTE: the coordinate may hold any number of axes (for example
+        #       the full XYZABC toolhead position), each axis is passed
+        #       to the stepper kinematics at its absolute index.
+        coord = list(coord)
+        return ffi_lib.itersolve_calc_position_from_axes(
+            self._stepper_kinematics, coord, len(coord))
     
     def set_position(self, coord):
         logging.info("\n\n" + f"MCU_stepper.set_position: setting coord={coord} on stepper={self._name}\n\n")
@@ -146,7 +155,8 @@ class MCU_stepper:
 
         # NOTE: "itersolve_set_position" sets "sk->commanded_pos" (at itersolve.c)
         logging.info("\n\n" + f"MCU_stepper.set_position: calling itersolve_set_position\n\n")
-        ffi_lib.itersolve_set_position(sk, coord[0], coord[1], coord[2])
+        coord = list(coord)
+        ffi_lib.itersolve_set_position_axes(sk, coord, len(coord))
 
         # NOTE: "_set_mcu_position" uses "self.get_commanded_position" 
         #       and "itersolve_get_commanded_pos" to read "sk->commanded_pos" 
@@ -248,7 +258,7 @@ class MCU_stepper:
         return old_tq
     def add_active_callback(self, cb):
         self._active_callbacks.append(cb)
-    def generate_steps(self, flush_time):
+    def check_active(self, flush_time):
         # Check for activity if necessary
         if self._active_callbacks:
             sk = self._stepper_kinematics
@@ -258,6 +268,8 @@ class MCU_stepper:
                 self._active_callbacks = []
                 for cb in cbs:
                     cb(ret)
+    def generate_steps(self, flush_time):
+        self.check_active(flush_time)
         # Generate step times for a range of moves on the trapq
         sk = self._stepper_kinematics
         ret = self._itersolve_generate_steps(sk, flush_time)
@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math, logging, importlib
-import mcu, chelper, kinematics.extruder
+import mcu, stepper, chelper, motiontrace, kinematics.extruder
 import time
 from kinematics.extruder import PrinterExtruder
 
@@ -27,12 +27,23 @@ Within the host code, print times are generally stored in variables named print_
 
 # Class to track each move request
 class Move:
+    # NOTE: Moves are created for every G-code segment, so the attribute
+    #       set is fixed with "__slots__" to reduce the per-move allocation
+    #       and attribute access cost on dense toolpaths.
+    __slots__ = ('toolhead', 'start_pos', 'end_pos', 'accel',
+                 'junction_deviation', 'timing_callbacks',
+                 'is_kinematic_move', 'axis_names', 'axis_count',
+                 'axes_d', 'move_d', 'axes_r', 'min_move_t',
+                 'max_start_v2', 'max_cruise_v2', 'delta_v2',
+                 'max_smoothed_v2', 'smooth_delta_v2',
+                 'start_v', 'cruise_v', 'end_v',
+                 'accel_t', 'cruise_t', 'decel_t')
+    # NOTE: Linear moves have no arc (see "ArcMove" below).
+    arc = None
     def __init__(self, toolhead, start_pos, end_pos, speed):
-        logging.info(f"\n\nMove: setup with start_pos={start_pos} and end_pos={end_pos}\n\n")
-        
         self.toolhead = toolhead
-        self.start_pos = tuple(start_pos)
-        self.end_pos = tuple(end_pos)
+        self.start_pos = start_pos = tuple(start_pos)
+        self.end_pos = end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
         self.junction_deviation = toolhead.junction_deviation
         self.timing_callbacks = []
@@ -47,32 +58,31 @@ class Move:
         
         # NOTE: amount of non-extruder axes: XYZ=3, XYZABC=6.
         self.axis_names = toolhead.axis_names
-        self.axis_count = len(self.axis_names)
+        self.axis_count = axis_count = toolhead.axis_count
 
         # NOTE: Compute the components of the displacement vector.
         #       The last component is now the extruder.
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in range(self.axis_count + 1)]
+        self.axes_d = axes_d = [ep - sp for sp, ep in
+                                zip(start_pos[:axis_count + 1], end_pos)]
         
         # NOTE: compute the euclidean magnitude of the XYZ(ABC) displacement vector.
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:self.axis_count]]))
-        
-        logging.info(f"\n\nMove: setup with axes_d={axes_d} and move_d={move_d}.\n\n")
+        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:axis_count]]))
         
         # NOTE: If the move in XYZ is very small, then parse it as an extrude-only move.
         if move_d < .000000001:
             # Extrude only move
             
             # NOTE: the main axes wont move, thus end=stop.
-            self.end_pos = tuple([start_pos[i] for i in range(self.axis_count)])
             # NOTE: the extruder will move.
-            self.end_pos = self.end_pos + (end_pos[self.axis_count],)
+            self.end_pos = (tuple(start_pos[:axis_count])
+                            + (end_pos[axis_count],))
             
             # NOTE: set axis displacement to zero.
-            for i in range(self.axis_count):
+            for i in range(axis_count):
                 axes_d[i] = 0.
             
             # NOTE: set move distance to the extruder's displacement.
-            self.move_d = move_d = abs(axes_d[self.axis_count])
+            self.move_d = move_d = abs(axes_d[axis_count])
             
             # NOTE: set more stuff (?)
             inv_move_d = 0.
@@ -100,6 +110,12 @@ class Move:
         self.delta_v2 = 2.0 * move_d * self.accel
         self.max_smoothed_v2 = 0.
         self.smooth_delta_v2 = 2.0 * move_d * toolhead.max_accel_to_decel
+
+        trace = toolhead.trace
+        if __debug__ and trace.enabled:
+            trace.record(motiontrace.TP_MOVE, toolhead.trace_source,
+                         move_d, self.min_move_t, self.max_cruise_v2,
+                         self.accel, self.is_kinematic_move)
     
     def limit_speed(self, speed, accel):
         speed2 = speed**2
@@ -122,8 +138,6 @@ class Move:
         if not self.is_kinematic_move or not prev_move.is_kinematic_move:
             return
         
-        logging.info("\n\nMove calc_junction: function triggered.\n\n")
-        
         # Allow extruder to calculate its maximum junction
         # NOTE: Uses the "instant_corner_v" config parameter.
         extruder_v2 = self.toolhead.extruder.calc_junction(prev_move, self)
@@ -131,6 +145,11 @@ class Move:
         # Find max velocity using "approximated centripetal velocity"
         axes_r = self.axes_r
         prev_axes_r = prev_move.axes_r
+        # NOTE: Arcs turn along the move, use their tangents at the junction.
+        if self.arc is not None:
+            axes_r = self.arc.start_r
+        if prev_move.arc is not None:
+            prev_axes_r = prev_move.arc.end_r
         junction_cos_theta = -sum([ axes_r[0] * prev_axes_r[0] for i in range(self.axis_count) ])
         if junction_cos_theta > 0.999999:
             return
@@ -153,7 +172,11 @@ class Move:
         self.max_smoothed_v2 = min(self.max_start_v2, 
                                    prev_move.max_smoothed_v2 + prev_move.smooth_delta_v2)
         
-        logging.info("\n\nMove calc_junction: function end.\n\n")
+        trace = self.toolhead.trace
+        if __debug__ and trace.enabled:
+            trace.record(motiontrace.TP_JUNCTION, self.toolhead.trace_source,
+                         self.max_start_v2, self.max_smoothed_v2,
+                         junction_cos_theta)
     
     def set_junction(self, start_v2, cruise_v2, end_v2):
         """Move.set_junction() implements the "trapezoid generator" on a move.
@@ -167,9 +190,6 @@ class Move:
             cruise_v2 (_type_): _description_
             end_v2 (_type_): _description_
         """
-        
-        logging.info("\n\nMove set_junction: function triggered.\n\n")
-        
         # Determine accel, cruise, and decel portions of the move distance
         half_inv_accel = .5 / self.accel
         accel_d = (cruise_v2 - start_v2) * half_inv_accel
@@ -185,19 +205,162 @@ class Move:
         self.cruise_t = cruise_d / cruise_v
         self.decel_t = decel_d / ((end_v + cruise_v) * 0.5)
         
-        logging.info("\n\nMove set_junction: function end.\n\n")
+        trace = self.toolhead.trace
+        if __debug__ and trace.enabled:
+            trace.record(motiontrace.TP_SET_JUNCTION,
+                         self.toolhead.trace_source, start_v, cruise_v, end_v,
+                         self.accel_t + self.cruise_t + self.decel_t)
+
+# Geometry of a circular move in the plane of two axes
+class MoveArc:
+    __slots__ = ('axis0', 'axis1', 'center', 'radius', 'angle', 'angle_r',
+                 'start_r', 'end_r')
+    def __init__(self, axis0, axis1, center, radius, angle, angle_r,
+                 start_r, end_r):
+        self.axis0 = axis0
+        self.axis1 = axis1
+        self.center = center
+        self.radius = radius
+        self.angle = angle
+        self.angle_r = angle_r
+        self.start_r = start_r
+        self.end_r = end_r
+
+# A G2/G3 arc queued as a single move (see "ToolHead.arc_move").  The
+# "axis0" and "axis1" coordinates turn by "angular_travel" radians
+# around "center", the remaining axes (helical and extruder) move
+# linearly.  The move distance is the length of the (helical) path.
+class ArcMove(Move):
+    __slots__ = ('arc',)
+    def __init__(self, toolhead, start_pos, end_pos, speed,
+                 axis0, axis1, center, angular_travel):
+        self.toolhead = toolhead
+        self.start_pos = start_pos = tuple(start_pos)
+        # End exactly on the circle, so that the next move starts where
+        # the step generator leaves the arc axes.
+        r0 = start_pos[axis0] - center[0]
+        r1 = start_pos[axis1] - center[1]
+        radius = math.hypot(r0, r1)
+        start_angle = math.atan2(r1, r0)
+        end_angle = start_angle + angular_travel
+        end_pos = list(end_pos)
+        end_pos[axis0] = center[0] + radius * math.cos(end_angle)
+        end_pos[axis1] = center[1] + radius * math.sin(end_angle)
+        self.end_pos = end_pos = tuple(end_pos)
+        self.accel = accel = toolhead.max_accel
+        self.junction_deviation = toolhead.junction_deviation
+        self.timing_callbacks = []
+        velocity = min(speed, toolhead.max_velocity)
+        self.is_kinematic_move = True
+        self.axis_names = toolhead.axis_names
+        self.axis_count = axis_count = toolhead.axis_count
+        self.axes_d = axes_d = [ep - sp for sp, ep in
+                                zip(start_pos[:axis_count + 1], end_pos)]
+        # Path length: the flat arc combined with the linear axes
+        linear_d2 = sum([d*d for i, d in enumerate(axes_d[:axis_count])
+                         if i != axis0 and i != axis1])
+        self.move_d = move_d = math.sqrt(
+            (radius * angular_travel)**2 + linear_d2)
+        if not move_d:
+            return
+        inv_move_d = 1. / move_d
+        # The arc axes are not linear, the trapq evaluates them from
+        # the arc parameters (see "trapq_append_arc" in trapq.c).
+        self.axes_r = axes_r = [d * inv_move_d for d in axes_d]
+        axes_r[axis0] = axes_r[axis1] = 0.
+        angle_r = angular_travel * inv_move_d
+        tangent_v = radius * angle_r
+        start_r = list(axes_r)
+        start_r[axis0] = -tangent_v * math.sin(start_angle)
+        start_r[axis1] = tangent_v * math.cos(start_angle)
+        end_r = list(axes_r)
+        end_r[axis0] = -tangent_v * math.sin(end_angle)
+        end_r[axis1] = tangent_v * math.cos(end_angle)
+        self.arc = MoveArc(axis0, axis1, tuple(center), radius, start_angle,
+                           angle_r, start_r, end_r)
+        self.min_move_t = move_d / velocity
+        self.max_start_v2 = 0.
+        self.max_cruise_v2 = velocity**2
+        self.delta_v2 = 2.0 * move_d * accel
+        self.max_smoothed_v2 = 0.
+        self.smooth_delta_v2 = 2.0 * move_d * toolhead.max_accel_to_decel
+        # Keep the centripetal acceleration within max_accel
+        self.limit_speed(math.sqrt(accel * radius), accel)
+        trace = toolhead.trace
+        if __debug__ and trace.enabled:
+            trace.record(motiontrace.TP_MOVE, toolhead.trace_source,
+                         move_d, self.min_move_t, self.max_cruise_v2,
+                         self.accel, self.is_kinematic_move)
+    def get_extremes(self):
+        # Return the positions where the arc reaches its furthest
+        # point along one of its axes (for range checks)
+        arc = self.arc
+        end_angle = arc.angle + arc.angle_r * self.move_d
+        lo, hi = sorted([arc.angle, end_angle])
+        quarter = .5 * math.pi
+        points = []
+        k = math.ceil(lo / quarter)
+        while k * quarter <= hi:
+            angle = k * quarter
+            dist = (angle - arc.angle) / arc.angle_r
+            pos = [sp + r * dist for sp, r in zip(self.start_pos,
+                                                  self.axes_r)]
+            pos[arc.axis0] = arc.center[0] + arc.radius * math.cos(angle)
+            pos[arc.axis1] = arc.center[1] + arc.radius * math.sin(angle)
+            points.append(pos)
+            k += 1
+        return points
+
+# Pause of the motion queued on the lookahead (see "register_lookahead_delay").
+# It does not move, so the moves around it stop at its junctions, and its
+# duration is only set once the lookahead reaches it.
+class DelayMove:
+    is_kinematic_move = False
+    arc = None
+    def __init__(self, toolhead):
+        self.toolhead = toolhead
+        self.start_pos = self.end_pos = tuple(toolhead.commanded_pos)
+        self.axes_d = [0.] * (toolhead.axis_count + 1)
+        self.move_d = self.min_move_t = 0.
+        self.max_start_v2 = self.max_cruise_v2 = self.delta_v2 = 0.
+        self.max_smoothed_v2 = self.smooth_delta_v2 = 0.
+        self.timing_callbacks = []
+        self.delay = 0.
+        self.set_junction(0., 0., 0.)
+    def calc_junction(self, prev_move):
+        pass
+    def set_delay(self, delay):
+        self.delay = self.cruise_t = delay
+    def set_junction(self, start_v2, cruise_v2, end_v2):
+        self.start_v = self.cruise_v = self.end_v = 0.
+        self.accel_t = self.decel_t = 0.
+        self.cruise_t = self.delay
 
 LOOKAHEAD_FLUSH_TIME = 0.250
 
 # Class to track a list of pending move requests and to facilitate
 # "look-ahead" across moves to reduce acceleration between moves.
 class MoveQueue:
-    def __init__(self, toolhead):
+    def __init__(self, toolhead, native_planner=False):
         self.toolhead = toolhead
         self.queue = []
+        # NOTE: Optionally run the junction velocity planning pass in C
+        #       (see "lookahead_planner" in the [printer] config section).
+        self.lookahead_flush = None
+        if native_planner:
+            self.ffi_main, ffi_lib = chelper.get_ffi()
+            self.lookahead_flush = ffi_lib.lookahead_flush
+        # NOTE: Column store of the lookahead limits of each queued move,
+        #       kept in step with "queue". Each entry is a tuple of:
+        #       (max_start_v2, delta_v2, max_smoothed_v2, smooth_delta_v2,
+        #       max_cruise_v2). These values are final once the move has
+        #       been added, so "flush" reads them from here in a single
+        #       pass instead of doing several attribute lookups per move.
+        self.limits = []
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
     def reset(self):
         del self.queue[:]
+        del self.limits[:]
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
     def set_flush_time(self, flush_time):
         self.junction_flush = flush_time
@@ -211,19 +374,54 @@ class MoveQueue:
         Args:
             lazy (bool, optional): _description_. Defaults to False.
         """
-        # NOTE: logging for tracing activity
-        logging.info("\n\nMoveQueue flush: function triggered.\n\n")
         # NOTE: called by "add_move" when: 
         #       "Enough moves have been queued to reach the target flush time."
         #       Also called by "flush_step_generation".
         
         self.junction_flush = LOOKAHEAD_FLUSH_TIME  # Hardcoded value of "0.250"
         
+        queue = self.queue
+        if self.lookahead_flush is not None:
+            flush_count = self._plan_native(lazy)
+        else:
+            flush_count = self._plan(lazy)
+
+        # NOTE: Here "flush_count" is checked to trigger an "early return",
+        #       which would skip sending moves to _process_moves (and removing them
+        #       from this MoveQueue). The planner returns zero when "lazy=True"
+        #       and "peak_cruise_v2" is not yet known ("update_flush_count").
+        # NOTE: The other sufficient condition is that the "flush_count" is zero,
+        #       which can happen if the queue was originally empty (¿or perhaps if
+        #       the peak cruise speed was found on the second move?).
+        trace = self.toolhead.trace
+        if __debug__ and trace.enabled:
+            trace.record(motiontrace.TP_FLUSH, self.toolhead.trace_source,
+                         len(queue), flush_count, lazy)
+        if not flush_count:
+            return
+
+        # Generate step times for all moves ready to be flushed
+        # NOTE: The clock time when these moves will be executed is not yet explicit,
+        #       it will be calculated  by "_process_moves", and then updated with
+        #       a call to "_update_move_time".
+        # NOTE: "flush_count" can only have been made possibly smaller by
+        #       setting "lazy=True" from the start. This means that a "regular"
+        #       call to flush will try to remove all
+        self.toolhead._process_moves(moves=queue[:flush_count])
+
+        # Remove processed moves from the queue
+        del queue[:flush_count]
+        del self.limits[:flush_count]
+
+    def _plan(self, lazy):
+        # NOTE: Returns the number of moves at the start of the queue that
+        #       are ready to be flushed (or zero if none are ready yet).
         # NOTE: True when "flush" was called by "add_move", in which case
         #       "junction_flush" used to be negative (and was just reset above).
         update_flush_count = lazy
         
         queue = self.queue
+        limits = self.limits
         
         # NOTE: 
         flush_count = len(queue)
@@ -234,29 +432,30 @@ class MoveQueue:
         delayed = []
         next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
         for i in range(flush_count-1, -1, -1):  # i.e.: "start", "stop", "step".
-            move = queue[i]
+            (max_start_v2, delta_v2, max_smoothed_v2, smooth_delta_v2,
+             max_cruise_v2) = limits[i]
             
             # NOTE: "delta_v2" is the maximum amount of this squared-velocity that
             #       can change in this move. "next_end_v2" is initialized to "0" and then
             #       holds "start_v2" of the move that follows (for the remaining iterations).
             # NOTE: Calculate the abosolute maximum (square) speed that can be reached,
             #       by adding the speed change of this move to the start speed of the ¿next?
-            reachable_start_v2 = next_end_v2 + move.delta_v2
+            reachable_start_v2 = next_end_v2 + delta_v2
             # NOTE: "max_start_v2" of the current move is a "speed limit" for the junction
             #       between the moves. Here "start_v2" is set to the minimum between this
             #       maximum juction speed, and the reachable junction speed (makes sense).
-            start_v2 = min(move.max_start_v2, reachable_start_v2)
+            start_v2 = min(max_start_v2, reachable_start_v2)
             
             # NOTE: The math above is now repeated for the 
             #       "smoothed versions" of the speeds.
-            reachable_smoothed_v2 = next_smoothed_v2 + move.smooth_delta_v2
-            smoothed_v2 = min(move.max_smoothed_v2, reachable_smoothed_v2)
+            reachable_smoothed_v2 = next_smoothed_v2 + smooth_delta_v2
+            smoothed_v2 = min(max_smoothed_v2, reachable_smoothed_v2)
 
             # NOTE: Check if the "max_smoothed_v2" junction speed
             #       was smaller that "reachable_smoothed_v2" just now.
             if smoothed_v2 < reachable_smoothed_v2:
                 # It's possible for this move to accelerate
-                if (smoothed_v2 + move.smooth_delta_v2 > next_smoothed_v2 or delayed):
+                if (smoothed_v2 + smooth_delta_v2 > next_smoothed_v2 or delayed):
                     # This move can either decelerate 
                     # and/or is a "full accel" move after a "full decel" move (¿delayed?).
                     if update_flush_count and peak_cruise_v2:
@@ -269,7 +468,7 @@ class MoveQueue:
                         #       that this will trigger "when peak_cruise_v2 is known".
                         flush_count = i
                         update_flush_count = False
-                    peak_cruise_v2 = min(move.max_cruise_v2, (smoothed_v2 + reachable_smoothed_v2) * .5)
+                    peak_cruise_v2 = min(max_cruise_v2, (smoothed_v2 + reachable_smoothed_v2) * .5)
                     if delayed:
                         # Propagate peak_cruise_v2 to any delayed moves
                         if not update_flush_count and i < flush_count:
@@ -290,39 +489,34 @@ class MoveQueue:
                     # NOTE: "i < flush_count" is true by initialization, but may
                     #       be false if "flush_count" was equated to "i" above.
                     cruise_v2 = min(0.5 * (start_v2 + reachable_start_v2), 
-                                    move.max_cruise_v2, peak_cruise_v2)
-                    move.set_junction(start_v2=min(start_v2, cruise_v2), 
-                                      cruise_v2=cruise_v2, 
-                                      end_v2=min(next_end_v2, cruise_v2))
+                                    max_cruise_v2, peak_cruise_v2)
+                    queue[i].set_junction(start_v2=min(start_v2, cruise_v2),
+                                          cruise_v2=cruise_v2,
+                                          end_v2=min(next_end_v2, cruise_v2))
             else:
                 # Delay calculating this move until peak_cruise_v2 is known
-                delayed.append((move, start_v2, next_end_v2))
+                delayed.append((queue[i], start_v2, next_end_v2))
             next_end_v2 = start_v2
             next_smoothed_v2 = smoothed_v2
-        
-        # NOTE: Here "update_flush_count" is checked to trigger an "early return",
-        #       which would skip sending moves to _process_moves (and removing them
-        #       from this MoveQueue). "update_flush_count" is True when "lazy=True",
-        #       and it remains True if "peak_cruise_v2" is not yet known.
-        # NOTE: The other sufficient condition is that the "flush_count" is zero,
-        #       which can happen if the queue was originally empty (¿or perhaps if
-        #       the peak cruise speed was found on the second move?).
-        if update_flush_count or not flush_count:
-            logging.info(f"\n\nMoveQueue flush: _process_moves skipped due to update_flush_count={update_flush_count} or not flush_count={flush_count}\n\n")
-            return
-        
-        # Generate step times for all moves ready to be flushed
-        # NOTE: The clock time when these moves will be executed is not yet explicit,
-        #       it will be calculated  by "_process_moves", and then updated with
-        #       a call to "_update_move_time".
-        logging.info("\n\nMoveQueue flush: calling _process_moves.\n\n")
-        # NOTE: "flush_count" can only have been made possibly smaller by 
-        #       setting "lazy=True" from the start. This means that a "regular"
-        #       call to flush will try to remove all
-        self.toolhead._process_moves(moves=queue[:flush_count])
+        if update_flush_count:
+            return 0
+        return flush_count
 
-        # Remove processed moves from the queue
-        del queue[:flush_count]
+    def _plan_native(self, lazy):
+        # NOTE: C version of "_plan" (see chelper/lookahead.c).
+        queue = self.queue
+        count = len(queue)
+        junctions = self.ffi_main.new('struct lookahead_junction[]', count)
+        flush_count = self.lookahead_flush(
+            self.ffi_main.new('struct lookahead_limits[]', self.limits),
+            junctions, count, lazy)
+        for i in range(flush_count):
+            jn = junctions[i]
+            if jn.cruise_v2 >= 0.:
+                queue[i].set_junction(start_v2=jn.start_v2,
+                                      cruise_v2=jn.cruise_v2,
+                                      end_v2=jn.end_v2)
+        return flush_count
 
     def add_move(self, move):
         """MoveQueue.add_move() places the move object on the "look-ahead" queue.
@@ -330,18 +524,21 @@ class MoveQueue:
         Args:
             move (Move): A new Move object.
         """
-        logging.info(f"\n\nMoveQueue.add_move: adding move.\n\n")
-        self.queue.append(move)
+        queue = self.queue
+        queue.append(move)
         
         # NOTE: The move queue is not flushed automatically when the 
         #       new move is the only move in the queue.
-        if len(self.queue) == 1:
+        if len(queue) > 1:
+            # NOTE: "calc_junction" is called on the move, and passed the previous move,
+            #       to calculate the values of "max_start_v2" and "max_smoothed_v2" of the
+            #       new move.
+            move.calc_junction(queue[-2])
+        self.limits.append((move.max_start_v2, move.delta_v2,
+                            move.max_smoothed_v2, move.smooth_delta_v2,
+                            move.max_cruise_v2))
+        if len(queue) == 1:
             return
-        
-        # NOTE: "calc_junction" is called on the move, and passed the previous move,
-        #       to calculate the values of "max_start_v2" and "max_smoothed_v2" of the
-        #       new move.
-        move.calc_junction(self.queue[-2])
         # NOTE: "junction_flush" is initialized at 0.250 (see LOOKAHEAD_FLUSH_TIME),
         #       here it is decremented by "min_move_t" of the arriving move. If the
         #       result is less than zero, this signals a "flush" automatically.
@@ -376,6 +573,132 @@ class TrapQ:
         self.trapq_finalize_moves = ffi_lib.trapq_finalize_moves
         self.step_generators = []
 
+# Helper to append moves to, and expire moves from, the trapqs of all the
+# kinematic groups of a toolhead (e.g. "XYZ" and "ABC") in a single call.
+class MultiTrapQ:
+    def __init__(self, kinematics):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        kins = list(kinematics.values())
+        # NOTE: kinematic groups may share a single trapq (see "load_axes"),
+        #       each distinct trapq is only listed once.
+        trapqs = []
+        for kin in kins:
+            if kin.trapq not in trapqs:
+                trapqs.append(kin.trapq)
+        self.count = len(trapqs)
+        self.trapqs = ffi_main.new('struct trapq *[]', trapqs)
+        # NOTE: Each trapq carries the toolhead axes at their absolute
+        #       index (axis "A" is trapq axis 3, and so on), so that the
+        #       stepper kinematics of any group can read its own axes.
+        self.axis_count = 0
+        if kins:
+            self.axis_count = max([max(kin.axis) for kin in kins]) + 1
+        # NOTE: Data for each move is laid out as expected by
+        #       "trapq_append_multi" (see trapq.c): 7 move values followed
+        #       by the start position and the axes ratios for every trapq.
+        self.stride = 7 + 2 * self.axis_count * self.count
+        self.trapq_append_multi = ffi_lib.trapq_append_multi
+        self.trapq_finalize_moves_multi = ffi_lib.trapq_finalize_moves_multi
+        self.trapq_set_position_axes = ffi_lib.trapq_set_position_axes
+        self.trapq_append_arc = ffi_lib.trapq_append_arc
+    def add_move(self, data, print_time, move):
+        if move.arc is not None:
+            # NOTE: Arcs can not be batched, queue the pending moves first.
+            self.append_moves(data)
+            del data[:]
+            self.add_arc_move(print_time, move)
+            return
+        data.extend((print_time, move.accel_t, move.cruise_t, move.decel_t,
+                     move.start_v, move.cruise_v, move.accel))
+        axis_count, count = self.axis_count, self.count
+        data.extend(move.start_pos[:axis_count] * count)
+        data.extend(move.axes_r[:axis_count] * count)
+    def add_arc_move(self, print_time, move):
+        arc = move.arc
+        axis_count = self.axis_count
+        start_pos = list(move.start_pos[:axis_count])
+        start_pos[arc.axis0], start_pos[arc.axis1] = arc.center
+        axes_r = move.axes_r[:axis_count]
+        for i in range(self.count):
+            self.trapq_append_arc(
+                self.trapqs[i], print_time,
+                move.accel_t, move.cruise_t, move.decel_t,
+                start_pos, axes_r, axis_count,
+                move.start_v, move.cruise_v, move.accel,
+                arc.axis0, arc.axis1, arc.radius, arc.angle, arc.angle_r)
+    def append_moves(self, data):
+        if data and self.count:
+            self.trapq_append_multi(self.trapqs, self.count, self.axis_count,
+                                    data, len(data) // self.stride)
+    def finalize_moves(self, print_time):
+        self.trapq_finalize_moves_multi(self.trapqs, self.count, print_time)
+    def set_position(self, print_time, newpos):
+        pos = list(newpos[:self.axis_count])
+        for i in range(self.count):
+            self.trapq_set_position_axes(self.trapqs[i], print_time,
+                                         pos, len(pos))
+
+# Helper to generate the steps of the toolhead steppers and flush them to
+# the mcus.  The steppers of each mcu are handled on their own native
+# thread (see stepflush.c), so multiple mcus are processed in parallel.
+class StepFlush:
+    def __init__(self, mcus):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.mcus = mcus
+        self.steppers = []
+        self.stepflush = None
+        self.steppersyncs = []
+        self.sks = []
+        self.flush_clocks = ffi_main.new('int64_t[]', len(mcus))
+        self.results = ffi_main.new('int32_t[]', len(mcus))
+        self.stepflush_flush = ffi_lib.stepflush_flush
+        self.stepflush_set_stepper = ffi_lib.stepflush_set_stepper
+    def add_steppers(self, steppers):
+        self.steppers.extend(steppers)
+        self.stepflush = None
+    def _build(self):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.stepflush = sf = ffi_main.gc(ffi_lib.stepflush_alloc(),
+                                          ffi_lib.stepflush_free)
+        self.steppersyncs = [m.get_steppersync() for m in self.mcus]
+        for ss in self.steppersyncs:
+            ffi_lib.stepflush_add_mcu(sf, ffi_main.NULL if ss is None else ss)
+        self.sks = []
+        for s in self.steppers:
+            sk = s.get_stepper_kinematics()
+            ffi_lib.stepflush_add_stepper(sf, self.mcus.index(s.get_mcu()),
+                                          ffi_main.NULL if sk is None else sk)
+            self.sks.append(sk)
+    def flush(self, flush_time, mcu_flush_time):
+        mcus = self.mcus
+        steppersyncs = [m.get_steppersync() for m in mcus]
+        if self.stepflush is None or steppersyncs != self.steppersyncs:
+            self._build()
+        # NOTE: Stepper kinematics may be replaced at run time (for
+        #       example by input shaping or FORCE_MOVE).
+        sks = self.sks
+        for i, s in enumerate(self.steppers):
+            s.check_active(flush_time)
+            sk = s.get_stepper_kinematics()
+            if sk is not sks[i]:
+                sks[i] = sk
+                self.stepflush_set_stepper(self.stepflush, i, sk)
+        flush_clocks = self.flush_clocks
+        for i, m in enumerate(mcus):
+            clock = -1
+            if steppersyncs[i] is not None:
+                clock = m.print_time_to_clock(mcu_flush_time)
+            flush_clocks[i] = clock
+        ret = self.stepflush_flush(self.stepflush, flush_time, flush_clocks,
+                                   self.results)
+        if ret:
+            for i, m in enumerate(mcus):
+                if self.results[i] == 1:
+                    raise stepper.error("Internal error in stepcompress")
+                if self.results[i]:
+                    raise mcu.error("Internal error in MCU '%s' stepcompress"
+                                    % (m.get_name(),))
+
 # Main code to track events (and their timing) on the printer toolhead
 class ToolHead:
     """Main toolhead class.
@@ -409,12 +732,15 @@ class ToolHead:
         self.all_mcus = [
             m for n, m in self.printer.lookup_objects(module='mcu')]
         self.mcu = self.all_mcus[0]
+        self.step_flush = StepFlush(self.all_mcus)
         self.can_pause = True
         if self.mcu.is_fileoutput():
             # NOTE: This triggers if 'debugoutput' is not None in the config,
             #       see "mcu.py".
             self.can_pause = False
-        self.move_queue = MoveQueue(self)
+        planners = {'python': False, 'c': True}
+        self.move_queue = MoveQueue(self, native_planner=config.getchoice(
+            'lookahead_planner', planners, 'python'))
         self.commanded_pos = [0.0 for i in range(self.axis_count + 1)]
         self.printer.register_event_handler("klippy:shutdown",
                                             self._handle_shutdown)
@@ -466,6 +792,10 @@ class ToolHead:
         self.print_stall = 0
         self.drip_completion = None
         
+        # Motion planning trace points (see motiontrace.py)
+        self.trace = motiontrace.lookup_motion_trace(config)
+        self.trace_source = self.trace.register_source(self.name)
+
         # Kinematic step generation scan window time tracking
         self.kin_flush_delay = SDS_CHECK_TIME
         self.kin_flush_times = []
@@ -494,6 +824,7 @@ class ToolHead:
         # NOTE: Load trapq (iterative solvers) and kinematics for the requested axes.
         self.kinematics = {}
         self.load_axes(config=config)
+        self.kin_trapqs = MultiTrapQ(self.kinematics)
         
         # Create extruder kinematics class
         # NOTE: setup a dummy extruder at first, replaced later if configured.
@@ -523,13 +854,20 @@ class ToolHead:
         Args:
             config (_type_): Klipper configuration object.
         """
+        # NOTE: All sets of axes share a single trapq, which holds up to
+        #       nine axes per move (see "trapq.h"). Stepper kinematics pick
+        #       their axis from it by its absolute index.
+        ffi_main, ffi_lib = chelper.get_ffi()
+        trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+
         # Setup XYZ axes
         if "XYZ" in self.axis_names:
-            # Create XYZ kinematics class, and its XYZ trapq (iterative solver).
+            # Create XYZ kinematics class, using the shared trapq (iterative solver).
             self.kin, self.trapq = self.setup_kinematics(config=config, 
                                                          config_name='kinematics',
                                                          axis_set_letters="XYZ",
-                                                         axes_ids = [0, 1, 2])
+                                                         axes_ids = [0, 1, 2],
+                                                         trapq=trapq)
             # Save the kinematics to the dict.
             self.kinematics["XYZ"] = self.kin
         else:
@@ -537,18 +875,20 @@ class ToolHead:
         
         # Setup ABC axes
         if "ABC" in self.axis_names:
-            # Create ABC kinematics class, and its ABC trapq (iterative solver).
+            # Create ABC kinematics class, using the shared trapq (iterative solver).
             self.kin_abc, self.abc_trapq = self.setup_kinematics(config=config, 
                                                                  config_name='kinematics_abc',
                                                                  axes_ids=[3, 4 ,5],
-                                                                 axis_set_letters="ABC")
+                                                                 axis_set_letters="ABC",
+                                                                 trapq=trapq)
             # Save the kinematics to the dict.
             self.kinematics["ABC"] = self.kin_abc
         else:
             self.kin_abc, self.abc_trapq = None, None
     
     # Load kinematics object
-    def setup_kinematics(self, config, axes_ids, config_name='kinematics', axis_set_letters="XYZ"):
+    def setup_kinematics(self, config, axes_ids, config_name='kinematics', axis_set_letters="XYZ",
+                         trapq=None):
         """Load kinematics for a set of axes.
 
         Note: this requires the Kinematics module to accept a "trapq" object,
@@ -562,6 +902,7 @@ class ToolHead:
             axes_ids (list): List of integers spevifying which of the "toolhead position" elements correspond to the axes of the new kinematic.
             config_name (str, optional): Name of the kinematics setting in the config. Defaults to 'kinematics'.
             axis_set_letters (str, optional): Letters identifying each of the three axes in the set. Defaults to 'XYZ'.
+            trapq (trapq, optional): Trapq shared with other sets of axes. A new one is allocated if None.
 
         Returns:
             CartKinematics: Kinematics object.
@@ -576,8 +917,9 @@ class ToolHead:
             raise config.error(msg)
         
         # Create a Trapq for the kinematics
-        ffi_main, ffi_lib = chelper.get_ffi()
-        trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)  # TrapQ()
+        if trapq is None:
+            ffi_main, ffi_lib = chelper.get_ffi()
+            trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)  # TrapQ()
         
         # Set up the kinematics object
         try:
@@ -612,12 +954,10 @@ class ToolHead:
         #       "itersolve" queue in small time chunks (probably to 
         #       "Generate steps for moves" )
         # NOTE: It also calls "trapq_finalize_moves" on the extruder and toolhead,
-        #       "flush_moves" on all MCUs, and "generate_steps" on all steppers.
+        #       and generates and flushes the steps of all MCUs (see "StepFlush").
         # NOTE: Called by "flush_step_generation", "_process_moves", 
         #       "dwell", and "_update_drip_move_time".
-        
-        logging.info(f"\n\nToolHead: _update_move_time triggered with next_print_time={next_print_time}\n\n")
-
+        trace = self.trace
         kin_flush_delay = self.kin_flush_delay
         # TODO: what is "fft"? It used to be named "last_kin_flush_time".
         fft = self.force_flush_time
@@ -631,11 +971,17 @@ class ToolHead:
             #       "self.force_flush_time", unless it is later than "print_time-kin_flush_delay".
             sg_flush_time = max(fft, self.print_time - kin_flush_delay)
             for sg in self.step_generators:
-                # NOTE: "self.step_generators" has been populated with "generate_steps" functions,
-                #       one per stepper, by each kinematic class (including the extruder class).
-                #       Those functions in turn end up calling "ffi_lib.itersolve_generate_steps"
-                #       which are meant to "Generate step times for a range of moves on the trapq".
+                # NOTE: "self.step_generators" holds the step generators that
+                #       are not plain steppers. The "generate_steps" functions
+                #       of steppers and rails are handled by "self.step_flush".
                 sg(sg_flush_time)
+
+            mcu_flush_time = max(fft, sg_flush_time - self.move_flush_time)
+            # NOTE: Generate step times for a range of moves on the trapq
+            #       (see "itersolve_generate_steps") and transmit any scheduled
+            #       steps prior to the given 'mcu_flush_time' (see stepcompress.c).
+            #       Each MCU is handled on its own thread (see stepflush.c).
+            self.step_flush.flush(sg_flush_time, mcu_flush_time)
                 
             # NOTE: Expire moves in the trapq before the "free_time" time.
             #       This is defined as "self.force_flush_time", unless it is
@@ -645,11 +991,8 @@ class ToolHead:
             # NOTE: Update move times on the toolhead's trapqs, meaning:
             #       "Expire any moves older than `free_time` from
             #       the trapezoid velocity queue" (see trapq.c).
-            for axes in list(self.kinematics):
-                # Iterate over ["XYZ", "ABC"].
-                kin = self.kinematics[axes]
-                logging.info(f"\n\nToolHead._update_move_time calling trapq_finalize_moves on axes={axes} with free_time={free_time}\n\n")
-                self.trapq_finalize_moves(kin.trapq, free_time)
+            #       This is done for all kinematic groups in one call.
+            self.kin_trapqs.finalize_moves(free_time)
             
             # NOTE: "free_time" is smaller than "sg_flush_time" by "kin_flush_delay",
             #       which is defined from "SDS_CHECK_TIME".
@@ -665,14 +1008,12 @@ class ToolHead:
             # NOTE: Update move times on the extruder by calling
             #       "trapq_finalize_moves" in PrinterExtruder.
             self.extruder.update_move_time(free_time)
-
-            mcu_flush_time = max(fft, sg_flush_time - self.move_flush_time)
-            for m in self.all_mcus:
-                # NOTE: The following may find and transmit any scheduled steps 
-                #       prior to the given 'mcu_flush_time' (see stepcompress.c
-                #       and "flush_moves" in mcu.py).
-                m.flush_moves(mcu_flush_time)
             
+            if __debug__ and trace.enabled:
+                trace.record(motiontrace.TP_UPDATE_TIME, self.trace_source,
+                             self.print_time, sg_flush_time, free_time,
+                             mcu_flush_time)
+
             # NOTE: The loop breaks when the update print_time is 
             #       greater than the requested update time.
             if self.print_time >= next_print_time:
@@ -751,9 +1092,6 @@ class ToolHead:
         #       the "flush" method in a "MoveQueue" class instance.
         #       The "moves" argument receives a "queue" of moves "ready to be flushed".
         
-        # NOTE: logging for tracing activity
-        logging.info("\n\nToolHead _process_moves: function triggered.\n\n")
-        
         # Resync print_time if necessary
         if self.special_queuing_state:
             if self.special_queuing_state != "Drip":
@@ -766,7 +1104,6 @@ class ToolHead:
             # NOTE Update "self.print_time".
             self._calc_print_time()
             # NOTE: Also sends a "toolhead:sync_print_time" event.
-            logging.info(f"\n\nToolHead _process_moves: self.print_time={str(self.print_time)}\n\n")
         
         # Queue moves into trapezoid motion queue (trapq)
         # NOTE: the "trapq" is possibly something like a CFFI object.
@@ -774,24 +1111,17 @@ class ToolHead:
         #       object the one responsible for sending commands to
         #       the MCUs.
         next_move_time = self.print_time
+        kin_trapqs = self.kin_trapqs
+        kin_data = []
         for move in moves:
-            logging.info(f"ToolHead _process_moves: next_move_time={str(next_move_time)}")
-            
-            for axes in list(self.kinematics):
-                # Iterate over["XYZ", "ABC"]
-                logging.info("\n\n" + f"toolhead._process_moves: appending move to {axes} trapq.\n\n")
-                kin = self.kinematics[axes]
-                # NOTE: The moves are first placed on a "trapezoid motion queue" with trapq_append.
-                if move.is_kinematic_move:
-                    self.trapq_append(
-                        kin.trapq, next_move_time,
-                        move.accel_t, move.cruise_t, move.decel_t,
-                        # NOTE: "kin.axis" is used to select the position value that corresponds
-                        #       to the current kinematic axis (e.g. kin.axis is [0,1,2] for the XYZ axis,
-                        #       or [3,4,5] for the ABC axis).
-                        move.start_pos[kin.axis[0]], move.start_pos[kin.axis[1]], move.start_pos[kin.axis[2]],
-                        move.axes_r[kin.axis[0]], move.axes_r[kin.axis[1]], move.axes_r[kin.axis[2]],
-                        move.start_v, move.cruise_v, move.accel)
+            # NOTE: The moves are first placed on a "trapezoid motion queue".
+            #       They are gathered here and appended to the trapq of every
+            #       kinematic group (e.g. "XYZ" and "ABC") with a single call
+            #       to "trapq_append_multi" below. "kin.axis" is used to select
+            #       the position values of each group (e.g. kin.axis is [0,1,2]
+            #       for the XYZ axis, or [3,4,5] for the ABC axis).
+            if move.is_kinematic_move:
+                kin_trapqs.add_move(kin_data, next_move_time, move)
             
             # NOTE: Repeat for the extruder's trapq.
             if move.axes_d[self.axis_count]:
@@ -807,15 +1137,23 @@ class ToolHead:
             
             # NOTE: Execute any "callbacks" registered 
             #       to be run at the end of this move.
-            for cb in move.timing_callbacks:
-                cb(next_move_time)
-        
+            if move.timing_callbacks:
+                # NOTE: Callbacks see the trapq with every move up to
+                #       this one appended, so pending moves are queued first.
+                kin_trapqs.append_moves(kin_data)
+                del kin_data[:]
+                for cb in move.timing_callbacks:
+                    cb(next_move_time)
+        kin_trapqs.append_moves(kin_data)
+
+        trace = self.trace
+        if __debug__ and trace.enabled:
+            trace.record(motiontrace.TP_PROCESS, self.trace_source,
+                         self.print_time, next_move_time, len(moves))
+
         # Generate steps for moves
         if self.special_queuing_state:
             # NOTE: this block is executed when "special_queuing_state" is not None.
-            # NOTE: loging "next_move_time" for tracing.
-            logging.info("\n\nToolHead _process_moves: calling _update_drip_move_time with " +
-                         f"next_move_time={str(next_move_time)}\n\n")
             # NOTE: This function loops "while self.print_time < next_print_time".
             #       It "pauses before sending more steps" using "drip_completion.wait",
             #       and calls "_update_move_time" with small increments in "next_move_time". 
@@ -828,11 +1166,9 @@ class ToolHead:
         #       Here, it is passed to "_update_move_time" (which updates
         #       "self.print_time" and calls "trapq_finalize_moves") and
         #       to overwrite "self.last_kin_move_time".
-        logging.info(f"\n\nToolHead _process_moves: _update_move_time with next_move_time={next_move_time}\n\n")
         self._update_move_time(next_move_time)
 
         # NOTE: "last_kin_move_time" may only be increased to "next_move_time" or stay the same.
-        logging.info(f"\n\nToolHead _process_moves: update last_kin_move_time={self.last_kin_move_time} set to next_move_time={next_move_time} if the former is greater.\n\n")
         self.last_kin_move_time = max(self.last_kin_move_time, next_move_time)
         
     def flush_step_generation(self):
@@ -842,8 +1178,6 @@ class ToolHead:
 
         It is a "use case" for drip moves is to: 'Exit "Drip" state'
         """ 
-        logging.info(f"\n\nToolHead.flush_step_generation: triggered.\n\n")
-
         # NOTE: This is the "flush" method from a "MoveQueue" object.
         #       It calls "_process_moves" on the moves in the queue that
         #       are "ready to be flushed", and likely removing them all 
@@ -1016,15 +1350,8 @@ class ToolHead:
         logging.info("\n\n" + f"toolhead.set_position: setting newpos={newpos} and homing_axes={homing_axes}\n\n")
         self.flush_step_generation()
             
-        # NOTE: Set the position of the axes "trapq".
-        for axes in list(self.kinematics):
-            # Iterate over["XYZ", "ABC"]
-            logging.info("\n\n" + f"toolhead.set_position: setting {axes} trapq position.\n\n")
-            kin = self.kinematics[axes]
-            # Filter the axis IDs according to the current kinematic
-            new_kin_pos = self.get_elements(newpos, kin.axis)
-            logging.info("\n\n" + f"toolhead.set_position: using newpos={new_kin_pos}\n\n")
-            self.set_kin_trap_position(kin.trapq, new_kin_pos)
+        # NOTE: Set the position of the axes "trapq" (all axes at once).
+        self.kin_trapqs.set_position(self.print_time, newpos)
         
         # NOTE: Also set the position of the extruder's "trapq".
         #       Runs "trapq_set_position" and "rail.set_position".
@@ -1047,6 +1374,11 @@ class ToolHead:
         #       an unmodified "commanded_pos" might be important.
         self.commanded_pos[:] = newpos
         
+        trace = self.trace
+        if __debug__ and trace.enabled:
+            trace.record(motiontrace.TP_SET_POSITION, self.trace_source,
+                         self.print_time, *newpos[:3], newpos[-1])
+
         # NOTE: this event is mainly recived by gcode_move.reset_last_position,
         #       which updates its "self.last_position" with (presumably) the
         #       "self.commanded_pos" above.
@@ -1064,7 +1396,7 @@ class ToolHead:
             # NOTE: Set the position of the toolhead's "trapq".
             logging.info("\n\n" + f"toolhead.set_kin_trap_position: setting trapq pos to newpos={newpos}\n\n")
             ffi_main, ffi_lib = chelper.get_ffi()
-            ffi_lib.trapq_set_position(self.trapq, self.print_time,
+            ffi_lib.trapq_set_position(trapq, self.print_time,
                                     newpos[0], newpos[1], newpos[2])
         else:
             logging.info("\n\n" + f"toolhead.set_kin_trap_position: trapq was None, skipped setting to newpos={newpos}\n\n")
@@ -1113,7 +1445,6 @@ class ToolHead:
             newpos (_type_): _description_
             speed (_type_): _description_
         """
-        logging.info(f"\n\ntoolhead.move: moving to newpos={newpos}.\n\n")
         move = Move(toolhead=self, 
                     start_pos=self.commanded_pos,
                     end_pos=newpos, 
@@ -1125,7 +1456,6 @@ class ToolHead:
 
         # NOTE: Move checks.
         if not move.move_d:
-            logging.info(f"\n\ntoolhead.move: early return, nothing to move. move.move_d={move.move_d}\n\n")
             return
         
         # NOTE: Kinematic move checks for XYZ and ABC axes.
@@ -1135,7 +1465,6 @@ class ToolHead:
             # for axes in ["XYZ"]:
             for axes in list(self.kinematics):    
                 # Iterate over["XYZ", "ABC"]
-                logging.info("\n\n" + f"toolhead.move: check_move on {axes} move.\n\n")
                 kin = self.kinematics[axes]
                 kin.check_move(move)
             # self.kin.check_move(move)
@@ -1145,7 +1474,6 @@ class ToolHead:
             
         # NOTE: Kinematic move checks for E axis.
         if move.axes_d[self.axis_count]:
-            logging.info("\n\n" + f"toolhead.move: check_move on E move to {move.axes_d[self.axis_count]}.\n\n")
             self.extruder.check_move(move, e_axis=self.axis_count)
         
         # NOTE: Update "commanded_pos" with the "end_pos"
@@ -1159,6 +1487,31 @@ class ToolHead:
         if self.print_time > self.need_check_stall:
             self._check_stall()
     
+    def arc_move(self, newpos, speed, axis0, axis1, center, angular_travel):
+        """Queue a G2/G3 arc as a single move (see "ArcMove").
+
+        The coordinates of "axis0" and "axis1" turn "angular_travel"
+        radians around "center" while the other axes move linearly
+        to "newpos".
+        """
+        move = ArcMove(self, self.commanded_pos, newpos, speed,
+                       axis0, axis1, center, angular_travel)
+        if not move.move_d:
+            return
+        # NOTE: The kinematic checks only look at the end of a move, also
+        #       check the points where the arc bulges out along an axis.
+        for axes in list(self.kinematics):
+            kin = self.kinematics[axes]
+            for pos in move.get_extremes():
+                kin.check_move(Move(self, self.commanded_pos, pos, speed))
+            kin.check_move(move)
+        if move.axes_d[self.axis_count]:
+            self.extruder.check_move(move, e_axis=self.axis_count)
+        self.commanded_pos[:] = move.end_pos
+        self.move_queue.add_move(move)
+        if self.print_time > self.need_check_stall:
+            self._check_stall()
+
     def manual_move(self, coord, speed):
         # NOTE: the "manual_move" command interprets "None" values
         #       as the latest (commanded) coordinates.
@@ -1257,6 +1610,10 @@ class ToolHead:
             
             # Send more steps
             npt = min(self.print_time + DRIP_SEGMENT_TIME, next_print_time)
+            trace = self.trace
+            if __debug__ and trace.enabled:
+                trace.record(motiontrace.TP_DRIP, self.trace_source,
+                             self.print_time, next_print_time)
             # NOTE: Call "_update_move_time" with a small time in the future, updating 
             #       "self.print_time", generating steps, calling "trapq_finalize_moves",
             #       and calling "MCU.flush_moves".
@@ -1310,11 +1667,7 @@ class ToolHead:
             #       - Flush all moves from trapq (in the case of print_time=NEVER_TIME)
             #       I am guessing here that "older" means "with a smaller timestamp",
             #       or "previous". Otherwise it would not make sense.
-            for axes in list(self.kinematics):
-                # Iterate over ["XYZ", "ABC"].
-                kin = self.kinematics[axes]
-                logging.info(f"\n\nToolHead.drip_move calling trapq_finalize_moves on axes={axes} free_time=self.reactor.NEVER ({self.reactor.NEVER})\n\n")
-                self.trapq_finalize_moves(kin.trapq, self.reactor.NEVER)
+            self.kin_trapqs.finalize_moves(self.reactor.NEVER)
             
             # # NOTE: This calls a function in "trapq.c", described as:
             # #       - Expire any moves older than `print_time` from the trapezoid velocity queue
@@ -1410,7 +1763,12 @@ class ToolHead:
         # TODO: update the rest of the code to use "get_trapq" with "axes" instead.
         return self.abc_trapq
     
+    def register_stepper(self, mcu_stepper):
+        # NOTE: Steps of steppers are generated in C, in parallel for
+        #       each mcu (see "StepFlush").
+        self.step_flush.add_steppers([mcu_stepper])
     def register_step_generator(self, handler):
+        # NOTE: Step generators other than steppers are called from Python.
         self.step_generators.append(handler)
     def note_step_generation_scan_time(self, delay, old_delay=0.):
         self.flush_step_generation()
@@ -1427,6 +1785,17 @@ class ToolHead:
             callback(self.get_last_move_time())
             return
         last_move.timing_callbacks.append(callback)
+    def register_lookahead_delay(self, callback):
+        # Like "register_lookahead_callback", but "callback" returns a time
+        # that the following moves wait for.  The wait is queued on the
+        # lookahead, so it does not flush the queued moves.
+        delay_move = DelayMove(self)
+        def set_delay(print_time):
+            delay_move.set_delay(max(0., callback(print_time) - print_time))
+        self.register_lookahead_callback(set_delay)
+        self.move_queue.add_move(delay_move)
+        if self.print_time > self.need_check_stall:
+            self._check_stall()
     def note_kinematic_activity(self, kin_time):
         self.last_kin_move_time = max(self.last_kin_move_time, kin_time)
     def get_max_velocity(self):
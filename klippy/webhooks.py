@@ -26,6 +26,39 @@ if sys.version_info.major < 3:
                     for k, v in data.items()}
         return data
 
+# Use a faster json encoder for the API socket when one is installed.
+# Messages that it rejects (eg, dictionaries with non-string keys) are
+# encoded with the standard json module instead.
+def _json_dumps_std(data):
+    return json.dumps(data, separators=(',', ':')).encode()
+
+try:
+    import orjson
+    JSON_ENCODER = 'orjson'
+    def _orjson_default(obj):
+        # Named tuples (eg, gcode.Coord) are sent as lists
+        if isinstance(obj, tuple):
+            return list(obj)
+        raise TypeError
+    def json_dumps(data):
+        try:
+            return orjson.dumps(data, default=_orjson_default)
+        except TypeError:
+            return _json_dumps_std(data)
+except ImportError:
+    try:
+        import ujson
+        JSON_ENCODER = 'ujson'
+        def json_dumps(data):
+            try:
+                return ujson.dumps(data, ensure_ascii=False,
+                                   escape_forward_slashes=False).encode()
+            except (TypeError, ValueError, OverflowError):
+                return _json_dumps_std(data)
+    except ImportError:
+        JSON_ENCODER = 'json'
+        json_dumps = _json_dumps_std
+
 class WebRequestError(gcode.CommandError):
     # NOTE: "gcode.CommandError" inherits from "Exception",
     #       which means that this does as well.
@@ -122,6 +155,9 @@ class ServerSocket:
         self.reactor = printer.get_reactor()
         self.sock = self.fd_handle = None
         self.clients = {}
+        # Writes to the clients are coalesced and done once per reactor pass
+        self.pending_sends = {}
+        self.send_timer = self.reactor.register_timer(self._do_pending_sends)
         start_args = printer.get_start_args()
         server_address = start_args.get('apiserver')
         is_fileinput = (start_args.get('debuginput') is not None)
@@ -135,6 +171,7 @@ class ServerSocket:
         self.sock.listen(1)
         self.fd_handle = self.reactor.register_fd(
             self.sock.fileno(), self._handle_accept)
+        logging.info("webhooks: using %s encoder", JSON_ENCODER)
         printer.register_event_handler(
             'klippy:disconnect', self._handle_disconnect)
         printer.register_event_handler(
@@ -150,6 +187,7 @@ class ServerSocket:
         self.clients[client.uid] = client
 
     def _handle_disconnect(self):
+        self._do_pending_sends(self.reactor.monotonic())
         for client in list(self.clients.values()):
             client.close()
         if self.sock is not None:
@@ -175,6 +213,19 @@ class ServerSocket:
 
     def pop_client(self, client_id):
         self.clients.pop(client_id, None)
+        self.pending_sends.pop(client_id, None)
+
+    def schedule_send(self, client):
+        if not self.pending_sends:
+            self.reactor.update_timer(self.send_timer, self.reactor.NOW)
+        self.pending_sends[client.uid] = client
+
+    def _do_pending_sends(self, eventtime):
+        pending_sends = self.pending_sends
+        self.pending_sends = {}
+        for client in pending_sends.values():
+            client._do_send(eventtime)
+        return self.reactor.NEVER
 
     def stats(self, eventtime):
         # Called once per second - check for idle clients
@@ -197,6 +248,7 @@ class ClientConnection:
         self.fd_handle = self.reactor.register_fd(
             self.sock.fileno(), self.process_received, self._do_send)
         self.partial_data = self.send_buffer = b""
+        self.send_queue = []
         self.is_blocking = False
         self.blocking_count = 0
         self.set_client_info("?", "New connection")
@@ -302,19 +354,27 @@ class ClientConnection:
 
     def send(self, data):
         try:
-            jmsg = json.dumps(data, separators=(',', ':'))
-            self.send_buffer += jmsg.encode() + b"\x03"
+            jmsg = json_dumps(data)
         except (TypeError, ValueError) as e:
             msg = ("json encoding error: %s" % (str(e),))
             logging.exception(msg)
             self.printer.invoke_shutdown(msg)
             return
+        self.send_encoded(jmsg)
+
+    def send_encoded(self, jmsg):
+        # Queue an already json encoded message (without terminator)
+        self.send_queue.append(jmsg)
+        self.send_queue.append(b"\x03")
         if not self.is_blocking:
-            self._do_send()
+            self.server.schedule_send(self)
 
     def _do_send(self, eventtime=None):
         if self.fd_handle is None:
             return
+        if self.send_queue:
+            self.send_buffer += b"".join(self.send_queue)
+            self.send_queue = []
         try:
             sent = self.sock.send(self.send_buffer)
         except socket.error as e:
@@ -502,45 +562,89 @@ class QueryStatusHelper:
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _query_object(self, obj_name, eventtime, last_query):
+        # Returns (status, changed_items, version) for a printer object
+        last = last_query.get(obj_name)
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            return {}, {}, None
+        # NOTE: Objects may implement get_status_version() returning a
+        #       value that changes whenever their get_status() result
+        #       changes. Unchanged objects are then neither queried
+        #       nor compared.
+        version = None
+        get_version = getattr(po, 'get_status_version', None)
+        if get_version is not None:
+            version = get_version()
+            if last is not None and version == last[2]:
+                return last[0], {}, version
+        res = po.get_status(eventtime)
+        # Compare with the previous status once for all clients
+        lres = last[0] if last is not None else {}
+        changed = {ri: rd for ri, rd in res.items() if rd != lres.get(ri)}
+        for ri in lres:
+            if ri not in res:
+                changed[ri] = None
+        return res, changed, version
     def _do_query(self, eventtime):
         last_query = self.last_query
         query = self.last_query = {}
         msglist = self.pending_queries
         self.pending_queries = []
         msglist.extend(self.clients.values())
+        # Clients with the same subscription share the same status
+        shared_params = {}
+        shared_msgs = {}
         # Generate get_status() info for each client
-        for cconn, subscription, send_func, template in msglist:
+        for cconn, subscription, send_func, template, sub_key in msglist:
             is_query = cconn is None
             if not is_query and cconn.is_closed():
                 del self.clients[cconn]
                 continue
-            # Query each requested printer object
-            cquery = {}
-            for obj_name, req_items in subscription.items():
-                res = query.get(obj_name, None)
-                if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
-                    else:
-                        res = query[obj_name] = po.get_status(eventtime)
-                if req_items is None:
-                    req_items = list(res.keys())
-                    if req_items:
-                        subscription[obj_name] = req_items
-                lres = last_query.get(obj_name, {})
-                cres = {}
-                for ri in req_items:
-                    rd = res.get(ri, None)
-                    if is_query or rd != lres.get(ri):
-                        cres[ri] = rd
-                if cres or is_query:
-                    cquery[obj_name] = cres
+            params = shared_params.get(sub_key)
+            if params is None:
+                # Query each requested printer object
+                cquery = {}
+                for obj_name, req_items in subscription.items():
+                    entry = query.get(obj_name)
+                    if entry is None:
+                        entry = query[obj_name] = self._query_object(
+                            obj_name, eventtime, last_query)
+                    res, changed, version = entry
+                    if req_items is None:
+                        req_items = list(res.keys())
+                        if req_items:
+                            subscription[obj_name] = req_items
+                    if is_query:
+                        cquery[obj_name] = {ri: res.get(ri, None)
+                                            for ri in req_items}
+                    elif changed:
+                        cres = {ri: changed[ri] for ri in req_items
+                                if ri in changed}
+                        if cres:
+                            cquery[obj_name] = cres
+                params = {'eventtime': eventtime, 'status': cquery}
+                if sub_key is not None:
+                    shared_params[sub_key] = params
             # Send data
-            if cquery or is_query:
-                tmp = dict(template)
-                tmp['params'] = {'eventtime': eventtime, 'status': cquery}
+            if not params['status'] and not is_query:
+                continue
+            tmp = dict(template)
+            tmp['params'] = params
+            if sub_key is None:
                 send_func(tmp)
+                continue
+            # Encode the update once for all clients sharing it
+            jmsg = shared_msgs.get(sub_key)
+            if jmsg is None:
+                try:
+                    jmsg = shared_msgs[sub_key] = json_dumps(tmp)
+                except (TypeError, ValueError) as e:
+                    msg = ("json encoding error: %s" % (str(e),))
+                    logging.exception(msg)
+                    self.printer.invoke_shutdown(msg)
+                    continue
+            send_func(jmsg)
         if not query:
             # Unregister timer if there are no longer any subscriptions
             reactor = self.printer.get_reactor()
@@ -565,7 +669,8 @@ class QueryStatusHelper:
             del self.clients[cconn]
         reactor = self.printer.get_reactor()
         complete = reactor.completion()
-        self.pending_queries.append((None, objects, complete.complete, {}))
+        self.pending_queries.append((None, objects, complete.complete, {},
+                                     None))
         # Start timer if needed
         if self.query_timer is None:
             qt = reactor.register_timer(self._do_query, reactor.NOW)
@@ -574,7 +679,9 @@ class QueryStatusHelper:
         msg = complete.wait()
         web_request.send(msg['params'])
         if is_subscribe:
-            self.clients[cconn] = (cconn, objects, cconn.send, template)
+            sub_key = json.dumps([objects, template], sort_keys=True)
+            self.clients[cconn] = (cconn, objects, cconn.send_encoded,
+                                   template, sub_key)
     def _handle_subscribe(self, web_request):
         self._handle_query(web_request, is_subscribe=True)
 
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# Preflight analysis of a g-code file: axis bounds, run time, feed limits
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, json, logging
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+# gcode_move imports klippy, whose modules refer back to klippy.Printer at
+# import time; loading webhooks first lets that circular import resolve.
+import webhooks
+import gcodeanalyze
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+def read_printer_config(filename, options):
+    # Take the limits and axis ranges from a printer.cfg file
+    cp = configparser.RawConfigParser(strict=False, inline_comment_prefixes=(
+        ';', '#'))
+    cp.read(filename)
+    def getfloat(section, option, default=None):
+        if cp.has_option(section, option):
+            return float(cp.get(section, option))
+        return default
+    if cp.has_section('printer'):
+        options.axes = cp.get('printer', 'axis', fallback=options.axes)
+        for opt in ['max_velocity', 'max_accel', 'max_accel_to_decel',
+                    'square_corner_velocity', 'max_z_velocity',
+                    'max_z_accel']:
+            value = getfloat('printer', opt)
+            if value is not None:
+                setattr(options, opt, value)
+    ranges = {}
+    home_position = {}
+    for a in options.axes:
+        section = 'stepper_' + a.lower()
+        if not cp.has_section(section):
+            continue
+        endstop = getfloat(section, 'position_endstop')
+        ranges[a] = (getfloat(section, 'position_min', 0.),
+                     getfloat(section, 'position_max', endstop))
+        if endstop is not None:
+            home_position[a] = endstop
+    if cp.has_section('gcode_arcs'):
+        options.arc_resolution = getfloat('gcode_arcs', 'resolution',
+                                          options.arc_resolution)
+    return ranges, home_position
+
+def parse_ranges(text):
+    # Parse "X:0:300,Y:0:200" style axis ranges
+    ranges = {}
+    for part in text.split(','):
+        a, amin, amax = part.strip().split(':')
+        ranges[a.upper()] = (float(amin), float(amax))
+    return ranges
+
+def analyze(filename, options, ranges, home_position):
+    axis_limits = []
+    if options.max_z_velocity is not None and 'Z' in options.axes:
+        max_z_accel = options.max_z_accel or options.max_accel
+        axis_limits.append(gcodeanalyze.AxisLimit(
+            options.axes.index('Z'), options.max_z_velocity, max_z_accel,
+            'max_z_velocity'))
+    analyzer = gcodeanalyze.GCodeAnalyzer(
+        options.axes, options.max_velocity, options.max_accel,
+        options.max_accel_to_decel, options.square_corner_velocity,
+        axis_limits, ranges, home_position,
+        {'resolution': options.arc_resolution})
+    f = open(filename, 'rb')
+    result = analyzer.process_file(f)
+    f.close()
+    return result
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-a", "--axes", type="string", dest="axes",
+                    default="XYZABC", help="toolhead axis names")
+    opts.add_option("-v", "--max_velocity", type="float", dest="max_velocity",
+                    default=300., help="maximum velocity")
+    opts.add_option("-c", "--max_accel", type="float", dest="max_accel",
+                    default=3000., help="maximum acceleration")
+    opts.add_option("-d", "--max_accel_to_decel", type="float",
+                    dest="max_accel_to_decel", default=None,
+                    help="maximum acceleration to deceleration")
+    opts.add_option("-s", "--square_corner_velocity", type="float",
+                    dest="square_corner_velocity", default=5.,
+                    help="square corner velocity")
+    opts.add_option("-z", "--max_z_velocity", type="float",
+                    dest="max_z_velocity", default=None,
+                    help="maximum z velocity")
+    opts.add_option("--max_z_accel", type="float", dest="max_z_accel",
+                    default=None, help="maximum z acceleration")
+    opts.add_option("--arc_resolution", type="float", dest="arc_resolution",
+                    default=1., help="G2/G3 arc segment length")
+    opts.add_option("-r", "--ranges", type="string", dest="ranges",
+                    default=None, help="axis ranges (eg, X:0:300,Y:0:200)")
+    opts.add_option("-C", "--config", type="string", dest="config",
+                    default=None, help="read limits from a printer.cfg file")
+    opts.add_option("-o", "--cache", type="string", dest="cache",
+                    default=None, help="json file caching previous results")
+    opts.add_option("-j", "--json", action="store_true", dest="json",
+                    help="write the result as json")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    filename = args[0]
+    logging.basicConfig(level=logging.WARNING)
+    ranges, home_position = {}, {}
+    if options.config is not None:
+        ranges, home_position = read_printer_config(options.config, options)
+    if options.ranges is not None:
+        ranges.update(parse_ranges(options.ranges))
+    # Results depend on the file and on the limits used
+    key = json.dumps([gcodeanalyze.file_key(filename), vars(options),
+                      sorted(ranges.items()), sorted(home_position.items())],
+                     sort_keys=True)
+    cache = {}
+    if options.cache is not None and os.path.exists(options.cache):
+        f = open(options.cache, 'r')
+        cache = json.load(f)
+        f.close()
+    result = cache.get(key)
+    if result is None:
+        result = analyze(filename, options, ranges, home_position)
+        if options.cache is not None:
+            cache[key] = result
+            f = open(options.cache, 'w')
+            json.dump(cache, f)
+            f.close()
+    if options.json:
+        sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+    else:
+        sys.stdout.write(gcodeanalyze.format_result(result) + "\n")
+
+if __name__ == '__main__':
+    main()
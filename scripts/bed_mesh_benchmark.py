@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Measure bed_mesh mesh build time and calc_z rate for several grid sizes
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random, time, logging
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import bed_mesh
+
+DEFAULT_SIZES = "5,10,25,50,75,100"
+
+def get_params(count, algo, pps):
+    return {'min_x': 10., 'max_x': 290., 'min_y': 10., 'max_y': 290.,
+            'x_count': count, 'y_count': count,
+            'mesh_x_pps': pps, 'mesh_y_pps': pps,
+            'algo': algo, 'tension': .2}
+
+def time_build(params, z_matrix, repeat):
+    best = None
+    for i in range(repeat):
+        start_time = time.time()
+        z_mesh = bed_mesh.ZMesh(params)
+        z_mesh.build_mesh([list(row) for row in z_matrix])
+        elapsed = time.time() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+    return z_mesh, best
+
+def time_calc_z(z_mesh, count):
+    rnd = random.Random(42)
+    coords = [(rnd.uniform(0., 300.), rnd.uniform(0., 300.))
+              for i in range(count)]
+    calc_z = z_mesh.calc_z
+    start_time = time.time()
+    for x, y in coords:
+        calc_z(x, y)
+    return count / (time.time() - start_time)
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-s", "--sizes", type="string", dest="sizes",
+                    default=DEFAULT_SIZES,
+                    help="comma separated probe counts (per axis) to test")
+    opts.add_option("-a", "--algorithm", type="string", dest="algo",
+                    default="bicubic", help="interpolation algorithm")
+    opts.add_option("-p", "--pps", type="int", dest="pps", default=2,
+                    help="interpolated points per segment")
+    opts.add_option("-n", "--calls", type="int", dest="calls",
+                    default=200000, help="number of calc_z calls to time")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of mesh builds (the best is reported)")
+    opts.add_option("--no-numpy", action="store_true", dest="no_numpy",
+                    help="only test the pure python interpolation")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.WARNING)
+    modes = [("python", False)]
+    if not options.no_numpy:
+        if bed_mesh.load_numpy():
+            modes.append(("numpy", True))
+        else:
+            sys.stdout.write("numpy not available, skipping numpy tests\n")
+    sys.stdout.write("%-8s %-7s %9s %12s %14s\n" % (
+        "probes", "mode", "mesh", "build(ms)", "calc_z/s"))
+    for count in [int(c) for c in options.sizes.split(',')]:
+        params = get_params(count, options.algo, options.pps)
+        rnd = random.Random(count)
+        z_matrix = [[rnd.uniform(-.2, .2) for i in range(count)]
+                    for j in range(count)]
+        for mode, use_numpy in modes:
+            # Force the interpolation method regardless of the mesh size
+            bed_mesh.NUMPY_MIN_POINTS = 0 if use_numpy else float('inf')
+            z_mesh, build_time = time_build(params, z_matrix, options.repeat)
+            rate = time_calc_z(z_mesh, options.calls)
+            sys.stdout.write("%-8s %-7s %9s %12.2f %14.0f\n" % (
+                "%dx%d" % (count, count), mode,
+                "%dx%d" % (z_mesh.mesh_x_count, z_mesh.mesh_y_count),
+                build_time * 1000., rate))
+
+if __name__ == '__main__':
+    main()
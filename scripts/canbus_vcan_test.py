@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Measure the serialqueue CAN transport against a simulated node
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, socket, struct, threading, time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import chelper, msgproto
+
+# The test is normally run on a virtual CAN interface:
+#   sudo ip link add dev vcan0 type vcan
+#   sudo ip link set vcan0 up
+
+CAN_FMT = "=IB3x8s"
+CAN_FRAME_SIZE = struct.calcsize(CAN_FMT)
+
+def open_can(iface, rxid):
+    s = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    s.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER,
+                 struct.pack("=II", rxid, 0x7ff))
+    s.bind((iface,))
+    return s
+
+def build_block(seq, payload):
+    msglen = msgproto.MESSAGE_MIN + len(payload)
+    msg = [msglen, msgproto.MESSAGE_DEST | (seq & msgproto.MESSAGE_SEQ_MASK)]
+    msg += payload
+    msg += msgproto.crc16_ccitt(msg)
+    msg.append(msgproto.MESSAGE_SYNC)
+    return bytearray(msg)
+
+# Simulated CAN node: answers each received message block with a data
+# message (which also acks the block) and notes when it was sent.
+class FakeNode:
+    def __init__(self, sock, txid, cmd_len, count):
+        self.sock = sock
+        self.txid = txid
+        self.cmd_len = cmd_len
+        self.count = count
+        self.data = bytearray()
+        self.blocks = self.frames = self.commands = 0
+        self.send_times = []
+        self.done = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.start()
+    def stop(self):
+        self.running = False
+        self.thread.join()
+    def _send(self, block):
+        for i in range(0, len(block), 8):
+            chunk = bytes(block[i:i+8])
+            self.sock.send(struct.pack(CAN_FMT, self.txid, len(chunk), chunk))
+    def _run(self):
+        self.sock.settimeout(.100)
+        while self.running:
+            try:
+                frame = self.sock.recv(CAN_FRAME_SIZE)
+            except socket.timeout:
+                continue
+            can_id, dlc, data = struct.unpack(CAN_FMT, frame)
+            self.frames += 1
+            self.data += data[:dlc]
+            while self.data:
+                if self.data[0] == msgproto.MESSAGE_SYNC:
+                    del self.data[:1]
+                    continue
+                msglen = self.data[0]
+                if len(self.data) < msglen:
+                    break
+                seq = self.data[msgproto.MESSAGE_POS_SEQ]
+                del self.data[:msglen]
+                self.blocks += 1
+                self.commands += (msglen - msgproto.MESSAGE_MIN) // self.cmd_len
+                self.send_times.append(
+                    time.clock_gettime(time.CLOCK_MONOTONIC_RAW))
+                self._send(build_block(seq + 1, [self.blocks & 0x7f]))
+                if self.commands >= self.count:
+                    self.done.set()
+
+def run_test(host_sock, node_sock, txid, count, bitrate):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    sq = ffi_lib.serialqueue_alloc(host_sock.fileno(), b'c', txid)
+    ffi_lib.serialqueue_set_wire_frequency(sq, bitrate)
+    ffi_lib.serialqueue_set_receive_window(sq, 192)
+    cq = ffi_lib.serialqueue_alloc_commandqueue()
+    # Queue "count" step sized commands and collect the node responses
+    cmd = [0x10, 0x81, 0x02, 0x83, 0x04, 0x05]
+    msg = ffi_main.new('uint8_t[]', cmd)
+    node = FakeNode(node_sock, txid + 1, len(cmd), count)
+    pqm = ffi_main.new('struct pull_queue_message *')
+    stats_buf = ffi_main.new('char[4096]')
+    ffi_lib.serialqueue_get_stats(sq, stats_buf, len(stats_buf))
+    start_time = time.clock_gettime(time.CLOCK_MONOTONIC_RAW)
+    for i in range(count):
+        ffi_lib.serialqueue_send(sq, cq, msg, len(msg), 0, 0, 0)
+    node.done.wait()
+    receive_times = []
+    while len(receive_times) < node.blocks:
+        ffi_lib.serialqueue_pull(sq, pqm)
+        if pqm.len < 0:
+            break
+        receive_times.append(pqm.receive_time)
+    end_time = time.clock_gettime(time.CLOCK_MONOTONIC_RAW)
+    ffi_lib.serialqueue_get_stats(sq, stats_buf, len(stats_buf))
+    stats = ffi_main.string(stats_buf).decode()
+    ffi_lib.serialqueue_exit(sq)
+    ffi_lib.serialqueue_free(sq)
+    ffi_lib.serialqueue_free_commandqueue(cq)
+    node.stop()
+    # Delay between the node sending a response and its receive_time
+    delays = [r - s for r, s in zip(receive_times, node.send_times)]
+    return {'elapsed': end_time - start_time, 'responses': len(receive_times),
+            'blocks': node.blocks, 'frames': node.frames,
+            'delay_avg': sum(delays) / max(1, len(delays)),
+            'delay_max': max(delays or [0.]), 'stats': stats}
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-i", "--interface", type="string", dest="iface",
+                    default="vcan0", help="CAN interface to test on")
+    opts.add_option("-n", "--count", type="int", dest="count",
+                    default=20000, help="number of commands to send")
+    opts.add_option("-b", "--bitrate", type="float", dest="bitrate",
+                    default=1000000., help="bus frequency used for bus load")
+    opts.add_option("--nodeid", type="int", dest="nodeid", default=64,
+                    help="canbus_nodeid of the simulated node")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    txid = options.nodeid * 2 + 256
+    try:
+        host_sock = open_can(options.iface, txid + 1)
+        node_sock = open_can(options.iface, txid)
+    except (OSError, AttributeError) as e:
+        opts.error("Unable to open CAN interface '%s': %s" % (
+            options.iface, e))
+    res = run_test(host_sock, node_sock, txid, options.count,
+                   options.bitrate)
+    sys.stdout.write("%d commands in %d blocks (%d frames) in %.3fs:"
+                     " %.0f commands/s\n" % (
+                         options.count, res['blocks'], res['frames'],
+                         res['elapsed'], options.count / res['elapsed']))
+    sys.stdout.write("response receive_time delay avg=%.1fus max=%.1fus\n" % (
+        res['delay_avg'] * 1000000., res['delay_max'] * 1000000.))
+    sys.stdout.write("%s\n" % (res['stats'],))
+
+if __name__ == '__main__':
+    main()
@@ -80,3 +80,7 @@ finish_test klippy "Test invoke klippy (Python3)"
 start_test klippy "Test invoke klippy (Python2)"
 $PYTHON2 scripts/test_klippy.py -d ${DICTDIR} test/klippy/*.test
 finish_test klippy "Test invoke klippy (Python2)"
+
+start_test klippy "Test lookahead planner parity"
+$PYTHON scripts/test_lookahead.py -g 20000 test/klippy/move.gcode
+finish_test klippy "Test lookahead planner parity"
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# Replay mcu clock samples through the clocksync estimators
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, re, math, random, logging
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import clocksync
+
+ESTIMATORS = ['decay', 'window']
+
+class DummyReactor:
+    def register_timer(self, callback, waketime=None):
+        return None
+
+class DummySerial:
+    warn_prefix = ""
+    def set_clock_est(self, freq, conv_time, conv_clock, last_clock):
+        pass
+
+
+######################################################################
+# Sample sources
+######################################################################
+
+# Read the "clock sample" lines of a klippy.log (logged with "-v")
+def read_log(filename, mcu_name):
+    prefix = "mcu '%s': " % (mcu_name,)
+    sample_r = re.compile(r"^(?P<prefix>.*)clock sample sent=(?P<sent>[0-9.]+)"
+                          r" receive=(?P<receive>[0-9.]+)"
+                          r" clock=(?P<clock>[0-9]+)$")
+    samples = []
+    f = open(filename, 'r')
+    for line in f:
+        m = sample_r.match(line.strip())
+        if m is None or not m.group('prefix').endswith(prefix):
+            continue
+        samples.append((float(m.group('sent')), float(m.group('receive')),
+                        int(m.group('clock'))))
+    f.close()
+    return samples
+
+# Synthetic link: the clock is read after a random outbound delay, some
+# round trips are delayed (USB/CAN hiccups) and the mcu frequency
+# drifts with a slow sine (temperature).
+class SyntheticClock:
+    def __init__(self, freq, drift_ppm, period):
+        self.freq = freq
+        self.drift = drift_ppm * .000001
+        self.period = period
+        self.start_clock = 123456789
+    def get_clock(self, systime):
+        w = 2. * math.pi / self.period
+        phase = systime - self.drift / w * (math.cos(w * systime) - 1.)
+        return self.start_clock + self.freq * phase
+
+def generate_samples(sc, duration, jitter, outlier_rate, seed=42):
+    rnd = random.Random(seed)
+    samples = []
+    sent_time = 10.
+    def delay():
+        d = .000050 + rnd.expovariate(1. / jitter)
+        if rnd.random() < outlier_rate:
+            d += rnd.uniform(.002, .030)
+        return d
+    # Startup samples (see ClockSync.connect) then the periodic queries
+    times = [sent_time + .050 * i for i in range(9)]
+    t = times[-1]
+    while t < sent_time + duration:
+        t += .9839
+        times.append(t)
+    for t in times:
+        read_time = t + delay()
+        receive_time = read_time + delay()
+        samples.append((t, receive_time, int(sc.get_clock(read_time))))
+    return samples
+
+
+######################################################################
+# Replay
+######################################################################
+
+def replay(estimator, samples, freq, truth, lookahead):
+    cs = clocksync.ClockSync(DummyReactor(), estimator)
+    cs.serial = DummySerial()
+    cs.mcu_freq = freq
+    sent_time, receive_time, clock = samples[0]
+    cs.reset_estimate(sent_time, clock)
+    min_hrtt = min([.5 * (r - s) for s, r, c in samples])
+    start_time = samples[1][0]
+    results = []
+    for i, (sent_time, receive_time, clock) in enumerate(samples[1:]):
+        half_rtt = .5 * (receive_time - sent_time)
+        if (truth is None and i
+            and half_rtt <= min_hrtt + clocksync.WINDOW_RTT_SLACK):
+            # Error predicting the next sample with a fast round trip
+            err = cs.get_clock(sent_time + half_rtt) - clock
+            results.append((sent_time - start_time, err / freq))
+        cs._handle_clock({'clock': clock & 0xffffffff,
+                          '#sent_time': sent_time,
+                          '#receive_time': receive_time})
+        if truth is not None:
+            # Error predicting the clock "lookahead" seconds ahead
+            eval_time = sent_time + lookahead
+            err = cs.get_clock(eval_time) - truth.get_clock(eval_time)
+            results.append((sent_time - start_time, err / freq))
+    return results
+
+def rms(values):
+    if not values:
+        return 0.
+    return math.sqrt(sum([v**2 for v in values]) / len(values))
+
+def summarize(results, settle_factor, steady_time):
+    # A constant offset (bias) between the estimate and the clock is
+    # harmless, so settling and the spread are measured around it
+    steady = [err for t, err in results if t >= steady_time]
+    bias = sum(steady) / max(1, len(steady))
+    spread = [err - bias for err in steady]
+    spread_max = max([abs(e) for e in spread] or [0.])
+    # Settled once the error stays within a multiple of the largest
+    # steady state error (so this is at most steady_time)
+    threshold = settle_factor * spread_max
+    settle = 0.
+    for t, err in results:
+        if abs(err - bias) > threshold:
+            settle = t
+    early = [err - bias for t, err in results if t < 10.]
+    return settle, rms(early), bias, rms(spread), spread_max
+
+def main():
+    usage = "%prog [options] [klippy.log]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-m", "--mcu", type="string", dest="mcu", default="mcu",
+                    help="name of the mcu to replay from the log")
+    opts.add_option("-f", "--freq", type="float", dest="freq", default=None,
+                    help="mcu CLOCK_FREQ (default: estimated from samples)")
+    opts.add_option("-g", "--generate", action="store_true", dest="generate",
+                    help="replay synthetic samples with a known clock")
+    opts.add_option("-d", "--duration", type="float", dest="duration",
+                    default=600., help="synthetic run length in seconds")
+    opts.add_option("-j", "--jitter", type="float", dest="jitter",
+                    default=.000100, help="synthetic mean link jitter")
+    opts.add_option("-o", "--outliers", type="float", dest="outliers",
+                    default=.05, help="synthetic fraction of slow transfers")
+    opts.add_option("--drift", type="float", dest="drift", default=1.,
+                    help="synthetic frequency drift amplitude in ppm")
+    opts.add_option("-l", "--lookahead", type="float", dest="lookahead",
+                    default=1., help="synthetic prediction time in seconds")
+    opts.add_option("-s", "--settle", type="float", dest="settle",
+                    default=2., help="settled error threshold as a multiple"
+                    " of the steady state max error")
+    options, args = opts.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    truth = None
+    if options.generate:
+        if args:
+            opts.error("No log file expected with --generate")
+        freq = options.freq or 72000000.
+        truth = SyntheticClock(freq, options.drift, 300.)
+        samples = generate_samples(truth, options.duration, options.jitter,
+                                   options.outliers)
+    else:
+        if len(args) != 1:
+            opts.error("Incorrect number of arguments")
+        samples = read_log(args[0], options.mcu)
+        if len(samples) < 3:
+            opts.error("Not enough clock samples for mcu '%s'" % (
+                options.mcu,))
+        freq = options.freq
+        if freq is None:
+            freq = ((samples[-1][2] - samples[0][2])
+                    / (samples[-1][0] - samples[0][0]))
+    sys.stdout.write("%d samples over %.1fs, freq=%.0f\n" % (
+        len(samples), samples[-1][0] - samples[0][0], freq))
+    sys.stdout.write("%-8s %10s %12s %10s %10s %10s\n" % (
+        "method", "settle(s)", "rms<10s(us)", "bias(us)", "rms(us)",
+        "max(us)"))
+    for estimator in ESTIMATORS:
+        results = replay(estimator, samples, freq, truth, options.lookahead)
+        settle, early, bias, spread, spread_max = summarize(
+            results, options.settle, 60.)
+        sys.stdout.write("%-8s %10.1f %12.1f %10.1f %10.1f %10.1f\n" % (
+            estimator, settle, early * 1000000., bias * 1000000.,
+            spread * 1000000., spread_max * 1000000.))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# Measure the g-code parsing and dispatch rate of GCodeDispatch
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, random
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import gcode
+
+class error(Exception):
+    pass
+
+class DummyMutex:
+    def __enter__(self):
+        pass
+    def __exit__(self, type, value, tb):
+        pass
+
+class DummyReactor:
+    def mutex(self):
+        return DummyMutex()
+
+# Minimal printer providing what GCodeDispatch needs
+class DummyPrinter:
+    config_error = error
+    def get_start_args(self):
+        return {}
+    def get_reactor(self):
+        return DummyReactor()
+    def register_event_handler(self, event, callback):
+        pass
+    def send_event(self, event, *params):
+        pass
+
+# Move handler parsing its words like GCodeMove.cmd_G1
+class MoveSink:
+    def __init__(self, axis_names):
+        self.move_words = [(w, gcode.MOVE_WORD_INDEX[w])
+                           for w in axis_names + 'EF']
+        self.count = 0
+    def cmd_G1(self, gcmd):
+        params = gcmd.get_command_parameters()
+        coords = [None] * len(gcode.MOVE_WORDS)
+        for w, i in self.move_words:
+            if w in params:
+                coords[i] = float(params[w])
+        self.move_G1(gcmd, coords)
+    def move_G1(self, gcmd, coords):
+        self.count += 1
+    def cmd_other(self, gcmd):
+        pass
+
+def setup_dispatch(axis_names, fast_path):
+    gd = gcode.GCodeDispatch(DummyPrinter())
+    sink = MoveSink(axis_names)
+    for cmd in ['G0', 'G1']:
+        gd.register_command(cmd, sink.cmd_G1)
+        if fast_path:
+            gd.register_move_handler(cmd, sink.move_G1)
+    for cmd in ['G2', 'G3', 'G17', 'G90', 'G91', 'G92', 'M3', 'M5']:
+        gd.register_command(cmd, sink.cmd_other)
+    gd._handle_ready()
+    return gd, sink
+
+def generate_cam_file(filename, count, axis_names):
+    # Write a synthetic CAM style program with short segments
+    rnd = random.Random(42)
+    f = open(filename, 'w')
+    f.write("G90\nM3 S10000\nG0 X0 Y0 Z5\n")
+    pos = [0.] * len(axis_names)
+    for i in range(count):
+        words = []
+        for j, a in enumerate(axis_names):
+            if j >= 2 and rnd.random() < .8:
+                continue
+            pos[j] += rnd.uniform(-.5, .5)
+            words.append("%s%.4f" % (a, pos[j]))
+        if not i % 50:
+            words.append("F%d" % (rnd.randint(600, 3000),))
+        f.write("G1 %s\n" % (" ".join(words),))
+    f.write("M5\n")
+    f.close()
+
+def run_dispatch(lines, axis_names, fast_path, chunk=1024):
+    gd, sink = setup_dispatch(axis_names, fast_path)
+    start = time.time()
+    for i in range(0, len(lines), chunk):
+        gd._process_commands(lines[i:i+chunk], need_ack=False)
+    return time.time() - start, sink.count
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-a", "--axes", type="string", dest="axes",
+                    default="XYZABC", help="toolhead axis names")
+    opts.add_option("-g", "--generate", type="int", dest="generate",
+                    default=0, help="write a synthetic CAM file with the"
+                    " given number of moves before running")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of runs (best result is reported)")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    filename = args[0]
+    if options.generate:
+        generate_cam_file(filename, options.generate, options.axes)
+    f = open(filename, 'r')
+    data = f.read()
+    f.close()
+    lines = data.split('\n')
+    sys.stdout.write("%s: %d lines, %.1f MB\n"
+                     % (filename, len(lines), len(data) / (1024. * 1024.)))
+    for name, fast_path in [("generic", False), ("fast path", True)]:
+        best = None
+        for i in range(options.repeat):
+            elapsed, moves = run_dispatch(lines, options.axes, fast_path)
+            if best is None or elapsed < best:
+                best = elapsed
+        sys.stdout.write("%-10s %.3fs  %10.0f lines/sec  %d moves\n"
+                         % (name, best, len(lines) / best, moves))
+
+if __name__ == '__main__':
+    main()
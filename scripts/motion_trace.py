@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Script to decode a binary motion trace written by SET_MOTION_TRACE
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, struct, sys
+
+RECORD = struct.Struct('<HHI5d')
+HEADER = struct.Struct('<8sIIII')
+TRACE_MAGIC = b'KMTRACE1'
+
+# Trace point names and argument labels (see klippy/motiontrace.py)
+TRACE_POINTS = {
+    1: ("move", ("move_d", "min_move_t", "max_cruise_v2", "accel",
+                 "is_kinematic")),
+    2: ("junction", ("max_start_v2", "max_smoothed_v2", "cos_theta")),
+    3: ("set_junction", ("start_v", "cruise_v", "end_v", "move_t")),
+    4: ("flush", ("queue_len", "flush_count", "lazy")),
+    5: ("process_moves", ("print_time", "next_move_time", "move_count")),
+    6: ("update_move_time", ("print_time", "sg_flush_time", "free_time",
+                             "mcu_flush_time")),
+    7: ("set_position", ("print_time", "x", "y", "z", "e")),
+    8: ("drip", ("print_time", "next_print_time")),
+}
+
+def read_trace(filename):
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+    if len(data) < HEADER.size:
+        raise ValueError("File too short")
+    magic, rec_size, count, seq, names_len = HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC or rec_size != RECORD.size:
+        raise ValueError("Not a motion trace file")
+    pos = HEADER.size
+    sources = data[pos:pos+names_len].decode().split('\n')
+    pos += names_len
+    records = []
+    for i in range(count):
+        records.append(RECORD.unpack_from(data, pos + i * RECORD.size))
+    return sources, records
+
+def format_record(sources, rec):
+    tp, source, seq = rec[:3]
+    name, labels = TRACE_POINTS.get(tp, ("tp%d" % (tp,), ()))
+    if source < len(sources):
+        sname = sources[source]
+    else:
+        sname = "source%d" % (source,)
+    args = ["%s=%.9f" % (label, val) for label, val in zip(labels, rec[3:])]
+    return "%10d %-10s %-16s %s" % (seq, sname, name, " ".join(args))
+
+def main():
+    usage = "%prog [options] <trace file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--tracepoint", type="string", dest="tracepoint",
+                    default=None, help="only show the given trace point")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    try:
+        sources, records = read_trace(args[0])
+    except (IOError, ValueError) as e:
+        sys.stderr.write("Unable to read trace: %s\n" % (e,))
+        sys.exit(-1)
+    for rec in records:
+        if (options.tracepoint is not None
+            and TRACE_POINTS.get(rec[0], ("",))[0] != options.tracepoint):
+            continue
+        sys.stdout.write(format_record(sources, rec) + "\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# Measure the timer and file descriptor dispatch cost of the reactors
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor
+
+# Register idle timers (like heater, fan and status timers) far in the
+# future; "churn" of them are rescheduled on every dispatch.
+class BackgroundTimers:
+    def __init__(self, r, count, churn):
+        self.reactor = r
+        self.churn = churn
+        self.rnd = random.Random(42)
+        now = r.monotonic()
+        self.timers = [r.register_timer(self._event, now + 3600. + i)
+                       for i in range(count)]
+    def _event(self, eventtime):
+        return eventtime + 3600.
+    def update(self, eventtime):
+        timers = self.timers
+        if not timers:
+            return
+        rnd = self.rnd
+        for i in range(self.churn):
+            t = timers[rnd.randrange(len(timers))]
+            self.reactor.update_timer(t, eventtime + rnd.uniform(60., 3600.))
+
+def bench_timers(r, background, count):
+    # A timer that is always due, measuring the cost of a dispatch pass
+    state = {'count': 0}
+    def event(eventtime):
+        state['count'] += 1
+        background.update(eventtime)
+        if state['count'] >= count:
+            r.end()
+            return r.NEVER
+        return r.NOW
+    start = r.monotonic()
+    r.register_timer(event, r.NOW)
+    r.run()
+    return (r.monotonic() - start) / count
+
+def bench_fds(r, background, count):
+    # Pass a byte through a pipe, measuring the cost of a fd wake up
+    rfd, wfd = os.pipe()
+    state = {'count': 0}
+    def read_event(eventtime):
+        os.read(rfd, 1)
+        state['count'] += 1
+        background.update(eventtime)
+        if state['count'] >= count:
+            r.end()
+            return
+        os.write(wfd, b'.')
+    handler = r.register_fd(rfd, read_event)
+    start = r.monotonic()
+    os.write(wfd, b'.')
+    r.run()
+    elapsed = r.monotonic() - start
+    r.unregister_fd(handler)
+    os.close(rfd)
+    os.close(wfd)
+    return elapsed / count
+
+def bench_latency(r, background, count, delay=.002):
+    # Lateness of a timer scheduled a short time in the future
+    late = []
+    def event(eventtime):
+        now = r.monotonic()
+        if late:
+            late[-1] = now - late[-1]
+        if len(late) >= count:
+            r.end()
+            return r.NEVER
+        background.update(eventtime)
+        waketime = now + delay
+        late.append(waketime)
+        return waketime
+    r.register_timer(event, r.NOW)
+    r.run()
+    return sum(late) / len(late), max(late)
+
+def run_reactor(name, timer_count, churn, count, latency_count):
+    results = []
+    for func, n in [(bench_timers, count), (bench_fds, count)]:
+        r = reactor.REACTORS[name]()
+        background = BackgroundTimers(r, timer_count, churn)
+        results.append(func(r, background, n))
+        r.finalize()
+    r = reactor.REACTORS[name]()
+    background = BackgroundTimers(r, timer_count, churn)
+    results.extend(bench_latency(r, background, latency_count))
+    r.finalize()
+    return results
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--timers", type="string", dest="timers",
+                    default="10,100,1000",
+                    help="comma separated numbers of background timers")
+    opts.add_option("-u", "--churn", type="int", dest="churn", default=4,
+                    help="background timers rescheduled per dispatch")
+    opts.add_option("-n", "--count", type="int", dest="count", default=20000,
+                    help="number of timer and fd dispatches")
+    opts.add_option("-l", "--latency", type="int", dest="latency",
+                    default=200, help="number of timer latency samples")
+    opts.add_option("-r", "--reactors", type="string", dest="reactors",
+                    default=",".join(sorted(reactor.REACTORS)),
+                    help="comma separated reactors to measure")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    names = options.reactors.split(',')
+    for name in names:
+        if name not in reactor.REACTORS:
+            opts.error("Unknown reactor '%s'" % (name,))
+    sys.stdout.write("%-10s %7s %10s %10s %10s %10s\n" % (
+        "reactor", "timers", "timer(us)", "fd(us)", "late(us)", "max(us)"))
+    for timer_count in [int(v) for v in options.timers.split(',')]:
+        for name in names:
+            res = run_reactor(name, timer_count, options.churn,
+                              options.count, options.latency)
+            sys.stdout.write("%-10s %7d %10.2f %10.2f %10.1f %10.1f\n" % (
+                name, timer_count, res[0] * 1000000., res[1] * 1000000.,
+                res[2] * 1000000., res[3] * 1000000.))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# Check that the C and Python lookahead planners give identical results
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, math, re, random
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import toolhead
+
+class error(Exception):
+    pass
+
+class DummyTrace:
+    enabled = False
+
+class DummyExtruder:
+    def calc_junction(self, prev_move, move):
+        return move.max_cruise_v2
+
+# Minimal toolhead providing what Move and MoveQueue need
+class PlannerToolHead:
+    def __init__(self, axis_names, native_planner, options):
+        self.axis_names = axis_names
+        self.axis_count = len(axis_names)
+        self.max_velocity = options.max_velocity
+        self.max_accel = options.max_accel
+        self.max_accel_to_decel = options.max_accel * .5
+        scv2 = options.square_corner_velocity**2
+        self.junction_deviation = scv2 * (math.sqrt(2.) - 1.) / self.max_accel
+        self.extruder = DummyExtruder()
+        self.trace = DummyTrace()
+        self.trace_source = 0
+        self.move_queue = toolhead.MoveQueue(self, native_planner)
+        self.results = []
+        self.flush_count = 0
+    def _process_moves(self, moves):
+        # Record the junction limits, the planned velocities and the
+        # flush that processed each move
+        self.flush_count += 1
+        for m in moves:
+            self.results.append((self.flush_count,
+                                 m.max_start_v2, m.max_smoothed_v2,
+                                 m.start_v, m.cruise_v, m.end_v,
+                                 m.accel_t, m.cruise_t, m.decel_t))
+    def move(self, start_pos, end_pos, speed):
+        move = toolhead.Move(self, start_pos, end_pos, speed)
+        if move.move_d:
+            self.move_queue.add_move(move)
+
+
+######################################################################
+# G-Code parsing
+######################################################################
+
+def parse_gcode(filename, axis_names):
+    # Return a list of ('move', end_pos, speed) and ('flush',) actions
+    axes = axis_names + 'E'
+    pos = [0.] * len(axes)
+    speed = 25.
+    absolute = True
+    actions = []
+    args_r = re.compile('([A-Z])([-+]?[0-9.]*)')
+    f = open(filename, 'r')
+    for line in f:
+        line = line.split(';')[0].strip().upper()
+        if not line:
+            continue
+        parts = line.split()
+        cmd = parts[0]
+        params = dict(args_r.match(p).groups() for p in parts[1:]
+                      if args_r.match(p))
+        if cmd in ('G0', 'G1'):
+            if 'F' in params:
+                speed = float(params['F']) / 60.
+            newpos = list(pos)
+            for i, a in enumerate(axes):
+                if a in params:
+                    v = float(params[a])
+                    newpos[i] = v if absolute else pos[i] + v
+            actions.append(('move', tuple(pos), tuple(newpos), speed))
+            pos = newpos
+        elif cmd == 'G90':
+            absolute = True
+        elif cmd == 'G91':
+            absolute = False
+        elif cmd == 'G28':
+            pos = [0.] * len(axes)
+            actions.append(('flush',))
+        elif cmd in ('G4', 'M400'):
+            actions.append(('flush',))
+    f.close()
+    actions.append(('flush',))
+    return actions
+
+# Random path of short segments with near colinear junctions, corners
+# and reversals (exercises lazy flushing and the junction limits)
+def generate_actions(count, seed, axis_names):
+    rand = random.Random(seed)
+    pos = [0.] * (len(axis_names) + 1)
+    angle = 0.
+    speed = 100.
+    actions = []
+    for i in range(count):
+        r = rand.random()
+        if r < .02:
+            angle += math.pi
+        elif r < .07:
+            angle += rand.uniform(-math.pi, math.pi)
+        else:
+            angle += rand.uniform(-.01, .01)
+        if rand.random() < .02:
+            speed = rand.uniform(5., 300.)
+        dist = rand.choice([rand.uniform(.001, .05), rand.uniform(.05, 2.),
+                            rand.uniform(2., 20.)])
+        newpos = list(pos)
+        newpos[0] += dist * math.cos(angle)
+        newpos[1] += dist * math.sin(angle)
+        if len(axis_names) > 2 and rand.random() < .05:
+            newpos[2] += rand.uniform(-.5, .5)
+        actions.append(('move', tuple(pos), tuple(newpos), speed))
+        pos = newpos
+        if rand.random() < .002:
+            actions.append(('flush',))
+    actions.append(('flush',))
+    return actions
+
+def run_planner(actions, axis_names, native_planner, options):
+    th = PlannerToolHead(axis_names, native_planner, options)
+    for action in actions:
+        if action[0] == 'move':
+            th.move(*action[1:])
+        else:
+            th.move_queue.flush()
+    return th.results
+
+def check_actions(filename, actions, options):
+    py_results = run_planner(actions, options.axes, False, options)
+    c_results = run_planner(actions, options.axes, True, options)
+    if len(py_results) != len(c_results):
+        raise error("%s: planned %d moves in python but %d in C"
+                    % (filename, len(py_results), len(c_results)))
+    for i, (py, c) in enumerate(zip(py_results, c_results)):
+        if py != c:
+            raise error("%s: move %d differs: python=%s C=%s"
+                        % (filename, i, py, c))
+    return len(py_results)
+
+def main():
+    usage = "%prog [options] <gcode file> ..."
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-a", "--axes", type="string", dest="axes",
+                    default="XYZ", help="toolhead axis names")
+    opts.add_option("-v", "--max_velocity", type="float", dest="max_velocity",
+                    default=300., help="maximum velocity")
+    opts.add_option("-c", "--max_accel", type="float", dest="max_accel",
+                    default=3000., help="maximum acceleration")
+    opts.add_option("-s", "--square_corner_velocity", type="float",
+                    dest="square_corner_velocity", default=5.,
+                    help="square corner velocity")
+    opts.add_option("-g", "--generate", type="int", dest="generate",
+                    default=0, help="also check a random path of this many"
+                    " moves")
+    opts.add_option("--seed", type="int", dest="seed", default=0,
+                    help="random seed of the generated path")
+    options, args = opts.parse_args()
+    if len(args) < 1 and not options.generate:
+        opts.error("Incorrect number of arguments")
+    checks = [(fname, parse_gcode(fname, options.axes)) for fname in args]
+    if options.generate:
+        checks.append(("generated path (seed %d)" % (options.seed,),
+                       generate_actions(options.generate, options.seed,
+                                        options.axes)))
+    for fname, actions in checks:
+        try:
+            count = check_actions(fname, actions, options)
+        except error as e:
+            sys.stderr.write("%s\n" % (str(e),))
+            sys.exit(-1)
+        sys.stdout.write("%s: %d moves planned identically\n" % (fname, count))
+
+if __name__ == '__main__':
+    main()
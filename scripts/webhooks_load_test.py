@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Load test the API Server with several simulated status subscribers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, optparse, socket, select, json, time
+
+DEFAULT_OBJECTS = ("toolhead,gcode_move,motion_report,heaters,extruder,"
+                   "heater_bed,print_stats,virtual_sdcard,idle_timeout,"
+                   "webhooks,configfile")
+
+# A client connection that subscribes like Moonraker does and counts
+# the status updates it receives
+class SimClient:
+    def __init__(self, uds_filename):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(uds_filename)
+        self.sock.setblocking(0)
+        self.partial_data = b""
+        self.next_id = 1
+        self.pending = {}
+        self.updates = self.update_bytes = 0
+    def fileno(self):
+        return self.sock.fileno()
+    def send_request(self, method, params, callback=None):
+        msg_id = self.next_id
+        self.next_id += 1
+        self.pending[msg_id] = (time.time(), callback)
+        req = {'id': msg_id, 'method': method, 'params': params}
+        self.sock.sendall(json.dumps(req).encode() + b"\x03")
+    def process(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise Exception("Connection closed by klippy")
+        msgs = data.split(b"\x03")
+        msgs[0] = self.partial_data + msgs[0]
+        self.partial_data = msgs.pop()
+        for msg in msgs:
+            if b'"notify_status_update"' in msg[:40]:
+                self.updates += 1
+                self.update_bytes += len(msg) + 1
+                continue
+            resp = json.loads(msg)
+            send_time, callback = self.pending.pop(resp.get('id'),
+                                                   (None, None))
+            if callback is not None:
+                callback(resp, time.time() - send_time)
+
+def wait_idle(clients):
+    while any([c.pending for c in clients]):
+        rl, wl, xl = select.select(clients, [], [], 1.)
+        for c in rl:
+            c.process()
+
+def main():
+    usage = "%prog [options] <socket filename>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--clients", type="int", dest="clients",
+                    default=10, help="number of simulated clients")
+    opts.add_option("-t", "--time", type="float", dest="duration",
+                    default=30., help="test duration in seconds")
+    opts.add_option("-o", "--objects", type="string", dest="objects",
+                    default=DEFAULT_OBJECTS,
+                    help="comma separated printer objects to subscribe to")
+    opts.add_option("-g", "--gcode", type="string", dest="gcode",
+                    default=None, help="G-Code script to run repeatedly")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    clients = [SimClient(args[0]) for i in range(options.clients)]
+    # Subscribe to the available objects
+    first = clients[0]
+    objects = []
+    def handle_list(resp, rtt):
+        available = resp['result']['objects']
+        objects.extend([o for o in options.objects.split(',')
+                        if o in available])
+    first.send_request('objects/list', {}, handle_list)
+    wait_idle(clients)
+    sys.stdout.write("Subscribing %d clients to %s\n" % (
+        len(clients), ",".join(objects)))
+    for c in clients:
+        c.send_request('objects/subscribe', {
+            'objects': {o: None for o in objects},
+            'response_template': {'method': 'notify_status_update'}})
+    wait_idle(clients)
+    has_stats = []
+    def handle_stats(resp, rtt):
+        if 'result' in resp:
+            has_stats.append(resp['result'])
+    first.send_request('reactor/stats', {'reset': True}, handle_stats)
+    for c in clients:
+        c.updates = c.update_bytes = 0
+    # Measure request round trips (and run gcode) while clients receive
+    # status updates
+    rtts = []
+    gcode_runs = []
+    gcode_errors = []
+    def handle_info(resp, rtt):
+        rtts.append(rtt)
+    def handle_gcode(resp, rtt):
+        if 'error' in resp:
+            gcode_errors.append(resp['error'])
+            return
+        gcode_runs.append(rtt)
+        if time.time() >= start_time + options.duration:
+            return
+        first.send_request('gcode/script', {'script': options.gcode},
+                           handle_gcode)
+    start_time = time.time()
+    if options.gcode:
+        first.send_request('gcode/script', {'script': options.gcode},
+                           handle_gcode)
+    next_info = start_time
+    while time.time() < start_time + options.duration:
+        curtime = time.time()
+        if curtime >= next_info:
+            clients[-1].send_request('info', {}, handle_info)
+            next_info = curtime + .100
+        rl, wl, xl = select.select(clients, [], [], .050)
+        for c in rl:
+            c.process()
+    elapsed = time.time() - start_time
+    del has_stats[:]
+    first.send_request('reactor/stats', {}, handle_stats)
+    wait_idle(clients)
+    # Report
+    updates = sum([c.updates for c in clients])
+    update_bytes = sum([c.update_bytes for c in clients])
+    sys.stdout.write("%d updates (%.1f/s, %.1f KiB/s) over %.1fs\n" % (
+        updates, updates / elapsed, update_bytes / elapsed / 1024., elapsed))
+    if rtts:
+        rtts.sort()
+        sys.stdout.write("info request round trip: avg=%.2fms median=%.2fms"
+                         " max=%.2fms\n" % (
+                             sum(rtts) / len(rtts) * 1000.,
+                             rtts[len(rtts) // 2] * 1000., rtts[-1] * 1000.))
+    if options.gcode:
+        sys.stdout.write("gcode script runs: %d\n" % (len(gcode_runs),))
+        if gcode_errors:
+            sys.stdout.write("gcode script error: %s\n" % (gcode_errors[0],))
+    if has_stats:
+        # Time spent in the webhooks callbacks of the klippy reactor
+        cbs = has_stats[0]['callbacks']
+        names = sorted([n for n in cbs if n.startswith('webhooks.')],
+                       key=lambda n: -cbs[n]['total_time'])
+        sys.stdout.write("%-48s %8s %10s %9s\n" % (
+            "reactor callback", "count", "total(ms)", "max(ms)"))
+        for name in names:
+            cs = cbs[name]
+            sys.stdout.write("%-48s %8d %10.1f %9.2f\n" % (
+                name, cs['count'], cs['total_time'] * 1000.,
+                cs['max_time'] * 1000.))
+    for c in clients:
+        c.sock.close()
+
+if __name__ == '__main__':
+    main()